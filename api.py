@@ -1,19 +1,74 @@
-from flask import Blueprint, jsonify
+import json
+from itertools import islice
+
+from flask import Blueprint, Response, jsonify, request, stream_with_context
 from flask.views import View
 
 from models import User, Category, Movie, Comment
+from movies import omdb_breaker, omdb_cache, omdb_flight, wikipedia_breaker, wikipedia_flight
 
 api = Blueprint('api', __name__)
 
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+#rows fetched from the database cursor at a time in streaming mode
+STREAM_BATCH_SIZE = 500
+
 class APIView(View):
+    '''
+    JSON listing of a model's rows, paginated by `id`.
+
+    `?limit=N&after=ID` returns up to N rows with ids greater than ID, along
+    with the `next` cursor to pass as `after` for the following page (null on
+    the last page). `?stream=1` returns every row, written out incrementally.
+    '''
     def __init__(self, model_class):
         self.model = model_class
 
+    def serialize(self, rows):
+        #models can provide a batched serializer to avoid a query per row
+        to_json_many = getattr(self.model, 'to_json_many', None)
+        if to_json_many:
+            return to_json_many(rows)
+        return [row.to_json() for row in rows]
+
     def dispatch_request(self):
-        result = [row.to_json() for row in self.model.query.all()]
-        return jsonify({"result": result})
+        if request.args.get('stream'):
+            return self.stream()
+
+        limit = max(1, min(request.args.get('limit', DEFAULT_LIMIT, type=int), MAX_LIMIT))
+        after = request.args.get('after', 0, type=int)
+        rows = self.model.query.filter(self.model.id > after).order_by(self.model.id).limit(limit + 1).all()
+        next_cursor = rows[limit - 1].id if len(rows) > limit else None
+        return jsonify({"result": self.serialize(rows[:limit]), "next": next_cursor})
+
+    def stream(self):
+        rows = iter(self.model.query.order_by(self.model.id).yield_per(STREAM_BATCH_SIZE))
+
+        def generate():
+            yield '{"result": ['
+            first = True
+            while True:
+                batch = list(islice(rows, STREAM_BATCH_SIZE))
+                if not batch:
+                    break
+                for item in self.serialize(batch):
+                    yield ('' if first else ', ') + json.dumps(item)
+                    first = False
+            yield '], "next": null}'
+
+        return Response(stream_with_context(generate()), mimetype='application/json')
 
 api.add_url_rule('/user', view_func=APIView.as_view('user', User))
 api.add_url_rule('/category', view_func=APIView.as_view('category', Category))
 api.add_url_rule('/movie', view_func=APIView.as_view('movie', Movie))
 api.add_url_rule('/comment', view_func=APIView.as_view('comment', Comment))
+
+@api.route('/cache')
+def cache_stats():
+    '''Cache hit/miss/eviction, upstream fetch coalescing and circuit breaker counters for this worker process.'''
+    return jsonify({
+        "omdb": omdb_cache.stats(),
+        "coalescing": {"omdb": omdb_flight.stats(), "wikipedia": wikipedia_flight.stats()},
+        "breakers": {"omdb": omdb_breaker.stats(), "wikipedia": wikipedia_breaker.stats()},
+    })
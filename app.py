@@ -2,36 +2,82 @@
 Movie picker flask application.
 '''
 
+import hashlib
+import httplib
 import logging
 import os
-import random
-import urllib
+import socket
+import time
+from collections import namedtuple
 from datetime import datetime, timedelta
 from functools import wraps
 
 from flask import (
     Flask, g, request, url_for, session,
-    render_template, redirect,
+    render_template, redirect, send_file, abort, jsonify, make_response,
 )
 from flask_admin import Admin, AdminIndexView, BaseView, expose
 from flask_admin.contrib.sqla import ModelView
+from jinja2 import Markup
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+from werkzeug.local import LocalProxy
 
 from movies import (
-    MovieData,
-    fetch_wikipedia_titles, fetch_omdb_info, is_valid_category,
+    MovieData, OMDbResult,
+    fetch_wikipedia_titles, fetch_omdb_info, fetch_omdb_info_many, is_valid_category, raise_for_omdb_error,
+    titles_changed_listeners,
 )
+import httpclient
+import metrics
+import recommendations
+from breaker import UpstreamUnavailable
+from cache import LRUCache, open_cache, open_disk_cache
+from titleindex import open_title_index
+from search import open_search_index
 from models import db, User, Category, Movie, Comment
 from api import api
 from forms import RegistrationForm, LoginForm
+from passwords import HashingOverloaded
 
 app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DBURI', 'sqlite:///movies.db')
 app.config['SQLALCHEMY_ECHO'] = bool(os.environ.get('ECHO'))
 db.init_app(app)
+metrics.init_app(app)
 
 # http://flask.pocoo.org/docs/0.10/errorhandling/
 logging.basicConfig(level=logging.INFO)
 
+#posters are kept on disk (up to POSTER_CACHE_BYTES) and browsers are told to cache them for POSTER_MAX_AGE seconds
+POSTER_CACHE_BYTES = int(os.environ.get('POSTER_CACHE_BYTES', 512 * 1024 * 1024))
+POSTER_MAX_AGE = 60 * 60 * 24 * 365
+#larger images aren't rehosted, so one response can't take over the poster cache
+POSTER_MAX_BYTES = int(os.environ.get('POSTER_MAX_BYTES', 10 * 1024 * 1024))
+poster_cache = open_disk_cache("posters", POSTER_CACHE_BYTES)
+
+#each worker remembers who is logged in for IDENTITY_CACHE_TTL seconds (0 to disable)
+IDENTITY_CACHE_TTL = int(os.environ.get('IDENTITY_CACHE_TTL', 30))
+IDENTITY_CACHE_SIZE = 10000
+identity_cache = LRUCache(IDENTITY_CACHE_SIZE, IDENTITY_CACHE_TTL)
+#role changes stamp the user in a cache shared by every worker, and cached identities are only used while the stamp
+#they were cached with is current, so a demoted admin loses access in every worker within IDENTITY_STAMP_CHECK seconds
+#(how long a worker trusts the stamp it last read). With caching disabled only the worker making the change notices
+#it, the others keep the old role for up to IDENTITY_CACHE_TTL seconds.
+identity_stamps = open_cache("identities.db", 60 * 60 * 24 * 30)
+IDENTITY_STAMP_CHECK = float(os.environ.get('IDENTITY_STAMP_CHECK', 2))
+identity_stamp_checks = LRUCache(IDENTITY_CACHE_SIZE, IDENTITY_STAMP_CHECK)
+
+search_index = open_search_index()
+title_index = open_title_index(search_index=search_index)
+
+#most changes /user/list applies in one request
+MAX_LIST_CHANGES = int(os.environ.get('MAX_LIST_CHANGES', 1000))
+
+#rendered category and movie page content, shared by all workers and invalidated when it changes
+PAGE_CACHE_TTL = int(os.environ.get('PAGE_CACHE_TTL', 60 * 60))
+page_cache = open_cache("pages.db", PAGE_CACHE_TTL)
+
 if os.environ.get('SECRET_KEY_PATH'):
     with open(os.environ['SECRET_KEY_PATH']) as f:
         app.secret_key = f.read().strip()
@@ -56,6 +102,10 @@ class ProtectedAdminModelView(ModelView):
     def inaccessible_callback(self, *a, **kw):
         return redirect(url_for('login'))
 
+#comments shown per page of the moderation queue, and updated per statement by the bulk actions
+MODERATION_PAGE_SIZE = 100
+MODERATION_BATCH_SIZE = 500
+
 class CommentModeration(BaseView):
     '''Easier moderation of comments.'''
     def is_accessible(self):
@@ -66,29 +116,42 @@ class CommentModeration(BaseView):
 
     @expose('/')
     def index(self):
+        page = request.args.get('page', 1, type=int)
         one_day_ago = datetime.utcnow() - timedelta(hours=24)
-        comments = Comment.query.filter(
+        comments = Comment.query.options(
+            db.joinedload(Comment.user), db.joinedload(Comment.movie),
+        ).filter(
             db.and_(Comment.created >= one_day_ago, Comment.is_visible == False, Comment.is_deleted != True)
-        ).all()
+        ).order_by(Comment.created, Comment.id).paginate(page, MODERATION_PAGE_SIZE, error_out=False)
         return self.render('admin/moderation.html', comments=comments)
 
+    def _update(self, comment_ids, **values):
+        '''Set `values` on the given comments with UPDATE statements, without loading them.'''
+        titles = set()
+        for start in range(0, len(comment_ids), MODERATION_BATCH_SIZE):
+            batch = comment_ids[start:start + MODERATION_BATCH_SIZE]
+            titles.update(t for t, in db.session.query(Movie.title).join(Comment).filter(Comment.id.in_(batch)).distinct())
+            Comment.query.filter(Comment.id.in_(batch)).update(values, synchronize_session=False)
+        db.session.commit()
+        for title in titles:
+            invalidate_movie_page(title)
+        return redirect(url_for('moderation.index', page=request.values.get('page', 1, type=int)))
+
     @expose('/approve', methods=['POST'])
     def approve(self):
-        comment_id = int(request.values['comment_id'])
-        c = Comment.query.get(comment_id)
-        c.is_visible = True
-        db.session.add(c)
-        db.session.commit()
-        return redirect(url_for('moderation.index'))
+        return self._update([int(request.values['comment_id'])], is_visible=True)
 
     @expose('/reject', methods=['POST'])
     def reject(self):
-        comment_id = int(request.values['comment_id'])
-        c = Comment.query.get(comment_id)
-        c.is_deleted = True
-        db.session.add(c)
-        db.session.commit()
-        return redirect(url_for('moderation.index'))
+        return self._update([int(request.values['comment_id'])], is_deleted=True)
+
+    @expose('/approve_many', methods=['POST'])
+    def approve_many(self):
+        return self._update([int(i) for i in request.values.getlist('comment_ids')], is_visible=True)
+
+    @expose('/reject_many', methods=['POST'])
+    def reject_many(self):
+        return self._update([int(i) for i in request.values.getlist('comment_ids')], is_deleted=True)
 
 admin = Admin(app, name='MoviePicker Admin', index_view=ProtectedAdminIndexView())
 admin.add_view(CommentModeration(name='Moderation', endpoint='moderation'))
@@ -98,32 +161,153 @@ for model in [User, Category, Movie, Comment]:
 
 ## utilities ##################################################################
 
+Identity = namedtuple('Identity', 'id username role')
+
 @app.before_request
 def before_request():
     '''
-    If there is a user currently in the session, look up their User object in
-    the database and set `g.user`.
+    Set `g.user` to the User object for the user currently in the session (or
+    None). The database is only queried the first time `g.user` is used during
+    the request.
     '''
-    g.user = None
-    if 'user' in session:
-        g.user = User.query.get(session['user'])
+    g.pop('_user', None)
+    g.user = LocalProxy(_lookup_user)
+
+def _lookup_user():
+    if '_user' not in g:
+        g._user = User.query.get(session['user']) if 'user' in session else None
+    return g._user
+
+def current_identity():
+    '''
+    Returns the `Identity` of the user currently in the session, or None.
+
+    Identities are cached by each worker, so checking who is logged in (and
+    their role) doesn't need a database query, or a read of the shared
+    stamps, on every request.
+    '''
+    if 'user' not in session:
+        return None
+    stamp = identity_stamp(session['user'])
+    entry = identity_cache.get(session['user'])
+    if entry is not None and entry.is_fresh and entry.value[0] == stamp:
+        return entry.value[1]
+    user = _lookup_user()
+    if user is None:
+        return None
+    identity = Identity(user.id, user.username, user.role)
+    identity_cache.set(user.id, (stamp, identity))
+    return identity
+
+def identity_stamp(user_id):
+    entry = identity_stamp_checks.get(user_id)
+    if entry is not None and entry.is_fresh:
+        return entry.value
+    entry = identity_stamps.get(str(user_id))
+    stamp = entry and entry.value
+    identity_stamp_checks.set(user_id, stamp)
+    return stamp
+
+@event.listens_for(User.role, 'set')
+def invalidate_identity(user, value, oldvalue, initiator):
+    if value != oldvalue and user.id is not None:
+        identity_cache.delete(user.id)
+        session = object_session(user)
+        if session is not None:
+            session.info.setdefault('changed_identities', set()).add(user.id)
+
+@event.listens_for(Session, 'after_commit')
+def stamp_changed_identities(session):
+    #only once the new role is committed, or other workers could cache the old one under the new stamp
+    for user_id in session.info.pop('changed_identities', ()):
+        identity_stamps.set(str(user_id), time.time())
+        identity_stamp_checks.delete(user_id)
+        identity_cache.delete(user_id)
 
 def is_admin():
-    return g.user and g.user.role == 'admin'
+    identity = current_identity()
+    return bool(identity) and identity.role == 'admin'
 
 def is_admin_visible():
-    return g.user and g.user.role in ['admin', 'moderator']
+    identity = current_identity()
+    return bool(identity) and identity.role in ['admin', 'moderator']
 
 def is_logged_in():
-    return bool(g.user)
+    return current_identity() is not None
 
 @app.context_processor
 def add_utils_to_template_context():
     return dict(
+        current_identity=current_identity,
         is_admin_visible=is_admin_visible,
         is_logged_in=is_logged_in,
     )
 
+def cached_page(key, render_content, version=None):
+    '''
+    Respond with the page content cached under `key`, calling
+    `render_content()` to render it on a miss, or if it was cached for another
+    `version` of the data. The ETag covers the content and who is logged in
+    (the navbar differs), and a matching If-None-Match gets a 304 without
+    rendering anything.
+    '''
+    entry = page_cache.get(key)
+    if entry is not None and entry.is_fresh and entry.value.get('version') == version:
+        content = entry.value
+    else:
+        html = render_content()
+        content = dict(html=html, etag=hashlib.sha1(html.encode('utf8')).hexdigest(), version=version)
+        page_cache.set(key, content)
+    etag = hashlib.sha1("{}:{!r}".format(content['etag'], current_identity())).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = make_response(render_template("_page.html", content=Markup(content['html'])))
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+def category_page_key(category):
+    return u"category:{}".format(category)
+
+def movie_page_key(title, logged_in):
+    #the add to list button is only shown to logged in users
+    return u"movie:{}:{}".format(int(logged_in), title)
+
+def invalidate_category_page(category):
+    page_cache.delete(category_page_key(category))
+
+def invalidate_movie_page(title):
+    for logged_in in [False, True]:
+        page_cache.delete(movie_page_key(title, logged_in))
+
+def category_titles_changed(category):
+    invalidate_category_page(category)
+    index = title_index.current()
+    if index is not None and category in index:
+        title_index.refresh(index.categories)
+
+titles_changed_listeners.append(category_titles_changed)
+
+def similar_movies_changed(titles):
+    for title in titles:
+        invalidate_movie_page(title)
+
+recommendations.similar_changed_listeners.append(similar_movies_changed)
+
+@app.errorhandler(HashingOverloaded)
+def hashing_overloaded(e):
+    return (e.message, 503, {'Retry-After': '5'})
+
+UPSTREAM_NAMES = {'omdb': 'OMDb', 'wikipedia': 'Wikipedia'}
+
+@app.errorhandler(UpstreamUnavailable)
+def upstream_unavailable(e):
+    '''Degraded page shown when a page needs Wikipedia or OMDb data that is neither cached nor available.'''
+    html = render_template("unavailable.html", upstream=UPSTREAM_NAMES.get(e.upstream, e.upstream))
+    return (html, 503, {'Retry-After': str(e.retry_after)})
+
 def login_required(f):
     '''
     View decorator that ensures a logged in user is in the session, redirecting
@@ -147,8 +331,17 @@ def index():
 
 @app.route('/categories/<category>')
 def show_category(category, message=''):
-    titles = fetch_wikipedia_titles(category)
-    return render_template("category.html", category=category, titles=titles, message=message)
+    #saved categories are read from the shared title index, other categories are fetched
+    index = title_index.current()
+    #pages rendered from the title index are re-rendered when a rebuild changes the category's titles
+    version = index.checksum(category) if index is not None and category in index else None
+
+    def render_content():
+        titles = index.titles_for(category) if version else fetch_wikipedia_titles(category)
+        return render_template("category.html", category=category, titles=titles, message=message)
+    if message:
+        return render_template("_page.html", content=Markup(render_content()))
+    return cached_page(category_page_key(category), render_content, version)
 
 @app.route('/categories', methods=['GET', 'POST'])
 @login_required
@@ -161,25 +354,80 @@ def add_category():
         category = Category.create(name)
     except RuntimeError, e:
         return render_template("add_category.html", category=name, error=e.message)
+    #make the new category searchable right away, the title index catches up in the background
+    search_index.update_category(category.name, fetch_wikipedia_titles(category.name))
+    title_index.refresh([c.name for c in Category.query.all()])
 
     return show_category(category.name, message='Category created!')
 
 @app.route('/random')
 def random_movie():
-    cat = random.choice(Category.query.all())
-    title = random.choice(fetch_wikipedia_titles(cat.name))
+    '''
+    Redirect to a random movie, picked uniformly from the titles in every
+    category. With `?by=category` a category is picked first, then a title in
+    it.
+    '''
+    index = title_index.get(lambda: [c.name for c in Category.query.all()])
+    title = index.random_title(by_category=request.args.get('by') == 'category')
+    if title is None:
+        return redirect(url_for("index"))
     return redirect(url_for("show_movie", title=title))
 
+def get_search_index():
+    '''The search index, filled from the title index (built first if needed) the first time it's used.'''
+    index = title_index.get(lambda: [c.name for c in Category.query.all()])
+    if not search_index.categories():
+        search_index.sync(index, index.categories)
+    return search_index
+
+@app.route('/search')
+def search():
+    query = request.args.get('q', '')
+    results = get_search_index().search(query) if query else []
+    return render_template("search.html", query=query, results=results)
+
+@app.route('/search/suggest')
+def search_suggest():
+    '''Titles for autocompleting `?q=`, as JSON.'''
+    return jsonify({"result": get_search_index().suggest(request.args.get('q', ''))})
+
+def lookup_movie(title, movie=None):
+    '''
+    OMDb data for `title`, read from its Movie row if ingest.py has filled it
+    in, otherwise fetched from OMDb.
+    '''
+    data = movie.omdb_data if movie is not None else None
+    if data is None:
+        return fetch_omdb_info(title)
+    return raise_for_omdb_error(data, title)
+
+def lookup_movies(movies):
+    '''`OMDbResult`s for a list of Movie rows, fetching the ones that haven't been ingested concurrently.'''
+    fetched = dict((r.title, r) for r in fetch_omdb_info_many([m.title for m in movies if m.omdb_data is None]))
+    results = []
+    for movie in movies:
+        if movie.title in fetched:
+            results.append(fetched[movie.title])
+            continue
+        try:
+            results.append(OMDbResult(movie.title, lookup_movie(movie.title, movie), None))
+        except (RuntimeError, UpstreamUnavailable), e:
+            results.append(OMDbResult(movie.title, None, e))
+    return results
+
 @app.route('/movie/<title>')
 def show_movie(title):
-    movie = Movie.query.filter_by(title=title).one_or_none()
-    comments = movie.comments.filter_by(is_visible=True, is_deleted=False) if movie else []
-    moviedata = MovieData(fetch_omdb_info(title))
-    return render_template("movie.html", moviedata=moviedata, comments=comments)
+    def render_content():
+        movie = Movie.query.filter_by(title=title).one_or_none()
+        comments = movie.visible_comments() if movie else []
+        also_listed = recommendations.also_listed(movie.id) if movie else []
+        moviedata = MovieData(lookup_movie(title, movie))
+        return render_template("movie.html", moviedata=moviedata, comments=comments, also_listed=also_listed)
+    return cached_page(movie_page_key(title, is_logged_in()), render_content)
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
-    if g.user:
+    if is_logged_in():
         return redirect(url_for('index'))
 
     rform = RegistrationForm()
@@ -208,16 +456,42 @@ def logout():
 @app.route('/user', methods=['GET', 'POST'])
 @login_required
 def show_user():
-    if request.method == 'POST' and request.form['action'] == 'add':
-        User.query.get(g.user.id).add_to_list(request.form['title'])
-        return "Added."
-    elif request.method == 'POST' and request.form['action'] == 'remove':
-        User.query.get(g.user.id).remove_from_list(request.form['title'])
-        return "Removed."
-
-    movies = g.user.movies
-    movies = [MovieData(fetch_omdb_info(movie.title)) for movie in movies]
-    return render_template("user.html", movies=movies)
+    if request.method == 'POST' and request.form['action'] in ('add', 'remove'):
+        [(status, error)] = g.user.update_list([(request.form['action'], request.form['title'])])
+        if status == 'error':
+            return error, 400
+        recommendations.schedule_refresh(app)
+        return "Added." if request.form['action'] == 'add' else "Removed."
+
+    results = lookup_movies(g.user.movies)
+    movies = [MovieData(r.data) for r in results if r.error is None]
+    #titles OMDb doesn't know can be removed, the others will be back when OMDb is
+    unavailable = [r.title for r in results if isinstance(r.error, UpstreamUnavailable)]
+    missing = [r.title for r in results if r.error is not None and r.title not in unavailable]
+    suggestions = recommendations.suggestions(current_identity().id)
+    return render_template("user.html", movies=movies, missing=missing, unavailable=unavailable, suggestions=suggestions)
+
+@app.route('/user/list', methods=['POST'])
+@login_required
+def update_list():
+    '''
+    Apply a batch of changes to the user's list in one transaction. Takes a
+    JSON body like `{"changes": [{"action": "add", "title": "Up"}, ...]}` and
+    returns the outcome of each change, in the same order, as `result`.
+    '''
+    #only JSON bodies are accepted, which browsers won't send cross-site without asking first
+    data = request.get_json(silent=True)
+    changes = data.get('changes') if isinstance(data, dict) else None
+    if not isinstance(changes, list) or not all(isinstance(c, dict) for c in changes):
+        return jsonify({"error": 'Expected a JSON body like {"changes": [{"action": "add", "title": "..."}]}.'}), 400
+    if len(changes) > MAX_LIST_CHANGES:
+        return jsonify({"error": "At most {} changes can be made at once.".format(MAX_LIST_CHANGES)}), 413
+    results = g.user.update_list([(c.get('action'), c.get('title')) for c in changes])
+    recommendations.schedule_refresh(app)
+    return jsonify({"result": [
+        dict(action=c.get('action'), title=c.get('title'), status=status, error=error)
+        for c, (status, error) in zip(changes, results)
+    ]})
 
 @app.route('/comments', methods=['POST'])
 @login_required
@@ -226,13 +500,49 @@ def post_comment():
     contents = request.form['contents']
     if contents:
         m = Movie.get_or_create(title)
-        m.add_comment(Comment(user_id=g.user.id, contents=contents))
+        m.add_comment(Comment(user_id=current_identity().id, contents=contents))
     return redirect(url_for("show_movie", title=title))
 
+def is_image(response):
+    return response.status == 200 and response.headers.get('content-type', '').startswith('image/')
+
+@metrics.timed('download_poster')
+def download_poster(url):
+    '''Download the image at `url` into the poster cache, returning its path or None on failure.'''
+    def write(f):
+        response = httpclient.download(url, f, accept=is_image, max_bytes=POSTER_MAX_BYTES)
+        if not is_image(response):
+            return False
+        return response.headers['content-type']
+    try:
+        return poster_cache.add(url, write)
+    except (IOError, socket.error, httplib.HTTPException), e:
+        logging.warning("Failed to download poster %r: %r", url, e)
+        return None
+
 @app.route('/rehost_image')
 def rehost_image():
-    image = urllib.urlopen(request.args['url'])
-    return (image.read(), '200 OK', {'Content-type': 'image/jpeg'})
+    url = request.args['url']
+    if poster_cache is None:
+        try:
+            image = httpclient.get(url)
+        except (IOError, socket.error, httplib.HTTPException), e:
+            logging.warning("Failed to download poster %r: %r", url, e)
+            abort(502)
+        if not is_image(image):
+            abort(502)
+        return (image.body, '200 OK', {'Content-type': image.headers['content-type']})
+
+    path = poster_cache.get(url) or download_poster(url)
+    if path is None:
+        abort(502)
+    #posters cached before their content type was stored were always served as JPEGs
+    response = send_file(path, mimetype=poster_cache.content_type(path) or 'image/jpeg', add_etags=False)
+    #the file is named after the hash of the URL, so it doubles as a stable ETag
+    response.set_etag(os.path.basename(path))
+    response.cache_control.public = True
+    response.cache_control.max_age = POSTER_MAX_AGE
+    return response.make_conditional(request)
 
 @app.route('/db_create_all')
 def db_create_all():
@@ -0,0 +1,112 @@
+'''
+Seeds a sqlite database with lots of comments and list entries, then shows the
+query plans and timings of the hot comment/movielist queries before and after
+creating the indexes defined on the models (the same ones the 6c2d3e8a9b1f
+migration adds).
+
+$ ~/mp_app_env/bin/python bench/comment_indexes.py --comments 1000000
+'''
+
+from __future__ import print_function
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import sqlalchemy as sa
+
+from models import db, Comment, movielist
+
+NUM_USERS = 1000
+NUM_MOVIES = 20000
+
+QUERIES = [
+    ("movie page comments",
+     "SELECT * FROM comment WHERE movie_id = :movie_id AND is_visible = 1 AND is_deleted = 0",
+     lambda: dict(movie_id=random.randint(1, NUM_MOVIES))),
+    ("moderation queue",
+     "SELECT * FROM comment WHERE created >= :since AND is_visible = 0 AND is_deleted != 1",
+     lambda: dict(since=datetime.utcnow() - timedelta(hours=24))),
+    ("list membership",
+     "SELECT 1 FROM movielist WHERE user_id = :user_id AND movie_id = :movie_id",
+     lambda: dict(user_id=random.randint(1, NUM_USERS), movie_id=random.randint(1, NUM_MOVIES))),
+]
+
+def seed(engine, num_comments):
+    now = datetime.utcnow()
+    conn = engine.raw_connection()
+    cursor = conn.cursor()
+    batch = 50000
+    for start in range(0, num_comments, batch):
+        rows = []
+        for i in range(start, min(start + batch, num_comments)):
+            #most comments are old and moderated, a few are recent and waiting for moderation
+            age = timedelta(days=random.randint(0, 365), seconds=random.randint(0, 86400))
+            recent = random.random() < 0.002
+            rows.append((
+                random.randint(1, NUM_MOVIES),
+                random.randint(1, NUM_USERS),
+                "comment {}".format(i),
+                0 if recent else 1,
+                0 if recent else int(random.random() < 0.05),
+                (now - (timedelta(hours=1) if recent else age)).strftime("%Y-%m-%d %H:%M:%S.%f"),
+            ))
+        cursor.executemany(
+            "INSERT INTO comment (movie_id, user_id, contents, is_visible, is_deleted, created) VALUES (?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+    pairs = set((random.randint(1, NUM_USERS), random.randint(1, NUM_MOVIES)) for _ in range(NUM_USERS * 50))
+    cursor.executemany("INSERT INTO movielist (user_id, movie_id) VALUES (?, ?)", list(pairs))
+    conn.commit()
+    conn.close()
+
+def measure(engine, label, repeat):
+    print("== {} ==".format(label))
+    with engine.connect() as conn:
+        for name, sql, make_params in QUERIES:
+            plan = conn.execute(sa.text("EXPLAIN QUERY PLAN " + sql), make_params()).fetchall()
+            start = time.time()
+            for _ in range(repeat):
+                conn.execute(sa.text(sql), make_params()).fetchall()
+            elapsed = (time.time() - start) / repeat * 1000
+            print("{:<20} {:>9.3f}ms  {}".format(name, elapsed, "; ".join(row[-1] for row in plan)))
+    print("")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--comments', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    try:
+        engine = sa.create_engine('sqlite:///' + path)
+        db.metadata.create_all(engine)
+        indexes = list(Comment.__table__.indexes) + list(movielist.indexes)
+        for index in indexes:
+            index.drop(engine)
+
+        start = time.time()
+        seed(engine, args.comments)
+        print("Seeded {} comments in {:.1f}s\n".format(args.comments, time.time() - start))
+        measure(engine, "without indexes", args.repeat)
+
+        start = time.time()
+        for index in indexes:
+            index.create(engine)
+        engine.execute("ANALYZE")
+        print("Created indexes in {:.1f}s\n".format(time.time() - start))
+        measure(engine, "with indexes", args.repeat)
+    finally:
+        os.unlink(path)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+'''
+Load test comparing sync and gevent gunicorn workers on an upstream-bound
+route.
+
+Starts a slow upstream server (every response takes `--latency` seconds),
+then for each worker class starts gunicorn with `--workers` workers and sends
+`--requests` requests to /rehost_image, `--concurrency` at a time, pointed at
+the slow upstream. Sync workers top out at roughly workers / latency requests
+per second, gevent workers scale with the concurrency instead.
+
+$ ~/mp_app_env/bin/python bench/concurrency.py --latency 0.2
+sync    workers=2 concurrency=50 latency=0.2s: 200 requests in 24.51s = 8.2 req/s
+gevent  workers=2 concurrency=50 latency=0.2s: 200 requests in 1.51s = 132.7 req/s
+'''
+
+from __future__ import print_function
+
+import argparse
+import BaseHTTPServer
+import os
+import SocketServer
+import subprocess
+import sys
+import threading
+import time
+import urllib
+import urllib2
+from multiprocessing.pool import ThreadPool
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class SlowHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        body = "\xff\xd8 not really a jpeg"
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *a):
+        pass
+
+class ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+def wait_for(url, timeout=20):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urllib2.urlopen(url).read()
+            return
+        except IOError:
+            time.sleep(0.2)
+    raise RuntimeError("{} didn't come up".format(url))
+
+def run(worker_class, args, upstream):
+    port = args.port
+    #the upstream is local, so lift the per-host connection cap to the concurrency being tested
+    env = dict(os.environ, CACHE_DIR='', DBURI='sqlite://', GUNICORN_WORKER_CLASS=worker_class,
+               GUNICORN_WORKERS=str(args.workers), HTTP_MAX_CONNECTIONS_PER_HOST=str(args.concurrency))
+    server = subprocess.Popen([
+        os.path.join(os.path.dirname(sys.executable), 'gunicorn'),
+        '--config=deploy/gunicorn_config.py', '--bind=127.0.0.1:{}'.format(port), '--log-level=warning', 'app:app',
+    ], cwd=ROOT, env=env)
+    try:
+        base = 'http://127.0.0.1:{}'.format(port)
+        wait_for(base + '/api/cache')
+
+        def fetch(i):
+            url = base + '/rehost_image?' + urllib.urlencode(dict(url='{}/poster{}.jpg'.format(upstream, i)))
+            urllib2.urlopen(url).read()
+
+        pool = ThreadPool(args.concurrency)
+        start = time.time()
+        pool.map(fetch, range(args.requests))
+        elapsed = time.time() - start
+        pool.close()
+        print("{:<7} workers={} concurrency={} latency={}s: {} requests in {:.2f}s = {:.1f} req/s".format(
+            worker_class, args.workers, args.concurrency, args.latency, args.requests, elapsed, args.requests / elapsed,
+        ))
+    finally:
+        server.terminate()
+        server.wait()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--latency', type=float, default=0.2, help='seconds the upstream takes to respond')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+
+    upstream = ThreadedHTTPServer(('127.0.0.1', 0), SlowHandler)
+    upstream.latency = args.latency
+    t = threading.Thread(target=upstream.serve_forever)
+    t.daemon = True
+    t.start()
+    upstream_url = 'http://127.0.0.1:{}'.format(upstream.server_port)
+
+    for worker_class in ['sync', 'gevent']:
+        run(worker_class, args, upstream_url)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+'''
+Time importing a list of movies into a user's list, half of them titles with
+no Movie row yet, one form POST to /user per title versus a single JSON POST
+to /user/list, against a sqlite database file. Counts the SQL statements and
+commits each way takes.
+
+$ ~/mp_app_env/bin/python bench/list_changes.py --titles 200
+200 titles, half of them new movies
+one POST per title     200 requests   1.82s   1000 statements    200 commits
+/user/list               1 request    0.04s      6 statements      1 commit
+'''
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--titles', type=int, default=200)
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    os.environ.update(DBURI='sqlite:///' + os.path.join(tmpdir, 'bench.db'), CACHE_DIR='', SECRET_KEY='bench')
+    from sqlalchemy import event
+    from app import app, db
+    from models import User, Movie
+
+    counts = dict(statements=0, commits=0)
+    try:
+        with app.app_context():
+            db.create_all()
+            event.listen(db.engine, 'before_cursor_execute', lambda *a: counts.update(statements=counts['statements'] + 1))
+            event.listen(db.engine, 'commit', lambda *a: counts.update(commits=counts['commits'] + 1))
+            for i in range(0, args.titles, 2):
+                Movie.get_or_create("Existing {}".format(i))
+            users = [User.create('bench{}'.format(i), 'bench{}@bench.test'.format(i), 'benchbench') for i in range(2)]
+            user_ids = [u.id for u in users]
+
+        titles = ["{} {}".format("Existing" if i % 2 == 0 else "New", i) for i in range(args.titles)]
+        print("{} titles, half of them new movies".format(args.titles))
+
+        def run(name, user_id, post):
+            client = app.test_client()
+            with client.session_transaction() as sess:
+                sess['user'] = user_id
+            counts.update(statements=0, commits=0)
+            start = time.time()
+            requests = post(client)
+            print("{:<20} {:>5} request{:<2} {:>5.2f}s {:>6} statements {:>6} commit{}".format(
+                name, requests, 's' if requests > 1 else ' ', time.time() - start,
+                counts['statements'], counts['commits'], 's' if counts['commits'] > 1 else ''))
+
+        def one_by_one(client):
+            for title in titles:
+                client.post('/user', data=dict(action='add', title=title))
+            return len(titles)
+
+        def batch(client):
+            changes = [dict(action='add', title=t.replace("New", "Newer")) for t in titles]
+            client.post('/user/list', data=json.dumps(dict(changes=changes)), content_type='application/json')
+            return 1
+
+        run("one POST per title", user_ids[0], one_by_one)
+        run("/user/list", user_ids[1], batch)
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+'''
+Helpers shared by the load testing scripts in bench/.
+'''
+
+import os
+import sys
+import time
+from multiprocessing.pool import ThreadPool
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from httpclient import HTTPClient
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+class LoadResult(object):
+    def __init__(self, name, timings, elapsed):
+        '''`timings` is a list of `(status, seconds)` tuples, with a None status for failed requests.'''
+        self.name = name
+        self.timings = timings
+        self.elapsed = elapsed
+
+    @property
+    def errors(self):
+        return len([status for status, _ in self.timings if status is None or status >= 500])
+
+    @property
+    def rps(self):
+        return len(self.timings) / self.elapsed if self.elapsed else 0.0
+
+    def latency(self, p):
+        '''The `p`th percentile latency in milliseconds.'''
+        return percentile([seconds for _, seconds in self.timings], p) * 1000
+
+    HEADER = "{:<28} {:>8} {:>7} {:>9} {:>9} {:>9} {:>9}".format(
+        "route", "requests", "errors", "req/s", "p50 ms", "p95 ms", "p99 ms")
+
+    def __str__(self):
+        return "{:<28} {:>8} {:>7} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}".format(
+            self.name[:28], len(self.timings), self.errors, self.rps,
+            self.latency(50), self.latency(95), self.latency(99),
+        )
+
+def run_requests(name, urls, concurrency, headers=None):
+    '''GET every URL in `urls`, `concurrency` at a time, and return a `LoadResult`. Redirects are not followed.'''
+    client = HTTPClient(max_connections_per_host=concurrency, accept_gzip=False, max_redirects=0)
+
+    def fetch(url):
+        start = time.time()
+        try:
+            status = client.get(url, headers=headers).status
+        except IOError:
+            status = None
+        return status, time.time() - start
+
+    pool = ThreadPool(concurrency)
+    start = time.time()
+    try:
+        timings = pool.map(fetch, urls)
+    finally:
+        pool.close()
+    return LoadResult(name, timings, time.time() - start)
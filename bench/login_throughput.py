@@ -0,0 +1,113 @@
+'''
+Measures how a burst of logins affects the latency of other pages.
+
+Serves the app from a threaded server, then runs `--logins` threads that log
+in over and over while one thread times requests to the index page. This is
+done once with password hashing inline and once with the hashing process
+pool, each in a fresh interpreter since the setting is read at import time.
+
+$ ~/mp_app_env/bin/python bench/login_throughput.py --seconds 5
+inline hashing: 40 logins in 5.0s (8.0/s), index page p50=28.3ms p95=49.9ms max=180.6ms
+process pool:   43 logins in 5.0s (8.6/s), index page p50=13.0ms p95=25.6ms max=95.5ms
+
+(on a single core machine, the gap grows with more cores)
+'''
+
+from __future__ import print_function
+
+import argparse
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib
+import urllib2
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def run_once(seconds, logins):
+    sys.path.insert(0, ROOT)
+    from werkzeug.serving import make_server
+    from app import app, db, User
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    app.secret_key = 'bench'
+    with app.app_context():
+        db.create_all()
+        if not User.query.filter_by(username='bench').first():
+            User.create('bench', 'bench@bench.test', 'benchbench')
+
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    base = 'http://127.0.0.1:{}'.format(server.server_port)
+
+    stop = time.time() + seconds
+    counts = []
+    latencies = []
+    login_form = urllib.urlencode(dict(username_or_email='bench', password='benchbench', submit='login'))
+
+    def log_in():
+        n = 0
+        while time.time() < stop:
+            urllib2.urlopen(base + '/login', login_form).read()
+            n += 1
+        counts.append(n)
+
+    def probe():
+        while time.time() < stop:
+            start = time.time()
+            urllib2.urlopen(base + '/').read()
+            latencies.append((time.time() - start) * 1000)
+            time.sleep(0.05)
+
+    threads = [threading.Thread(target=log_in) for _ in range(logins)] + [threading.Thread(target=probe)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    server.shutdown()
+
+    print("{} logins in {:.1f}s ({:.1f}/s), index page p50={:.1f}ms p95={:.1f}ms max={:.1f}ms".format(
+        sum(counts), seconds, sum(counts) / float(seconds),
+        percentile(latencies, 50), percentile(latencies, 95), max(latencies),
+    ))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--seconds', type=int, default=10)
+    parser.add_argument('--logins', type=int, default=4, help='number of concurrent login threads')
+    parser.add_argument('--processes', type=int, default=2, help='hashing processes for the pooled run')
+    parser.add_argument('--once', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.once:
+        return run_once(args.seconds, args.logins)
+
+    db_fd, db_path = tempfile.mkstemp(suffix='.db')
+    os.close(db_fd)
+    try:
+        for label, processes in [('inline hashing: ', 0), ('process pool:   ', args.processes)]:
+            env = dict(os.environ, DBURI='sqlite:///' + db_path, CACHE_DIR='', PASSWORD_HASH_PROCESSES=str(processes))
+            sys.stdout.write(label)
+            sys.stdout.flush()
+            subprocess.check_call([
+                sys.executable, os.path.abspath(__file__), '--once',
+                '--seconds', str(args.seconds), '--logins', str(args.logins),
+            ], env=env)
+    finally:
+        os.unlink(db_path)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+'''
+Seeds a sqlite database with users whose lists follow a Zipf-like popularity
+curve, then times rebuilding every movie's similar movies, incremental
+refreshes after list changes (from obscure to the most listed movies), and
+the reads behind the "people also listed" panel and the /user suggestions.
+Checks that the refreshed table matches a full rebuild.
+
+$ ~/mp_app_env/bin/python bench/recommendations.py --users 5000 --movies 20000 --list-size 30
+130403 list entries
+rebuild                        15526 movies   11.32s
+refresh add    [19990, 19991]     22 movies    0.128s
+refresh add    [15000]            21 movies    0.131s
+refresh add    [50]              246 movies    0.846s
+refresh remove [1, 2]            354 movies    4.736s
+refresh remove [3]               396 movies    3.839s
+refreshed table matches a rebuild: True
+also_listed     0.59ms
+suggestions     2.96ms
+'''
+
+from __future__ import print_function
+
+import argparse
+import bisect
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--movies', type=int, default=20000)
+    parser.add_argument('--list-size', type=int, default=30)
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    os.environ.update(DBURI='sqlite:///' + os.path.join(tmpdir, 'bench.db'), CACHE_DIR='')
+    from app import app, db
+    from models import Movie, movielist, movielist_change
+    import recommendations
+
+    random.seed(1)
+    #the movie with popularity rank r is picked with probability proportional to 1/r
+    cumulative = []
+    total = 0.0
+    for rank in range(1, args.movies + 1):
+        total += 1.0 / rank
+        cumulative.append(total)
+
+    try:
+        with app.app_context():
+            db.create_all()
+            db.session.execute(Movie.__table__.insert(), [dict(title="Movie {}".format(i)) for i in range(args.movies)])
+            entries = set()
+            for user_id in range(1, args.users + 1):
+                for _ in range(args.list_size):
+                    entries.add((user_id, bisect.bisect(cumulative, random.random() * total) + 1))
+            db.session.execute(movielist.insert(), [dict(user_id=u, movie_id=m) for u, m in entries])
+            db.session.commit()
+            print("{} list entries".format(len(entries)))
+
+            start = time.time()
+            count = recommendations.rebuild()
+            print("{:<30} {:>5} movies {:>7.2f}s".format("rebuild", count, time.time() - start))
+
+            changes = [
+                (2, 'add', [args.movies - 10, args.movies - 9]),
+                (3, 'add', [args.movies * 3 / 4]),
+                (4, 'add', [50]),
+                (5, 'remove', [1, 2]),
+                (6, 'remove', [3]),
+            ]
+            for user_id, action, movie_ids in changes:
+                if action == 'add':
+                    movie_ids = [m for m in movie_ids if (user_id, m) not in entries]
+                    db.session.execute(movielist.insert(), [dict(user_id=user_id, movie_id=m) for m in movie_ids])
+                else:
+                    movie_ids = [m for m in movie_ids if (user_id, m) in entries]
+                    db.session.execute(movielist.delete().where(db.and_(
+                        movielist.c.user_id == user_id, movielist.c.movie_id.in_(movie_ids))))
+                if not movie_ids:
+                    continue
+                db.session.execute(movielist_change.insert(), [dict(movie_id=m) for m in movie_ids])
+                db.session.commit()
+                start = time.time()
+                count = recommendations.refresh()
+                print("{:<30} {:>5} movies {:>8.3f}s".format("refresh {:<6} {}".format(action, movie_ids), count, time.time() - start))
+
+            stored = {}
+            for movie_id, other_id in db.session.execute(
+                db.select([recommendations.movie_similarity.c.movie_id, recommendations.movie_similarity.c.similar_movie_id])
+                .order_by(recommendations.movie_similarity.c.movie_id, recommendations.movie_similarity.c.rank)
+            ):
+                stored.setdefault(movie_id, []).append(other_id)
+            rebuilt = recommendations.compute()
+            print("refreshed table matches a rebuild: {}".format(
+                all(stored.get(m, []) == [o for _, o in top] for m, top in rebuilt.items())))
+
+            for name, read, ids, calls in [
+                ("also_listed", recommendations.also_listed, args.movies, 1000),
+                ("suggestions", recommendations.suggestions, args.users, 200),
+            ]:
+                start = time.time()
+                for _ in range(calls):
+                    read(random.randint(1, ids))
+                print("{} {:>8.2f}ms".format(name, (time.time() - start) * 1000 / calls))
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+'''
+Repeatable end-to-end benchmark of the main routes.
+
+Starts the stub upstream (bench/stub_upstream.py) with the given latency,
+jitter and error rate, seeds a fresh sqlite database (categories, a user with
+a list of movies, some comments), starts gunicorn against both, then drives
+each route and reports p50/p95/p99 latency and requests per second.
+
+$ ~/mp_app_env/bin/python bench/routes.py --requests 200 --concurrency 20 --latency 0.05
+stub upstream: latency=0.05s jitter=0.02s error_rate=0.0; workers=4 concurrency=20 cache=on
+route                        requests  errors     req/s    p50 ms    p95 ms    p99 ms
+/                                 200       0     203.0       5.9     355.7     440.1
+/categories/<category>            200       0      28.2     185.1    4939.9    6710.2
+/movie/<title>                    200      15      93.0     128.1     484.7     703.9
+/user                             200       0      73.3      59.8    1040.5    1276.4
+/random                           200       0     433.5      10.9     145.2     248.5
+/api/movie                        200       0      57.3     184.3     728.0    1215.3
+/api/comment                      200       0     122.2      34.9     574.3     962.9
+/api/category                     200       0     213.4      30.2     288.5     408.9
+
+The /movie errors are titles the stub answers "Movie not found!" for.
+'''
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib
+
+from loadgen import ROOT, LoadResult, run_requests
+from stub_upstream import StubServer
+
+CATEGORIES = ['Pixar_animated_films', 'American_epic_films', 'American_satirical_films']
+
+def seed(list_size, num_comments):
+    '''
+    Create the tables and sample rows, returns the benchmark user's session
+    cookie and the movie titles. Run with `--seed` in a fresh interpreter,
+    since the app reads its settings from the environment at import time.
+    '''
+    from app import app, db
+    from models import User, Category, Movie, Comment
+    from movies import crawl_wikipedia_titles
+
+    with app.app_context():
+        db.create_all()
+        for name in CATEGORIES:
+            Category.create(name)
+        user = User.create('bench', 'bench@bench.test', 'benchbench')
+        titles = []
+        for name in CATEGORIES:
+            titles.extend(crawl_wikipedia_titles(name))
+        for title in titles[:list_size]:
+            user.add_to_list(title)
+        for i in range(num_comments):
+            c = Comment(user_id=user.id, contents="Benchmark comment {}".format(i), is_visible=True)
+            Movie.get_or_create(titles[i % len(titles)]).add_comment(c)
+        cookie = app.session_interface.get_signing_serializer(app).dumps({'user': user.id})
+    return 'session=' + cookie, titles
+
+def wait_for(url, timeout=30):
+    from httpclient import HTTPClient
+    client = HTTPClient(connect_timeout=1, read_timeout=5)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            client.get(url)
+            return
+        except IOError:
+            time.sleep(0.2)
+    raise RuntimeError("{} didn't come up".format(url))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--requests', type=int, default=200, help='requests per route')
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.05, help='stub upstream latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.02, help='stub upstream latency jitter in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of stub upstream requests that fail')
+    parser.add_argument('--worker-class', default=None, help='gunicorn worker class (defaults to deploy/gunicorn_config.py)')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--port', type=int, default=8766)
+    parser.add_argument('--list-size', type=int, default=30, help="movies on the benchmark user's list")
+    parser.add_argument('--comments', type=int, default=200)
+    parser.add_argument('--no-cache', action='store_true', help='run with the shared caches disabled')
+    parser.add_argument('--seed', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.seed:
+        cookie, titles = seed(args.list_size, args.comments)
+        print(json.dumps([cookie, titles]))
+        return
+
+    stub = StubServer(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate).start()
+    tmpdir = tempfile.mkdtemp()
+    env = dict(
+        os.environ,
+        DBURI='sqlite:///' + os.path.join(tmpdir, 'bench.db'),
+        CACHE_DIR='' if args.no_cache else os.path.join(tmpdir, 'cache'),
+        SECRET_KEY='bench',
+        GUNICORN_WORKERS=str(args.workers),
+        **stub.app_environ()
+    )
+    if args.worker_class:
+        env['GUNICORN_WORKER_CLASS'] = args.worker_class
+
+    stub.error_rate, error_rate = 0.0, stub.error_rate
+    output = subprocess.check_output([
+        sys.executable, os.path.abspath(__file__), '--seed',
+        '--list-size', str(args.list_size), '--comments', str(args.comments),
+    ], env=env)
+    cookie, titles = json.loads(output.strip().splitlines()[-1])
+    stub.error_rate = error_rate
+
+    server = subprocess.Popen([
+        os.path.join(os.path.dirname(sys.executable), 'gunicorn'),
+        '--config=deploy/gunicorn_config.py', '--bind=127.0.0.1:{}'.format(args.port), '--log-level=warning', 'app:app',
+    ], cwd=ROOT, env=env)
+    try:
+        base = 'http://127.0.0.1:{}'.format(args.port)
+        wait_for(base + '/api/cache')
+        n = args.requests
+        routes = [
+            ('/', [base + '/'] * n, None),
+            ('/categories/<category>', [base + '/categories/' + CATEGORIES[i % len(CATEGORIES)] for i in range(n)], None),
+            ('/movie/<title>', [base + '/movie/' + urllib.quote(titles[i % len(titles)].encode('utf8')) for i in range(n)], None),
+            ('/user', [base + '/user'] * n, {'Cookie': cookie}),
+            ('/random', [base + '/random'] * n, None),
+            ('/api/movie', [base + '/api/movie'] * n, None),
+            ('/api/comment', [base + '/api/comment'] * n, None),
+            ('/api/category', [base + '/api/category'] * n, None),
+        ]
+        print("stub upstream: latency={}s jitter={}s error_rate={}; workers={} concurrency={} cache={}".format(
+            args.latency, args.jitter, args.error_rate, args.workers, args.concurrency, 'off' if args.no_cache else 'on'))
+        print(LoadResult.HEADER)
+        for name, urls, headers in routes:
+            print(run_requests(name, urls, args.concurrency, headers))
+    finally:
+        server.terminate()
+        server.wait()
+        stub.shutdown()
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main()
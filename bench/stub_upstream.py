@@ -0,0 +1,203 @@
+'''
+Stand-in for the Wikipedia categorymembers API, the OMDb API and poster
+image hosts, for load testing without touching the real services.
+
+Recorded responses are replayed from bench/fixtures/ (wikipedia.json maps a
+category to its list of API response pages, omdb.json maps a title to its
+payload). Categories and titles that weren't recorded get generated,
+deterministic data, with about 1 in 10 titles answering "Movie not found!".
+Every response can be delayed and a fraction can be turned into errors.
+
+Serve it, then point the app at it:
+
+$ ~/mp_app_env/bin/python bench/stub_upstream.py serve --port 9000 --latency 0.1 --jitter 0.05 --error-rate 0.01
+$ WIKIPEDIA_API_URL=http://127.0.0.1:9000/w/api.php OMDBAPI_URL=http://127.0.0.1:9000/omdb/ ~/mp_app_env/bin/python app.py
+
+Record real responses for some categories (and the OMDb data of their titles):
+
+$ ~/mp_app_env/bin/python bench/stub_upstream.py record Pixar_animated_films --titles 20
+'''
+
+from __future__ import print_function
+
+import argparse
+import BaseHTTPServer
+import hashlib
+import json
+import os
+import random
+import SocketServer
+import sys
+import threading
+import time
+import urlparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+PAGE_SIZE = 250
+SYNTHETIC_CATEGORY_SIZE = 600
+#smallest valid JPEG-ish payload, the app never decodes posters
+POSTER_BODY = "\xff\xd8\xff\xe0" + "\x00" * 1020 + "\xff\xd9"
+
+def load_fixtures(fixtures_dir):
+    fixtures = {}
+    for name in ['wikipedia', 'omdb']:
+        path = os.path.join(fixtures_dir, name + '.json')
+        fixtures[name] = json.load(open(path)) if os.path.exists(path) else {}
+    return fixtures
+
+def _digest(text):
+    return int(hashlib.sha1(text.encode('utf8')).hexdigest(), 16)
+
+def synthetic_category_pages(category):
+    '''Categorymembers API pages for a made up category.'''
+    name = category.replace('_', ' ')
+    members = [{"ns": 14, "title": u"Category:{} by decade".format(name)}]
+    for i in range(SYNTHETIC_CATEGORY_SIZE):
+        suffix = [u"", u" (film)", u" ({} film)".format(1950 + i % 60)][i % 3]
+        members.append({"ns": 0, "title": u"{} {}{}".format(name, i, suffix)})
+    pages = []
+    for start in range(0, len(members), PAGE_SIZE):
+        page = {"batchcomplete": "", "query": {"categorymembers": members[start:start + PAGE_SIZE]}}
+        if start + PAGE_SIZE < len(members):
+            page["continue"] = {"cmcontinue": "page|{}".format(start + PAGE_SIZE), "continue": "-||"}
+        pages.append(page)
+    return pages
+
+def synthetic_omdb(title, poster_base):
+    '''OMDb payload for a made up title.'''
+    n = _digest(title)
+    if n % 10 == 0:
+        return {"Response": "False", "Error": "Movie not found!"}
+    imdb_id = "tt{:07d}".format(n % 10000000)
+    return {
+        "Title": title,
+        "Year": str(1950 + n % 70),
+        "Plot": u"A synthetic plot about {}.".format(title),
+        "Genre": ["Action", "Comedy", "Drama", "Science Fiction"][n % 4],
+        "imdbID": imdb_id,
+        "imdbRating": "{:.1f}".format(1 + (n % 90) / 10.0),
+        "Poster": "{}/posters/{}.jpg".format(poster_base, imdb_id),
+        "Response": "True",
+    }
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        delay = server.latency + random.uniform(-server.jitter, server.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        if random.random() < server.error_rate:
+            return self.respond(503, "text/plain", "stub upstream error")
+
+        url = urlparse.urlsplit(self.path)
+        args = dict((k, v[0].decode('utf8')) for k, v in urlparse.parse_qs(url.query, keep_blank_values=True).items())
+        if url.path == '/w/api.php':
+            category = args.get('cmtitle', '').replace('Category:', '', 1)
+            pages = server.fixtures['wikipedia'].get(category) or synthetic_category_pages(category)
+            cmcontinue = args.get('cmcontinue', '')
+            page = pages[0]
+            for previous, following in zip(pages, pages[1:]):
+                if previous.get('continue', {}).get('cmcontinue') == cmcontinue:
+                    page = following
+            return self.respond(200, "application/json", json.dumps(page))
+        if url.path == '/omdb/':
+            title = args.get('t', '')
+            data = server.fixtures['omdb'].get(title)
+            if data is None:
+                data = synthetic_omdb(title, "http://{}".format(self.headers.get('Host')))
+            return self.respond(200, "application/json", json.dumps(data))
+        if url.path.startswith('/posters/'):
+            return self.respond(200, "image/jpeg", POSTER_BODY)
+        return self.respond(404, "text/plain", "not found")
+
+    def respond(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *a):
+        pass
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.0, jitter=0.0, error_rate=0.0, fixtures_dir=FIXTURES_DIR):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), StubHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.fixtures = load_fixtures(fixtures_dir)
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_port)
+
+    def app_environ(self):
+        '''Environment variables that point the app at this server.'''
+        return dict(
+            WIKIPEDIA_API_URL=self.base_url + '/w/api.php',
+            OMDBAPI_URL=self.base_url + '/omdb/',
+        )
+
+    def start(self):
+        '''Serve requests from a background thread.'''
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+        return self
+
+def record(categories, num_titles, fixtures_dir):
+    '''Fetch real responses for `categories` (and `num_titles` of each one's titles) into the fixture files.'''
+    sys.path.insert(0, ROOT)
+    import httpclient
+    from movies import WIKIPEDIA_CATEGORY_URL, OMDBAPI_TITLE_URL, filter_titles
+
+    fixtures = load_fixtures(fixtures_dir)
+    for category in categories:
+        pages, cmcontinue = [], ""
+        while True:
+            page = httpclient.get(WIKIPEDIA_CATEGORY_URL.format(category, cmcontinue)).json()
+            pages.append(page)
+            if 'continue' not in page:
+                break
+            cmcontinue = page['continue']['cmcontinue']
+        fixtures['wikipedia'][category] = pages
+        titles = filter_titles(m for p in pages for m in p['query']['categorymembers'])
+        for title in titles[:num_titles]:
+            fixtures['omdb'][title] = httpclient.get(OMDBAPI_TITLE_URL.format(title.encode('utf8'))).json()
+        print("Recorded {} pages and {} titles for {}".format(len(pages), min(num_titles, len(titles)), category))
+
+    if not os.path.isdir(fixtures_dir):
+        os.makedirs(fixtures_dir)
+    for name in ['wikipedia', 'omdb']:
+        with open(os.path.join(fixtures_dir, name + '.json'), 'w') as f:
+            json.dump(fixtures[name], f, indent=1, sort_keys=True)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--fixtures', default=FIXTURES_DIR)
+    commands = parser.add_subparsers(dest='command')
+    serve = commands.add_parser('serve')
+    serve.add_argument('--port', type=int, default=9000)
+    serve.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    serve.add_argument('--jitter', type=float, default=0.0, help='random +/- seconds added to the latency')
+    serve.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with a 503')
+    rec = commands.add_parser('record')
+    rec.add_argument('categories', nargs='+')
+    rec.add_argument('--titles', type=int, default=20, help='OMDb payloads to record per category')
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        return record(args.categories, args.titles, args.fixtures)
+    server = StubServer(args.port, args.latency, args.jitter, args.error_rate, args.fixtures)
+    print("Serving on {}, point the app at it with:".format(server.base_url))
+    print(" ".join("{}={}".format(k, v) for k, v in sorted(server.app_environ().items())))
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+'''
+Memory used by N worker processes holding the title index, as Python lists
+loaded from JSON (one copy per worker) versus the mmap'd packed file (one
+copy in the OS page cache, shared by every worker). Each worker reads every
+title once, like rendering every category page would, and reports how much
+its private memory grew (from /proc/self/smaps_rollup). The mapped file
+counts as private while a single process maps it, and as shared once several
+do.
+
+$ ~/mp_app_env/bin/python bench/title_store.py --categories 150 --titles 1000 --workers 8
+150000 titles: json 5.9MB, packed 5.9MB on disk
+json    workers=1 private=  30.1MB (30.1MB/worker)
+packed  workers=1 private=   6.0MB (6.0MB/worker)
+json    workers=8 private= 240.7MB (30.1MB/worker)
+packed  workers=8 private=   2.9MB (0.4MB/worker)
+'''
+
+from __future__ import print_function
+
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from titleindex import TitleIndex
+
+def memory():
+    '''Returns the private memory of this process in MB.'''
+    fields = {}
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                fields[parts[0].rstrip(':')] = int(parts[1])
+    return (fields['Private_Clean'] + fields['Private_Dirty']) / 1024.0
+
+def worker(kind, path, results, done):
+    baseline = memory()
+    if kind == 'json':
+        with open(path) as f:
+            data = json.load(f)
+        index = TitleIndex(data['categories'], data['titles'], data['offsets'], data['built'])
+    else:
+        index = TitleIndex.load(path)
+    for name in index.categories:
+        for title in index.titles_for(name):
+            pass
+    results.put(memory() - baseline)
+    done.wait()
+
+def run(kind, path, workers):
+    results, done = multiprocessing.Queue(), multiprocessing.Event()
+    procs = [multiprocessing.Process(target=worker, args=(kind, path, results, done)) for _ in range(workers)]
+    for p in procs:
+        p.start()
+    measured = [results.get() for _ in procs]
+    done.set()
+    for p in procs:
+        p.join()
+    print("{:<7} workers={} private={:>6.1f}MB ({:.1f}MB/worker)".format(
+        kind, workers, sum(measured), sum(measured) / workers))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--categories', type=int, default=150)
+    parser.add_argument('--titles', type=int, default=1000, help='titles per category')
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+
+    names = ["Category_{}".format(c) for c in range(args.categories)]
+    index = TitleIndex.build(names, fetch=lambda name: [
+        u"{} movie number {} (film)".format(name, i) for i in range(args.titles)
+    ])
+    tmpdir = tempfile.mkdtemp()
+    try:
+        json_path = os.path.join(tmpdir, "title_index.json")
+        with open(json_path, 'w') as f:
+            json.dump(dict(built=index.built, categories=index.categories, titles=index.titles,
+                           offsets=index.offsets.tolist()), f)
+        packed_path = os.path.join(tmpdir, "title_index.bin")
+        index.save(packed_path)
+        del index
+        print("{} titles: json {:.1f}MB, packed {:.1f}MB on disk".format(
+            args.categories * args.titles, os.path.getsize(json_path) / 1e6, os.path.getsize(packed_path) / 1e6))
+        for workers in [1, args.workers]:
+            run('json', json_path, workers)
+            run('packed', packed_path, workers)
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main()
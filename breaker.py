@@ -0,0 +1,119 @@
+'''
+Circuit breakers for the upstream services (Wikipedia, OMDb).
+
+Each worker process tracks the outcome of its recent calls to an upstream.
+Once enough of them fail the breaker opens and calls are refused right away,
+instead of every request waiting on the same timeouts, so the app can fall
+back to stale data or a degraded page. After a while one probe call is let
+through (half-open): if it succeeds the breaker closes again, otherwise it
+stays open for another round.
+'''
+
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+#the breaker opens when at least BREAKER_ERROR_RATE of the calls in the last BREAKER_WINDOW seconds failed, once there
+#were at least BREAKER_MIN_CALLS of them, and stays open for BREAKER_OPEN_SECONDS before letting a probe call through
+BREAKER_ERROR_RATE = float(os.environ.get('BREAKER_ERROR_RATE', 0.5))
+BREAKER_MIN_CALLS = int(os.environ.get('BREAKER_MIN_CALLS', 10))
+BREAKER_WINDOW = float(os.environ.get('BREAKER_WINDOW', 30))
+BREAKER_OPEN_SECONDS = float(os.environ.get('BREAKER_OPEN_SECONDS', 15))
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+class UpstreamUnavailable(IOError):
+    '''Raised when a call to an upstream service fails or times out.'''
+    #seconds clients are asked to wait before trying again
+    retry_after = 5
+
+    def __init__(self, upstream, message):
+        IOError.__init__(self, message)
+        self.upstream = upstream
+
+class CircuitOpen(UpstreamUnavailable):
+    '''Raised instead of calling an upstream service whose breaker is open.'''
+    def __init__(self, upstream, retry_after):
+        UpstreamUnavailable.__init__(self, upstream, "{} is unavailable, not calling it for {:.0f}s".format(upstream, retry_after))
+        self.retry_after = max(1, int(retry_after + 0.5))
+
+class CircuitBreaker(object):
+    def __init__(self, name, error_rate=BREAKER_ERROR_RATE, min_calls=BREAKER_MIN_CALLS,
+                 window=BREAKER_WINDOW, open_seconds=BREAKER_OPEN_SECONDS):
+        self.name = name
+        self.error_rate = error_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.open_seconds = open_seconds
+        self.state = CLOSED
+        self.opened_at = None
+        self.calls = self.failures = self.rejected = self.trips = 0
+        #(time, succeeded) of the calls made in the last `window` seconds while closed
+        self._outcomes = deque()
+        self._lock = threading.Lock()
+
+    def _allow(self):
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.time() - self.opened_at >= self.open_seconds:
+                #let this call through as the probe, everyone else keeps being refused until it's done
+                self.state = HALF_OPEN
+                return True
+            self.rejected += 1
+            raise CircuitOpen(self.name, self.opened_at + self.open_seconds - time.time())
+
+    def _record(self, succeeded):
+        now = time.time()
+        with self._lock:
+            self.calls += 1
+            if not succeeded:
+                self.failures += 1
+            if self.state == HALF_OPEN:
+                if succeeded:
+                    self.state = CLOSED
+                    self._outcomes.clear()
+                else:
+                    self._trip(now)
+                return
+            if self.state == OPEN:
+                #a call that started before the breaker opened
+                return
+            self._outcomes.append((now, succeeded))
+            while self._outcomes[0][0] < now - self.window:
+                self._outcomes.popleft()
+            failed = len([ok for _, ok in self._outcomes if not ok])
+            if len(self._outcomes) >= self.min_calls and failed >= self.error_rate * len(self._outcomes):
+                self._trip(now)
+
+    def _trip(self, now):
+        self.state = OPEN
+        self.opened_at = now
+        self.trips += 1
+        self._outcomes.clear()
+
+    def call(self, func, *args):
+        '''
+        Returns `func(*args)`. Any exception it raises counts as a failure and
+        is re-raised as `UpstreamUnavailable`; raises `CircuitOpen` without
+        calling it if the breaker is open.
+        '''
+        self._allow()
+        #anything else that interrupts the call (e.g. a gevent.Timeout) counts as a failure too, or a half-open
+        #breaker would wait on its probe forever
+        succeeded = False
+        try:
+            result = func(*args)
+            succeeded = True
+        except Exception, e:
+            raise UpstreamUnavailable(self.name, "{} request failed: {!r}".format(self.name, e)), None, sys.exc_info()[2]
+        finally:
+            self._record(succeeded)
+        return result
+
+    def stats(self):
+        return dict(state=self.state, calls=self.calls, failures=self.failures, rejected=self.rejected, trips=self.trips)
@@ -0,0 +1,323 @@
+'''
+Caches shared by every worker process, used to avoid repeating slow calls to
+Wikipedia and omdbapi.com.
+'''
+
+import hashlib
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import namedtuple, OrderedDict
+
+#directory holding the cache files, set the CACHE_DIR environment variable to "" to disable caching
+CACHE_DIR = os.environ.get('CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache'))
+#seconds expired entries are kept around to be served as fallbacks before they're purged, and the chance that a `set`
+#purges them
+CACHE_PURGE_GRACE = float(os.environ.get('CACHE_PURGE_GRACE', 7 * 24 * 3600))
+CACHE_PURGE_PROBABILITY = 0.001
+
+class CacheEntry(namedtuple('CacheEntry', 'value stored expires')):
+    '''A cached `value` along with the timestamps of when it was stored and when it goes stale.'''
+    @property
+    def is_fresh(self):
+        return time.time() < self.expires
+
+    @property
+    def age(self):
+        return time.time() - self.stored
+
+class SQLiteCache(object):
+    '''
+    Key/value cache stored in a sqlite database file. Values are stored as JSON.
+
+    Expired entries are not deleted right away, they are returned with
+    `is_fresh` set to False so callers can decide whether to serve them while
+    fetching a new copy. Entries expired for longer than `grace` seconds are
+    purged now and then.
+    '''
+    def __init__(self, path, ttl, grace=CACHE_PURGE_GRACE):
+        self.path = path
+        self.ttl = ttl
+        self.grace = grace
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, stored REAL, expires REAL)")
+                conn.execute("CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires)")
+
+    def _connect(self):
+        #must be called with the lock held, connections can't be shared by forked processes. One connection per
+        #process rather than per thread: under gevent every request is its own thread.
+        if self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._pid = os.getpid()
+        return self._conn
+
+    def get(self, key):
+        '''Returns the `CacheEntry` for `key`, or None if it has never been cached.'''
+        with self._lock:
+            row = self._connect().execute("SELECT value, stored, expires FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        value, stored, expires = row
+        return CacheEntry(json.loads(value), stored, expires)
+
+    def set(self, key, value, ttl=None):
+        '''Store `value` under `key`, going stale after `ttl` seconds (defaults to the cache's TTL).'''
+        now = time.time()
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO cache (key, value, stored, expires) VALUES (?, ?, ?, ?)",
+                    (key, json.dumps(value), now, now + ttl),
+                )
+        if random.random() < CACHE_PURGE_PROBABILITY:
+            self.purge()
+
+    def delete(self, key):
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def purge(self, older_than=None):
+        '''
+        Delete the entries that went stale more than `older_than` seconds ago
+        (defaults to the cache's grace period). Returns how many were deleted.
+        '''
+        older_than = self.grace if older_than is None else older_than
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                return conn.execute("DELETE FROM cache WHERE expires < ?", (time.time() - older_than,)).rowcount
+
+class LRUCache(object):
+    '''
+    In-process cache holding at most `maxsize` entries, evicting the least
+    recently used entry when full. Keeps hit/miss/eviction counters.
+    '''
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = self.misses = self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        '''Returns the `CacheEntry` for `key` or None. Stale entries are returned too, but count as misses.'''
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry.is_fresh:
+                self.hits += 1
+            else:
+                self.misses += 1
+            self._entries[key] = entry
+            return entry
+
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        ttl = self.ttl if ttl is None else ttl
+        self.set_entry(key, CacheEntry(value, now, now + ttl))
+
+    def set_entry(self, key, entry):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self):
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            size=len(self._entries),
+            maxsize=self.maxsize,
+        )
+
+class TieredCache(object):
+    '''
+    An in-process `LRUCache` in front of a cache shared by all workers. Entries
+    found in the shared tier are copied into the in-process tier.
+    '''
+    def __init__(self, local, shared):
+        self.local = local
+        self.shared = shared
+        self.shared_hits = self.shared_misses = 0
+
+    def get(self, key):
+        entry = self.local.get(key)
+        if entry is not None and entry.is_fresh:
+            return entry
+        shared_entry = self.shared.get(key)
+        if shared_entry is None:
+            self.shared_misses += 1
+            return entry
+        self.shared_hits += 1
+        self.local.set_entry(key, shared_entry)
+        return shared_entry
+
+    def set(self, key, value, ttl=None):
+        self.local.set(key, value, ttl)
+        self.shared.set(key, value, ttl)
+
+    def delete(self, key):
+        self.local.delete(key)
+        self.shared.delete(key)
+
+    def stats(self):
+        return dict(
+            local=self.local.stats(),
+            shared=dict(hits=self.shared_hits, misses=self.shared_misses),
+        )
+
+class NullCache(object):
+    '''Stand-in used when caching is disabled. Never stores anything.'''
+    def get(self, key):
+        return None
+
+    def set(self, key, value, ttl=None):
+        pass
+
+    def delete(self, key):
+        pass
+
+class DiskCache(object):
+    '''
+    Content-addressed file cache: each key is stored in a file named after the
+    SHA-1 of the key. Files are written to a temporary name and renamed into
+    place, so readers never see partial files. When the directory grows past
+    `max_bytes`, the least recently used files are deleted.
+
+    A file can have a content type, kept next to it in a `.type` file.
+    '''
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        makedirs(directory)
+
+    def path_for(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf8')
+        return os.path.join(self.directory, hashlib.sha1(key).hexdigest())
+
+    def get(self, key):
+        '''Returns the path to the cached file for `key`, or None.'''
+        path = self.path_for(key)
+        try:
+            #the modification time doubles as the last access time for LRU eviction
+            os.utime(path, None)
+        except OSError:
+            return None
+        return path
+
+    def content_type(self, path):
+        '''The content type stored along with the cached file at `path`, or None.'''
+        try:
+            with open(path + '.type') as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def add(self, key, write):
+        '''
+        Call `write(f)` with a temporary file and store it under `key`. If
+        `write` returns False the file is thrown away and None is returned,
+        otherwise the path to the cached file is returned. If `write` returns
+        a string, it's stored as the file's content type.
+        '''
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                keep = write(f)
+            if keep is False:
+                os.unlink(tmp_path)
+                return None
+            path = self.path_for(key)
+            if isinstance(keep, basestring):
+                #in place before the file is, so readers always find it
+                self._write_content_type(path, keep)
+            os.rename(tmp_path, path)
+        except:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        self.evict()
+        return path
+
+    def _write_content_type(self, path, content_type):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content_type)
+        os.rename(tmp_path, path + '.type')
+
+    def evict(self):
+        '''Delete the least recently used files until the cache fits in `max_bytes`.'''
+        files = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if name.startswith('.tmp') or name.endswith('.type'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, name))
+            total += st.st_size
+        files.sort()
+        while files and total > self.max_bytes:
+            _, size, name = files.pop(0)
+            for path in [os.path.join(self.directory, name), os.path.join(self.directory, name + '.type')]:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            total -= size
+
+def makedirs(path):
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            #another worker created it first
+            if not os.path.isdir(path):
+                raise
+
+def open_cache(name, ttl):
+    '''
+    Returns a `SQLiteCache` stored as `name` inside `CACHE_DIR`, or a
+    `NullCache` if caching is disabled.
+    '''
+    if not CACHE_DIR:
+        return NullCache()
+    makedirs(CACHE_DIR)
+    return SQLiteCache(os.path.join(CACHE_DIR, name), ttl)
+
+def open_disk_cache(name, max_bytes):
+    '''
+    Returns a `DiskCache` in the `name` directory inside `CACHE_DIR`, or None
+    if caching is disabled.
+    '''
+    if not CACHE_DIR:
+        return None
+    return DiskCache(os.path.join(CACHE_DIR, name), max_bytes)
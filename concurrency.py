@@ -0,0 +1,169 @@
+'''
+Helpers for running work concurrently that do the right thing both under
+gunicorn's sync workers (real threads) and its gevent workers, where the
+standard library has been monkey patched and threads are greenlets.
+'''
+
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
+try:
+    from gevent import monkey
+except ImportError:
+    monkey = None
+
+def is_cooperative():
+    '''True if gevent has patched the standard library, e.g. inside a gevent gunicorn worker.'''
+    return monkey is not None and monkey.is_module_patched('socket')
+
+def map_concurrently(func, items, size):
+    '''
+    Returns `[func(item) for item in items]`, running up to `size` calls at
+    once on greenlets (under gevent) or threads.
+    '''
+    items = list(items)
+    if is_cooperative():
+        from gevent.pool import Pool
+        return Pool(size).map(func, items)
+    pool = ThreadPool(size)
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+
+def run_in_native_thread(func, *args):
+    '''
+    Run CPU bound `func(*args)` on one of gevent's real OS threads so the
+    other greenlets keep running. Without gevent it just calls `func`.
+    '''
+    if is_cooperative():
+        import gevent
+        return gevent.get_hub().threadpool.apply(func, args)
+    return func(*args)
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+def _flock(fd, deadline):
+    #polled rather than blocked on, so gevent workers keep serving other requests while waiting
+    while True:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except IOError, e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES) or time.time() > deadline:
+                return False
+            time.sleep(0.02)
+
+def _is_file_at(fd, path):
+    try:
+        return os.fstat(fd).st_ino == os.stat(path).st_ino
+    except OSError:
+        return False
+
+@contextmanager
+def file_lock(path, timeout, remove=False):
+    '''
+    Hold an exclusive flock on `path` while inside the block, waiting up to
+    `timeout` seconds for it. Yields False (without the lock) on timeout. The
+    lock is polled rather than blocked on, so gevent workers keep serving
+    other requests while waiting.
+
+    With `remove` the file is deleted when the lock is released, for locks
+    taken on many different paths.
+    '''
+    deadline = time.time() + timeout
+    while True:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        locked = _flock(fd, deadline)
+        if not (locked and remove) or _is_file_at(fd, path):
+            break
+        #the previous holder deleted the file after we opened it, lock the one at `path` now
+        os.close(fd)
+    try:
+        yield locked
+    finally:
+        try:
+            if locked:
+                if remove:
+                    os.unlink(path)
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+class SingleFlight(object):
+    '''
+    Coalesces concurrent calls for the same key: the first caller runs the
+    function and everyone else who asks for that key in the meantime waits
+    for its result instead of making the same call.
+
+    With `lock_dir` set, the first caller also takes a file lock for the key
+    so only one worker process runs the function at a time. Workers that had
+    to wait for the lock call `recheck()` first, which returns the result the
+    other worker stored (e.g. in a shared cache) or None to run the function
+    anyway. Each key has its own lock file, deleted once the call is done.
+    '''
+    def __init__(self, name, lock_dir=None, lock_timeout=30):
+        self.name = name
+        self.lock_dir = lock_dir
+        self.lock_timeout = lock_timeout
+        self.calls = self.deduplicated = self.shared = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def _lock_path(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf8')
+        return os.path.join(self.lock_dir, "{}-{}.lock".format(self.name, hashlib.sha1(key).hexdigest()))
+
+    def _run(self, key, func, recheck):
+        if not self.lock_dir:
+            return func()
+        with file_lock(self._lock_path(key), self.lock_timeout, remove=True) as locked:
+            if not locked:
+                logging.warning("Timed out waiting for the %s lock for %r, fetching anyway", self.name, key)
+            if recheck is not None:
+                result = recheck()
+                if result is not None:
+                    self.shared += 1
+                    return result
+            return func()
+
+    def do(self, key, func, recheck=None):
+        '''Returns `func()`, or the result of a call for `key` already in progress.'''
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.calls += 1
+            else:
+                self.deduplicated += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = self._run(key, func, recheck)
+            return call.result
+        except Exception, e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self):
+        return dict(calls=self.calls, deduplicated=self.deduplicated, shared=self.shared)
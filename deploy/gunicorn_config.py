@@ -0,0 +1,30 @@
+'''
+gunicorn settings shared by the Procfile and the systemd service.
+
+The app spends most of its time waiting on Wikipedia, omdbapi.com and poster
+hosts, so by default it runs gevent workers: each worker handles up to
+`worker_connections` requests at once, switching between them while they wait
+on the network. Set GUNICORN_WORKER_CLASS=sync to go back to one request per
+worker.
+
+Known limit: only socket I/O is cooperative. The sqlite calls (the app
+database when DBURI points at sqlite, the caches in CACHE_DIR and the search
+index) are blocking C calls gevent can't patch, and they aren't moved off the
+hub. They're quick, but while one waits on another process's write lock (up
+to its 30s timeout) every request in that worker stalls. Run sync workers if
+that shows up in the latencies.
+'''
+
+import os
+import sys
+
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gevent')
+workers = int(os.environ.get('GUNICORN_WORKERS', 4))
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 200))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+
+def on_starting(server):
+    #/metrics adds up the files of every worker, start from zero instead of the last run's totals
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import metrics
+    metrics.registry.clear()
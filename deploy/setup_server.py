@@ -53,7 +53,7 @@ User=${user}
 WorkingDirectory=${repo_path}
 Type=simple
 Environment=SECRET_KEY_PATH=${secret_key_path}
-ExecStart=${gunicorn_path} --error-logfile=- --access-logfile=- --log-syslog --bind=unix:/tmp/gunicorn.sock --workers=4 app:app
+ExecStart=${gunicorn_path} --error-logfile=- --access-logfile=- --log-syslog --bind=unix:/tmp/gunicorn.sock --config=${repo_path}/deploy/gunicorn_config.py app:app
 KillMode=mixed
 
 [Install]
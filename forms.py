@@ -3,6 +3,7 @@ from wtforms import StringField, PasswordField
 from wtforms.validators import DataRequired, EqualTo, Email, Regexp, Length, ValidationError
 
 from models import User
+from passwords import HashingOverloaded
 
 class RegistrationForm(Form):
     username = StringField('Username', validators=[Regexp("\A[a-zA-Z0-9]+\Z")])
@@ -32,5 +33,7 @@ class LoginForm(Form):
     def validate_username_or_email(self, field):
         try:
             self.validated_user = User.validate(field.data, self.password.data)
+        except HashingOverloaded, e:
+            raise ValidationError(e.message)
         except RuntimeError:
             raise ValidationError("Invalid username/email or password.")
@@ -0,0 +1,325 @@
+'''
+Outbound HTTP client used for every call to Wikipedia, omdbapi.com, and
+poster image hosts.
+
+Connections are kept alive and reused per host, the number of connections
+to a single host is capped, and every request has connect/read timeouts so a
+slow upstream can't hold a worker forever. Redirects are followed, like
+urllib.urlopen did.
+'''
+
+import httplib
+import json
+import os
+import socket
+import threading
+import time
+import urllib
+import urlparse
+import zlib
+
+import metrics
+
+CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 3))
+#seconds a whole request may take, waiting for a free connection, redirects and reading the body included
+READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', 10))
+MAX_CONNECTIONS_PER_HOST = int(os.environ.get('HTTP_MAX_CONNECTIONS_PER_HOST', 8))
+#seconds a request waits for one of a host's MAX_CONNECTIONS_PER_HOST connections to be free
+POOL_TIMEOUT = float(os.environ.get('HTTP_POOL_TIMEOUT', 10))
+USER_AGENT = "moviepicker (https://github.com/lost-theory/moviepicker)"
+
+#outbound requests are recorded in the metrics by upstream: `register_upstream` names the known ones, every other host
+#(e.g. the user supplied poster URLs) is recorded as OTHER_UPSTREAM so they can't add label values without bound
+upstream_labels = {}
+OTHER_UPSTREAM = 'other'
+
+#redirects followed before giving up with HTTPError
+MAX_REDIRECTS = 5
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+#same characters urllib.urlopen leaves unquoted
+SAFE_URL_CHARS = "%/:=&?~#+!$,;'@()*[]|"
+
+class HTTPError(IOError):
+    '''Raised when a request fails at the HTTP level (bad status line, truncated response, ...).'''
+
+class ResponseTooLarge(HTTPError):
+    '''Raised when a downloaded body grows past the size the caller allowed.'''
+
+class PoolTimeout(socket.timeout):
+    '''Raised when every connection to a host stays in use for longer than the pool timeout.'''
+
+class DeadlineSocket(object):
+    '''
+    Wraps a connection's socket so every read is only given the time left
+    until `deadline`: a plain socket timeout applies to each read separately,
+    so a response trickling in could take any amount of time.
+    '''
+    def __init__(self, sock):
+        self.sock = sock
+        self.deadline = None
+
+    def recv(self, size):
+        remaining = self.deadline - time.time()
+        if remaining <= 0:
+            raise socket.timeout("Ran out of time reading the response")
+        self.sock.settimeout(remaining)
+        return self.sock.recv(size)
+
+    def makefile(self, mode='r', bufsize=-1):
+        #httplib reads the response through this, it has to call our recv
+        return socket._fileobject(self, mode, bufsize)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+class Response(object):
+    '''An HTTP response, with the body fully read into `body`.'''
+    def __init__(self, url, status, headers, body):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body)
+
+    def __repr__(self):
+        return '<Response status={!r} url={!r}>'.format(self.status, self.url)
+
+class HostPool(object):
+    '''
+    Idle keep-alive connections to a single host, plus a count of the free
+    slots limiting the number of connections that can be in use at once.
+    '''
+    def __init__(self, scheme, host, port, maxsize):
+        self.connection_class = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+        self.host = host
+        self.port = port
+        self._idle = []
+        self._lock = threading.Lock()
+        #threading.Semaphore.acquire can't time out in python 2
+        self._free_slots = maxsize
+        self._slot_freed = threading.Condition(self._lock)
+
+    def _take_slot(self, timeout):
+        deadline = time.time() + timeout
+        with self._lock:
+            while not self._free_slots:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise PoolTimeout("No connection to {} free after {:.1f}s".format(self.host, timeout))
+                self._slot_freed.wait(remaining)
+            self._free_slots -= 1
+
+    def _release_slot(self):
+        with self._lock:
+            self._free_slots += 1
+            self._slot_freed.notify()
+
+    def acquire(self, connect_timeout, read_timeout, pool_timeout=POOL_TIMEOUT):
+        '''
+        Returns `(connection, reused)`, opening a new connection if there are no
+        idle ones. Raises `PoolTimeout` if no slot is freed within `pool_timeout`.
+        '''
+        self._take_slot(pool_timeout)
+        with self._lock:
+            if self._idle:
+                conn = self._idle.pop()
+                conn.sock.settimeout(read_timeout)
+                return conn, True
+        try:
+            conn = self.connection_class(self.host, self.port, timeout=connect_timeout)
+            conn.connect()
+            conn.sock.settimeout(read_timeout)
+        except Exception:
+            self._release_slot()
+            raise
+        return conn, False
+
+    def release(self, conn, reusable):
+        if reusable:
+            with self._lock:
+                self._idle.append(conn)
+        else:
+            conn.close()
+        self._release_slot()
+
+class HTTPClient(object):
+    def __init__(self, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, pool_timeout=POOL_TIMEOUT,
+                 max_connections_per_host=MAX_CONNECTIONS_PER_HOST, accept_gzip=True, max_redirects=MAX_REDIRECTS):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.pool_timeout = pool_timeout
+        self.max_connections_per_host = max_connections_per_host
+        self.accept_gzip = accept_gzip
+        self.max_redirects = max_redirects
+        self._pools = {}
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def _pool_for(self, scheme, host, port):
+        with self._lock:
+            #connections opened before a fork (e.g. in the gunicorn master) can't be shared with the child
+            if self._pid != os.getpid():
+                self._pools = {}
+                self._pid = os.getpid()
+            key = (scheme, host, port)
+            if key not in self._pools:
+                self._pools[key] = HostPool(scheme, host, port, self.max_connections_per_host)
+            return self._pools[key]
+
+    def _open(self, url, headers, connect_timeout, read_timeout, pool_timeout):
+        '''
+        Send a GET request, following up to `max_redirects` redirects. Returns
+        `(url, pool, connection, response)`: the URL finally fetched and its
+        response with the body still unread, which raises `socket.timeout` if
+        it isn't read within `read_timeout` of the start of the request. The
+        connection must be given back to the pool once the body has been read.
+        '''
+        connect_timeout = self.connect_timeout if connect_timeout is None else connect_timeout
+        read_timeout = self.read_timeout if read_timeout is None else read_timeout
+        pool_timeout = self.pool_timeout if pool_timeout is None else pool_timeout
+        deadline = time.time() + read_timeout
+        for _ in range(self.max_redirects + 1):
+            pool, conn, resp = self._send(url, headers, connect_timeout, deadline, pool_timeout)
+            location = resp.getheader('location')
+            #with redirects turned off the redirect itself is the response
+            if resp.status not in REDIRECT_STATUSES or not location or not self.max_redirects:
+                return url, pool, conn, resp
+            #the body of a redirect isn't worth reading
+            pool.release(conn, False)
+            url = urllib.quote(urlparse.urljoin(url, location), safe=SAFE_URL_CHARS)
+        raise HTTPError("Too many redirects, last one to {!r}".format(url))
+
+    def _send(self, url, headers, connect_timeout, deadline, pool_timeout):
+        parts = urlparse.urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise HTTPError("Can't request {!r}".format(url))
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        request_headers = {'User-Agent': USER_AGENT}
+        request_headers.update(headers or {})
+
+        pool = self._pool_for(parts.scheme, parts.hostname, parts.port)
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise socket.timeout("Ran out of time requesting {!r}".format(url))
+            conn, reused = pool.acquire(connect_timeout, remaining, min(pool_timeout, remaining))
+            try:
+                if not isinstance(conn.sock, DeadlineSocket):
+                    conn.sock = DeadlineSocket(conn.sock)
+                conn.sock.deadline = deadline
+                conn.request('GET', path, headers=request_headers)
+                return pool, conn, conn.getresponse()
+            except Exception, e:
+                pool.release(conn, False)
+                if not isinstance(e, (httplib.HTTPException, socket.error)):
+                    raise
+                if reused and not isinstance(e, socket.timeout):
+                    #the server probably closed the idle connection, retry on a new one
+                    continue
+                if isinstance(e, httplib.HTTPException):
+                    raise HTTPError("Request to {!r} failed: {!r}".format(url, e))
+                raise
+
+    def _read(self, url, pool, conn, resp, f=None, max_bytes=None, chunk_size=64 * 1024):
+        '''
+        Read the body of `resp`, into the file `f` if given, then release the
+        connection. The connection is released whatever goes wrong, but only
+        reused if the body was read in full.
+        '''
+        reusable = False
+        try:
+            chunks = []
+            size = 0
+            chunk = resp.read(chunk_size)
+            while chunk:
+                size += len(chunk)
+                if max_bytes is not None and size > max_bytes:
+                    raise ResponseTooLarge("Response from {!r} is over {} bytes".format(url, max_bytes))
+                if f is None:
+                    chunks.append(chunk)
+                else:
+                    f.write(chunk)
+                chunk = resp.read(chunk_size)
+            body = None if f is not None else ''.join(chunks)
+            reusable = not resp.will_close
+        except httplib.HTTPException, e:
+            raise HTTPError("Request to {!r} failed: {!r}".format(url, e))
+        finally:
+            pool.release(conn, reusable)
+        return body
+
+    def _timed(self, request, url, *args):
+        '''Run `request(url, *args)`, recording how long it took in the upstream request histogram.'''
+        start = time.time()
+        status = 'error'
+        try:
+            response = request(url, *args)
+            status = response.status
+            return response
+        finally:
+            metrics.observe('upstream_request_duration_seconds', time.time() - start,
+                            upstream=upstream_labels.get(urlparse.urlsplit(url).hostname, OTHER_UPSTREAM), status=status)
+
+    def _get(self, url, headers, connect_timeout, read_timeout, pool_timeout):
+        headers = dict(headers or {})
+        if self.accept_gzip:
+            headers.setdefault('Accept-Encoding', 'gzip')
+        url, pool, conn, resp = self._open(url, headers, connect_timeout, read_timeout, pool_timeout)
+        body = self._read(url, pool, conn, resp)
+        response_headers = dict((k.lower(), v) for k, v in resp.getheaders())
+        if response_headers.get('content-encoding') == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        return Response(url, resp.status, response_headers, body)
+
+    def _download(self, url, f, headers, connect_timeout, read_timeout, pool_timeout, accept, max_bytes):
+        url, pool, conn, resp = self._open(url, headers, connect_timeout, read_timeout, pool_timeout)
+        response_headers = dict((k.lower(), v) for k, v in resp.getheaders())
+        response = Response(url, resp.status, response_headers, None)
+        if accept is not None and not accept(response):
+            #not worth reading the rest of, the connection can't be reused either
+            pool.release(conn, False)
+        else:
+            self._read(url, pool, conn, resp, f, max_bytes)
+        return response
+
+    def get(self, url, headers=None, connect_timeout=None, read_timeout=None, pool_timeout=None):
+        '''
+        Perform a GET request and return the `Response`. Raises `IOError` (or
+        `socket.timeout`) if the request could not be completed. The whole
+        request, redirects and reading the body included, must be done within
+        `read_timeout` seconds.
+        '''
+        url = urllib.quote(url, safe=SAFE_URL_CHARS)
+        return self._timed(self._get, url, headers, connect_timeout, read_timeout, pool_timeout)
+
+    def download(self, url, f, headers=None, connect_timeout=None, read_timeout=None, pool_timeout=None,
+                 accept=None, max_bytes=None):
+        '''
+        Perform a GET request, writing the response body to the file `f` in
+        chunks instead of holding it in memory. Returns the `Response`, with
+        `body` set to None.
+
+        If `accept(response)` returns False, nothing is written. Raises
+        `ResponseTooLarge` once more than `max_bytes` would be written.
+        '''
+        url = urllib.quote(url, safe=SAFE_URL_CHARS)
+        return self._timed(self._download, url, f, headers, connect_timeout, read_timeout, pool_timeout, accept, max_bytes)
+
+def register_upstream(url, label):
+    '''Record requests to the host of `url` as `label` in the upstream request metrics.'''
+    upstream_labels[urlparse.urlsplit(url).hostname] = label
+
+client = HTTPClient()
+
+def get(url, **kw):
+    '''GET `url` using the shared `HTTPClient`.'''
+    return client.get(url, **kw)
+
+def download(url, f, **kw):
+    '''GET `url` into the file `f` using the shared `HTTPClient`.'''
+    return client.download(url, f, **kw)
@@ -0,0 +1,110 @@
+'''
+Bulk load OMDb data for every title in every saved category into the Movie
+table, so movie pages can be rendered without calling OMDb.
+
+$ python ingest.py ingest --workers 8
+
+Progress is committed after every batch. Titles already ingested are skipped,
+so an interrupted run picks up where it left off when run again; the
+checkpoint file also remembers which categories were already crawled. Pass
+--refresh to look up titles that were ingested before this run started too.
+'''
+
+from __future__ import print_function
+
+import json
+import os
+import time
+from datetime import datetime
+
+from flask_script import Manager
+
+from app import app, db, invalidate_movie_page
+from cache import CACHE_DIR, makedirs
+from models import Category, Movie
+from movies import OMDB_NOT_FOUND, fetch_omdb_info_many, fetch_wikipedia_titles, refresh_wikipedia_titles
+
+manager = Manager(app)
+
+DEFAULT_CHECKPOINT = os.path.join(CACHE_DIR or '.', 'ingest_checkpoint.json')
+
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return dict(started=time.time(), categories=[])
+    with open(path) as f:
+        return json.load(f)
+
+def save_checkpoint(path, checkpoint):
+    makedirs(os.path.dirname(os.path.abspath(path)))
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoint, f)
+    os.rename(tmp_path, path)
+
+def crawl_categories(checkpoint, checkpoint_path, recrawl):
+    '''Make sure every title of every saved category has a Movie row.'''
+    existing = set(title for title, in db.session.query(Movie.title))
+    for category in Category.query.order_by(Category.id):
+        if category.name in checkpoint['categories']:
+            continue
+        titles = (refresh_wikipedia_titles if recrawl else fetch_wikipedia_titles)(category.name)
+        new = [t for t in set(titles) if t not in existing]
+        if new:
+            db.session.execute(Movie.__table__.insert(), [dict(title=t) for t in new])
+        db.session.commit()
+        existing.update(new)
+        checkpoint['categories'].append(category.name)
+        save_checkpoint(checkpoint_path, checkpoint)
+        print("{}: {} titles, {} new".format(category.name, len(titles), len(new)))
+
+def ingest_batch(movies, workers):
+    '''Look up `movies` on OMDb and store the results, returns the number that failed.'''
+    failed = 0
+    for movie, result in zip(movies, fetch_omdb_info_many([m.title for m in movies], max_workers=workers)):
+        if result.error is None:
+            movie.set_omdb_data(result.data)
+        elif result.not_found:
+            movie.set_omdb_data({'Response': 'False', 'Error': OMDB_NOT_FOUND})
+        else:
+            #network errors etc. are retried on the next run
+            failed += 1
+            continue
+        invalidate_movie_page(movie.title)
+    db.session.commit()
+    return failed
+
+@manager.option('--workers', type=int, default=8, help='concurrent OMDb requests')
+@manager.option('--batch-size', type=int, default=100, help='titles looked up per commit')
+@manager.option('--checkpoint', default=DEFAULT_CHECKPOINT, help='file recording the progress of this run')
+@manager.option('--recrawl', action='store_true', help='crawl Wikipedia instead of using the cached category titles')
+@manager.option('--refresh', action='store_true', help='also look up titles ingested before this run started')
+def ingest(workers, batch_size, checkpoint, recrawl, refresh):
+    '''Crawl every category and store the OMDb data of every title in the Movie table.'''
+    checkpoint_path = checkpoint
+    checkpoint = load_checkpoint(checkpoint_path)
+    save_checkpoint(checkpoint_path, checkpoint)
+    crawl_categories(checkpoint, checkpoint_path, recrawl)
+
+    pending = Movie.ingested == None
+    if refresh:
+        pending = db.or_(pending, Movie.ingested < datetime.utcfromtimestamp(checkpoint['started']))
+    total = Movie.query.filter(pending).count()
+    done = failed = 0
+    last_id = 0
+    while True:
+        #walk by id so titles that failed this run aren't fetched again until the next run
+        movies = Movie.query.filter(pending, Movie.id > last_id).order_by(Movie.id).limit(batch_size).all()
+        if not movies:
+            break
+        last_id = movies[-1].id
+        failed += ingest_batch(movies, workers)
+        done += len(movies)
+        print("{}/{} titles looked up, {} failed".format(done, total, failed))
+
+    if failed:
+        print("{} titles failed, run again to retry them".format(failed))
+    else:
+        os.remove(checkpoint_path)
+
+if __name__ == '__main__':
+    manager.run()
@@ -0,0 +1,242 @@
+'''
+Latency histograms for requests, SQL statements, and calls to upstream
+services, exposed on /metrics in the Prometheus text format.
+
+Every worker process keeps its own histograms and a background thread writes
+them to a file in the cache directory (one file per process) every few
+seconds. /metrics adds up the files of every worker, including workers that
+have since exited, so the totals only ever go up no matter which worker
+answers the scrape.
+'''
+
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import Response, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from cache import CACHE_DIR, makedirs
+
+#directory holding each worker's metrics file, None when caching (and so sharing between workers) is disabled
+METRICS_DIR = os.path.join(CACHE_DIR, 'metrics') if CACHE_DIR else None
+#seconds between background writes of a worker's metrics file, /metrics always writes the current worker's first
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 5))
+
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+HISTOGRAMS = {
+    'http_request_duration_seconds': ("Time spent handling a request, by endpoint.", DURATION_BUCKETS),
+    'http_request_sql_statements': ("SQL statements executed per request, by endpoint.", COUNT_BUCKETS),
+    'http_request_sql_duration_seconds': ("Time spent running SQL per request, by endpoint.", DURATION_BUCKETS),
+    'sql_statement_duration_seconds': ("Time spent running a single SQL statement.", DURATION_BUCKETS),
+    'upstream_request_duration_seconds': ("Time spent on an outbound HTTP request, by upstream.", DURATION_BUCKETS),
+    'function_duration_seconds': ("Time spent in instrumented functions that call upstream services.", DURATION_BUCKETS),
+}
+
+def format_labels(labels):
+    '''`{'a': 'x', 'b': 'y'}` -> `a="x",b="y"`, escaped as the text format requires.'''
+    def escape(value):
+        return unicode(value).replace(u'\\', u'\\\\').replace(u'"', u'\\"').replace(u'\n', u'\\n')
+    return u",".join(u'{}="{}"'.format(k, escape(v)) for k, v in sorted(labels.items()))
+
+class Registry(object):
+    '''
+    The histograms of this process. Each series is stored as a list of
+    per-bucket counts (the last one for values above every bucket) followed by
+    the sum of the observed values.
+    '''
+    def __init__(self, directory=None):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self.series = {}
+        self.dirty = False
+        self._flusher = None
+        #the start time keeps a new process from reusing the file of an old one with the same pid
+        self.path = None
+        if self.directory:
+            self.path = os.path.join(self.directory, '{}-{}.json'.format(self.pid, int(time.time() * 1000)))
+
+    def observe(self, name, value, **labels):
+        buckets = HISTOGRAMS[name][1]
+        key = format_labels(labels)
+        with self._lock:
+            if self.pid != os.getpid():
+                #forked, the parent's numbers are already in the parent's file
+                self._reset()
+            counts = self.series.setdefault(name, {}).setdefault(key, [0] * (len(buckets) + 2))
+            i = 0
+            while i < len(buckets) and value > buckets[i]:
+                i += 1
+            counts[i] += 1
+            counts[-1] += value
+            self.dirty = True
+            if self.directory and self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_periodically)
+                self._flusher.daemon = True
+                self._flusher.start()
+
+    def snapshot(self):
+        with self._lock:
+            if self.pid != os.getpid():
+                self._reset()
+            return dict((name, dict((k, list(v)) for k, v in series.items())) for name, series in self.series.items())
+
+    def _flush_periodically(self):
+        pid = os.getpid()
+        while pid == self.pid:
+            time.sleep(METRICS_FLUSH_INTERVAL)
+            if self.dirty:
+                try:
+                    self.flush()
+                except (IOError, OSError):
+                    logging.exception("Failed to write metrics to %r", self.path)
+
+    def flush(self):
+        '''Write this process's histograms to its file.'''
+        if not self.directory:
+            return
+        self.dirty = False
+        data = self.snapshot()
+        makedirs(self.directory)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp_path, self.path)
+
+    def collect(self):
+        '''Returns the histograms of every process that wrote a file, or just this process's without a directory.'''
+        if not self.directory:
+            return self.snapshot()
+        self.flush()
+        total = {}
+        for filename in os.listdir(self.directory):
+            if not filename.endswith('.json') or filename.startswith('.'):
+                continue
+            try:
+                with open(os.path.join(self.directory, filename)) as f:
+                    data = json.load(f)
+            except (IOError, ValueError):
+                continue
+            for name, series in data.items():
+                if name not in HISTOGRAMS:
+                    continue
+                for key, counts in series.items():
+                    merged = total.setdefault(name, {}).setdefault(key, [0] * len(counts))
+                    if len(merged) == len(counts):
+                        total[name][key] = [a + b for a, b in zip(merged, counts)]
+        return total
+
+    def clear(self):
+        '''Delete every worker's metrics file, e.g. when the server starts.'''
+        with self._lock:
+            self._reset()
+        if self.directory and os.path.isdir(self.directory):
+            for filename in os.listdir(self.directory):
+                os.remove(os.path.join(self.directory, filename))
+
+def render(data):
+    '''Format collected histograms in the Prometheus text exposition format.'''
+    lines = []
+    for name in sorted(data):
+        description, buckets = HISTOGRAMS[name]
+        lines.append(u"# HELP {} {}".format(name, description))
+        lines.append(u"# TYPE {} histogram".format(name))
+        for key in sorted(data[name]):
+            counts = data[name][key]
+            prefix = key + u"," if key else u""
+            cumulative = 0
+            for le, count in zip([repr(float(b)) for b in buckets] + ["+Inf"], counts[:-1]):
+                cumulative += count
+                lines.append(u'{}_bucket{{{}le="{}"}} {}'.format(name, prefix, le, cumulative))
+            labels = u"{" + key + u"}" if key else u""
+            lines.append(u"{}_sum{} {!r}".format(name, labels, float(counts[-1])))
+            lines.append(u"{}_count{} {}".format(name, labels, cumulative))
+    return u"\n".join(lines) + u"\n"
+
+registry = Registry(METRICS_DIR)
+
+def observe(name, value, **labels):
+    '''Record `value` in the histogram `name` (one of HISTOGRAMS).'''
+    registry.observe(name, value, **labels)
+
+@contextmanager
+def timer(name, **labels):
+    '''Context manager recording the time spent inside it in the histogram `name`.'''
+    start = time.time()
+    try:
+        yield
+    finally:
+        observe(name, time.time() - start, **labels)
+
+def timed(function_name):
+    '''Decorator recording the time spent in the decorated function under `function_duration_seconds`.'''
+    def decorator(f):
+        @wraps(f)
+        def inner(*a, **kw):
+            with timer('function_duration_seconds', function=function_name):
+                return f(*a, **kw)
+        return inner
+    return decorator
+
+## SQL ########################################################################
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('metrics_start', []).append(time.time())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.time() - conn.info['metrics_start'].pop()
+    observe('sql_statement_duration_seconds', elapsed)
+    if has_request_context() and '_metrics_sql' in g:
+        g._metrics_sql[0] += 1
+        g._metrics_sql[1] += elapsed
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(context):
+    #the statement failed, after_cursor_execute won't run for it
+    if context.connection is not None and context.connection.info.get('metrics_start'):
+        context.connection.info['metrics_start'].pop()
+
+## flask ######################################################################
+
+def _before_request():
+    g._metrics_start = time.time()
+    g._metrics_sql = [0, 0.0]
+
+def _after_request(response):
+    g._metrics_status = response.status_code
+    return response
+
+def _teardown_request(exc):
+    if '_metrics_start' not in g:
+        return
+    endpoint = request.endpoint or 'none'
+    status = 500 if exc is not None else g.get('_metrics_status', 500)
+    observe('http_request_duration_seconds', time.time() - g._metrics_start,
+            endpoint=endpoint, method=request.method, status=status)
+    statements, sql_seconds = g._metrics_sql
+    observe('http_request_sql_statements', statements, endpoint=endpoint)
+    observe('http_request_sql_duration_seconds', sql_seconds, endpoint=endpoint)
+
+def show_metrics():
+    return Response(render(registry.collect()), mimetype='text/plain; version=0.0.4')
+
+def init_app(app):
+    '''Time every request to `app` and serve the collected metrics on /metrics.'''
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    app.add_url_rule('/metrics', 'metrics', show_metrics)
@@ -0,0 +1,34 @@
+"""Add composite indexes on comment and a unique index on movielist.
+
+Covers the movie page and moderation comment queries, and makes movielist
+rows unique per (user_id, movie_id).
+
+Revision ID: 6c2d3e8a9b1f
+Revises: fb0496e0c29d
+Create Date: 2026-10-17 21:02:11.418230
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6c2d3e8a9b1f'
+down_revision = 'fb0496e0c29d'
+
+from alembic import op
+
+
+def upgrade():
+    op.create_index('ix_comment_movie_id_is_visible_is_deleted', 'comment', ['movie_id', 'is_visible', 'is_deleted'], unique=False)
+    op.create_index('ix_comment_is_visible_created_is_deleted', 'comment', ['is_visible', 'created', 'is_deleted'], unique=False)
+
+    # drop duplicate list entries before adding the unique index
+    op.execute("CREATE TABLE movielist_dedup AS SELECT DISTINCT user_id, movie_id FROM movielist")
+    op.execute("DELETE FROM movielist")
+    op.execute("INSERT INTO movielist (user_id, movie_id) SELECT user_id, movie_id FROM movielist_dedup")
+    op.execute("DROP TABLE movielist_dedup")
+    op.create_index('uq_movielist_user_id_movie_id', 'movielist', ['user_id', 'movie_id'], unique=True)
+
+
+def downgrade():
+    op.drop_index('uq_movielist_user_id_movie_id', table_name='movielist')
+    op.drop_index('ix_comment_is_visible_created_is_deleted', table_name='comment')
+    op.drop_index('ix_comment_movie_id_is_visible_is_deleted', table_name='comment')
@@ -0,0 +1,38 @@
+"""Add OMDb data columns to movie.
+
+Filled in by ingest.py so movie pages don't need to call OMDb.
+
+Revision ID: 9f4b7c1d2e3a
+Revises: 6c2d3e8a9b1f
+Create Date: 2026-10-18 10:12:40.118502
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9f4b7c1d2e3a'
+down_revision = '6c2d3e8a9b1f'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('movie', sa.Column('year', sa.String(length=16), nullable=True))
+    op.add_column('movie', sa.Column('genre', sa.String(length=256), nullable=True))
+    op.add_column('movie', sa.Column('plot', sa.Text(), nullable=True))
+    op.add_column('movie', sa.Column('rating', sa.Float(), nullable=True))
+    op.add_column('movie', sa.Column('imdb_id', sa.String(length=16), nullable=True))
+    op.add_column('movie', sa.Column('poster', sa.String(length=512), nullable=True))
+    op.add_column('movie', sa.Column('omdb_error', sa.String(length=256), nullable=True))
+    op.add_column('movie', sa.Column('ingested', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('movie', 'ingested')
+    op.drop_column('movie', 'omdb_error')
+    op.drop_column('movie', 'poster')
+    op.drop_column('movie', 'imdb_id')
+    op.drop_column('movie', 'rating')
+    op.drop_column('movie', 'plot')
+    op.drop_column('movie', 'genre')
+    op.drop_column('movie', 'year')
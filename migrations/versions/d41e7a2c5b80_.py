@@ -0,0 +1,45 @@
+"""Add the movielist_change and movie_similarity tables, index movielist by movie.
+
+Used by recommendations.py for the "people also listed" panel and list
+suggestions.
+
+Revision ID: d41e7a2c5b80
+Revises: 9f4b7c1d2e3a
+Create Date: 2026-10-18 16:40:27.530114
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'd41e7a2c5b80'
+down_revision = '9f4b7c1d2e3a'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('movielist_change',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('movie_id', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('movie_similarity',
+        sa.Column('movie_id', sa.Integer(), nullable=False),
+        sa.Column('rank', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('similar_movie_id', sa.Integer(), nullable=False),
+        sa.Column('score', sa.Float(), nullable=False),
+        sa.ForeignKeyConstraint(['movie_id'], ['movie.id'], ),
+        sa.ForeignKeyConstraint(['similar_movie_id'], ['movie.id'], ),
+        sa.PrimaryKeyConstraint('movie_id', 'rank')
+    )
+    op.create_index('ix_movie_similarity_similar_movie_id', 'movie_similarity', ['similar_movie_id'], unique=False)
+    op.create_index('ix_movielist_movie_id_user_id', 'movielist', ['movie_id', 'user_id'], unique=False)
+    # every movie already on a list needs its similar movies computed
+    op.execute("INSERT INTO movielist_change (movie_id) SELECT DISTINCT movie_id FROM movielist")
+
+
+def downgrade():
+    op.drop_index('ix_movielist_movie_id_user_id', table_name='movielist')
+    op.drop_index('ix_movie_similarity_similar_movie_id', table_name='movie_similarity')
+    op.drop_table('movie_similarity')
+    op.drop_table('movielist_change')
@@ -1,10 +1,12 @@
 import os
+from collections import defaultdict
 from datetime import datetime
 
-from passlib.hash import pbkdf2_sha512
 from flask_sqlalchemy import SQLAlchemy
 import sqlalchemy.exc
 
+from passwords import hash_password, verify_password, needs_rehash
+
 db = SQLAlchemy()
 
 DEFAULT_CATEGORIES = [
@@ -18,10 +20,35 @@ DEFAULT_CATEGORIES = [
     'American_science_fiction_films',
 ]
 MIN_PASSWORD_LENGTH = 8
+#values per IN (...) clause, sqlite allows at most 999 parameters in a statement
+IN_CLAUSE_SIZE = 500
+
+def chunked(items, size):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
 
 movielist = db.Table('movielist',
     db.Column('user_id', db.Integer, db.ForeignKey('user.id')),
     db.Column('movie_id', db.Integer, db.ForeignKey('movie.id')),
+    db.Index('uq_movielist_user_id_movie_id', 'user_id', 'movie_id', unique=True),
+    #who listed a movie, for recommendations.py
+    db.Index('ix_movielist_movie_id_user_id', 'movie_id', 'user_id'),
+)
+
+#movies added to or removed from a list since recommendations.py last refreshed their similar movies
+movielist_change = db.Table('movielist_change',
+    db.Column('id', db.Integer, primary_key=True),
+    db.Column('movie_id', db.Integer, nullable=False),
+)
+
+#the movies most often listed by the same users as `movie_id`, best first, maintained by recommendations.py
+movie_similarity = db.Table('movie_similarity',
+    db.Column('movie_id', db.Integer, db.ForeignKey('movie.id'), primary_key=True),
+    db.Column('rank', db.Integer, primary_key=True, autoincrement=False),
+    db.Column('similar_movie_id', db.Integer, db.ForeignKey('movie.id'), nullable=False),
+    db.Column('score', db.Float, nullable=False),
+    db.Index('ix_movie_similarity_similar_movie_id', 'similar_movie_id'),
 )
 
 class User(db.Model):
@@ -38,7 +65,7 @@ class User(db.Model):
 
     @classmethod
     def create(cls, username=None, email=None, password=None, **others):
-        password_hash = pbkdf2_sha512.encrypt(password)
+        password_hash = hash_password(password)
         u = cls(username=username, email=email, password_hash=password_hash)
         db.session.add(u)
         db.session.commit()
@@ -51,21 +78,111 @@ class User(db.Model):
         ).one_or_none()
         if not u:
             raise RuntimeError("Invalid username/email or password.")
-        if not pbkdf2_sha512.verify(password, u.password_hash):
+        if not verify_password(password, u.password_hash):
             raise RuntimeError("Invalid username/email or password.")
+        if needs_rehash(u.password_hash):
+            #the configured cost changed since this hash was made
+            u.password_hash = hash_password(password)
+            db.session.add(u)
+            db.session.commit()
         return u
 
     def add_to_list(self, title):
-        m = Movie.get_or_create(title)
-        self.movies.append(m)
-        db.session.add(self)
-        db.session.commit()
-        return m
+        '''
+        Add the movie `title` to this user's list, creating the Movie row if it
+        doesn't exist yet. Adding a movie that's already on the list does
+        nothing.
+        '''
+        status, error = self.update_list([('add', title)])[0]
+        if status == 'error':
+            raise RuntimeError(error)
+
+    def update_list(self, changes):
+        '''
+        Apply a batch of `(action, title)` changes to this user's list in a
+        single transaction, `action` being "add" or "remove". Changes apply in
+        order, so adding and then removing a title leaves it off the list.
+        Titles are resolved to Movie ids with one query per IN_CLAUSE_SIZE
+        titles, and the missing Movie rows of added titles are inserted in
+        bulk.
+
+        Returns a `(status, error)` tuple for each change, the status being
+        "added", "removed", "unchanged" or "error" (for invalid changes, which
+        don't stop the others).
+        '''
+        results = [self._check_list_change(action, title) for action, title in changes]
+        valid = [change for change, (status, _) in zip(changes, results) if status is None]
+        for attempt in range(2):
+            try:
+                statuses = iter(self._apply_list_changes(valid))
+                db.session.commit()
+                break
+            except sqlalchemy.exc.IntegrityError:
+                #a concurrent request inserted the same movie or list entry first, the retry will see it
+                db.session.rollback()
+                if attempt:
+                    raise
+        db.session.expire(self, ['movies'])
+        return [(next(statuses), None) if status is None else (status, error) for status, error in results]
+
+    @staticmethod
+    def _check_list_change(action, title):
+        if action not in ('add', 'remove'):
+            return ('error', "Unknown action {!r}.".format(action))
+        if not isinstance(title, basestring) or not title.strip():
+            return ('error', "Title must not be blank.")
+        if len(title) > Movie.title.type.length:
+            return ('error', "Title is too long.")
+        return (None, None)
+
+    def _apply_list_changes(self, changes):
+        movie = Movie.__table__
+
+        def movie_ids(titles):
+            ids = {}
+            for chunk in chunked(titles, IN_CLAUSE_SIZE):
+                ids.update((t, i) for i, t in db.session.execute(
+                    db.select([movie.c.id, movie.c.title]).where(movie.c.title.in_(chunk))))
+            return ids
+
+        ids = movie_ids(set(title for _, title in changes))
+        missing = set(title for action, title in changes if action == 'add' and title not in ids)
+        if missing:
+            db.session.execute(movie.insert(), [dict(title=t) for t in missing])
+            ids.update(movie_ids(missing))
+
+        on_list = set()
+        for chunk in chunked(set(ids.values()), IN_CLAUSE_SIZE):
+            on_list.update(i for i, in db.session.execute(db.select([movielist.c.movie_id]).where(db.and_(
+                movielist.c.user_id == self.id, movielist.c.movie_id.in_(chunk)))))
+        before = set(on_list)
+
+        statuses = []
+        for action, title in changes:
+            movie_id = ids.get(title)
+            if action == 'add' and movie_id not in on_list:
+                on_list.add(movie_id)
+                statuses.append('added')
+            elif action == 'remove' and movie_id in on_list:
+                on_list.remove(movie_id)
+                statuses.append('removed')
+            else:
+                statuses.append('unchanged')
+
+        added = on_list - before
+        removed = before - on_list
+        if added:
+            db.session.execute(movielist.insert(), [dict(user_id=self.id, movie_id=i) for i in added])
+        for chunk in chunked(removed, IN_CLAUSE_SIZE):
+            db.session.execute(movielist.delete().where(db.and_(
+                movielist.c.user_id == self.id, movielist.c.movie_id.in_(chunk))))
+        if added or removed:
+            db.session.execute(movielist_change.insert(), [dict(movie_id=i) for i in added | removed])
+        return statuses
 
     def remove_from_list(self, title):
-        self.movies = [m for m in self.movies if m.title != title]
-        db.session.add(self)
-        db.session.commit()
+        '''Remove the movie `title` from this user's list.'''
+        self.update_list([('remove', title)])
 
     def to_json(self):
         return dict(
@@ -112,6 +229,16 @@ class Movie(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(256), unique=True, nullable=False)
 
+    #OMDb data filled in by ingest.py, `ingested` is None until the title has been looked up
+    year = db.Column(db.String(16))
+    genre = db.Column(db.String(256))
+    plot = db.Column(db.Text)
+    rating = db.Column(db.Float)
+    imdb_id = db.Column(db.String(16))
+    poster = db.Column(db.String(512))
+    omdb_error = db.Column(db.String(256))
+    ingested = db.Column(db.DateTime)
+
     comments = db.relationship('Comment', backref=db.backref('movie', lazy='select'), lazy='dynamic')
 
     @classmethod
@@ -124,6 +251,43 @@ class Movie(db.Model):
         db.session.commit()
         return m
 
+    def set_omdb_data(self, data):
+        '''Store an OMDb API response (or error) in this row.'''
+        self.omdb_error = data.get('Error')
+        if self.omdb_error is None:
+            self.year = data.get('Year')
+            self.genre = data.get('Genre')
+            self.plot = data.get('Plot')
+            try:
+                self.rating = float(data.get('imdbRating'))
+            except (TypeError, ValueError):
+                self.rating = None #"N/A"
+            self.imdb_id = data.get('imdbID')
+            self.poster = data.get('Poster')
+        self.ingested = datetime.utcnow()
+
+    @property
+    def omdb_data(self):
+        '''The stored OMDb data, in the same shape as the API response, or None if it hasn't been ingested.'''
+        if self.ingested is None:
+            return None
+        if self.omdb_error:
+            return {'Response': 'False', 'Error': self.omdb_error}
+        return {
+            'Title': self.title,
+            'Year': self.year,
+            'Genre': self.genre,
+            'Plot': self.plot,
+            'imdbRating': 'N/A' if self.rating is None else str(self.rating),
+            'imdbID': self.imdb_id,
+            'Poster': self.poster,
+            'Response': 'True',
+        }
+
+    def visible_comments(self):
+        '''Query for the comments on this movie that passed moderation.'''
+        return self.comments.filter_by(is_visible=True, is_deleted=False)
+
     def add_comment(self, comment):
         self.comments.append(comment)
         db.session.add(self)
@@ -132,13 +296,31 @@ class Movie(db.Model):
     def __repr__(self):
         return '<Movie id={!r} title={!r}>'.format(self.id, self.title)
 
-    def to_json(self):
+    def to_json(self, comments=None):
+        if comments is None:
+            comments = self.visible_comments()
         return dict(
             id=self.id,
             title=self.title,
-            comments=[row.to_json() for row in self.comments],
+            comments=[row.to_json() for row in comments],
         )
 
+    @classmethod
+    def to_json_many(cls, movies):
+        '''
+        Serialize a list of movies, loading the visible comments for all of
+        them with a single query instead of one query per movie.
+        '''
+        comments = defaultdict(list)
+        ids = [m.id for m in movies]
+        if ids:
+            rows = Comment.query.filter(
+                Comment.movie_id.in_(ids), Comment.is_visible == True, Comment.is_deleted == False
+            ).order_by(Comment.id)
+            for row in rows:
+                comments[row.movie_id].append(row)
+        return [m.to_json(comments=comments[m.id]) for m in movies]
+
 class Comment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     movie_id = db.Column('movie_id', db.Integer, db.ForeignKey('movie.id'))
@@ -150,6 +332,13 @@ class Comment(db.Model):
 
     user = db.relationship('User')
 
+    __table_args__ = (
+        #comments shown on a movie page
+        db.Index('ix_comment_movie_id_is_visible_is_deleted', 'movie_id', 'is_visible', 'is_deleted'),
+        #recent unmoderated comments, equality on is_visible first so the created range can use the index
+        db.Index('ix_comment_is_visible_created_is_deleted', 'is_visible', 'created', 'is_deleted'),
+    )
+
     def __repr__(self):
         return '<Comment id={!r} movie_id={!r} user_id={!r} created={!r} contents={!r}>'.format(
             self.id,
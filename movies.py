@@ -48,22 +48,104 @@ Mystery Men
 A Fish in the Bathtub
 '''
 
-import json
+import logging
+import os
+import Queue
 import random
-import urllib
+import socket
+import threading
+import time
+from collections import namedtuple
+
+import httpclient
+from breaker import CircuitBreaker, CircuitOpen, UpstreamUnavailable
+from cache import CACHE_DIR, LRUCache, TieredCache, makedirs, open_cache
+from concurrency import SingleFlight, map_concurrently
+from metrics import timed
 
 DEFAULT_CATEGORY = "American_science_fiction_action_films"
-WIKIPEDIA_CATEGORY_URL = "https://en.wikipedia.org/w/api.php?action=query&list=categorymembers&cmtitle=Category:{}&format=json&cmlimit=250&cmcontinue={}"
-OMDBAPI_TITLE_URL = "http://www.omdbapi.com/?t={}&y=&plot=short&r=json&tomatoes=true"
+
+#upstream API endpoints, override these to point the app at a stand-in server (see bench/stub_upstream.py)
+WIKIPEDIA_API_URL = os.environ.get('WIKIPEDIA_API_URL', "https://en.wikipedia.org/w/api.php")
+OMDBAPI_URL = os.environ.get('OMDBAPI_URL', "http://www.omdbapi.com/")
+WIKIPEDIA_CATEGORY_URL = WIKIPEDIA_API_URL + "?action=query&list=categorymembers&cmtitle=Category:{}&format=json&cmlimit=250&cmcontinue={}"
+OMDBAPI_TITLE_URL = OMDBAPI_URL + "?t={}&y=&plot=short&r=json&tomatoes=true"
+httpclient.register_upstream(WIKIPEDIA_API_URL, 'wikipedia')
+httpclient.register_upstream(OMDBAPI_URL, 'omdb')
 
 #have the user pick this many movies before quitting
 NUM_MOVIES = 3
 
+#titles MoviePicker tries (e.g. skipping ones OMDb doesn't know) before giving up on finding a movie
+PICK_ATTEMPTS = 10
+
+#number of movies to look up ahead of time, and how many threads to look them up with
+PREFETCH_DEPTH = 3
+PREFETCH_WORKERS = 2
+
 #use this to build the URL to the movie on IMDB, e.g.: http://www.imdb.com/title/tt0093773
 IMDB_URL = "http://www.imdb.com/title/{}"
 
+#category title lists are refreshed after this many seconds, stale lists keep being served (while a fresh copy is
+#fetched in the background) until they are WIKIPEDIA_CACHE_MAX_STALE seconds past that
+WIKIPEDIA_CACHE_TTL = int(os.environ.get('WIKIPEDIA_CACHE_TTL', 60 * 60 * 24))
+WIKIPEDIA_CACHE_MAX_STALE = int(os.environ.get('WIKIPEDIA_CACHE_MAX_STALE', 60 * 60 * 24 * 7))
+
+#OMDb lookups are cached for OMDB_CACHE_TTL seconds, "Movie not found!" results for OMDB_NOT_FOUND_TTL seconds, with
+#the most recently used OMDB_CACHE_SIZE entries also kept in memory by each worker
+OMDB_CACHE_TTL = int(os.environ.get('OMDB_CACHE_TTL', 60 * 60 * 24 * 7))
+OMDB_NOT_FOUND_TTL = int(os.environ.get('OMDB_NOT_FOUND_TTL', 60 * 60 * 24))
+OMDB_CACHE_SIZE = int(os.environ.get('OMDB_CACHE_SIZE', 2000))
+OMDB_NOT_FOUND = "Movie not found!"
+
+#maximum number of concurrent OMDb requests made by fetch_omdb_info_many
+OMDB_MAX_WORKERS = int(os.environ.get('OMDB_MAX_WORKERS', 8))
+
+#seconds a single OMDb lookup, or crawling every page of a Wikipedia category, may take before it's abandoned
+OMDB_DEADLINE = float(os.environ.get('OMDB_DEADLINE', 3))
+WIKIPEDIA_DEADLINE = float(os.environ.get('WIKIPEDIA_DEADLINE', 20))
+
+#concurrent fetches of the same title or category are always coalesced within a worker, with UPSTREAM_LOCKS set (and
+#caching enabled) workers also take a lock file in CACHE_DIR so only one of them fetches it
+UPSTREAM_LOCKS = os.environ.get('UPSTREAM_LOCKS', '1') == '1'
+UPSTREAM_LOCK_DIR = os.path.join(CACHE_DIR, 'locks') if CACHE_DIR and UPSTREAM_LOCKS else None
+
+wikipedia_cache = open_cache("wikipedia.db", WIKIPEDIA_CACHE_TTL)
+omdb_cache = TieredCache(LRUCache(OMDB_CACHE_SIZE, OMDB_CACHE_TTL), open_cache("omdb.db", OMDB_CACHE_TTL))
+_revalidating = set()
+_revalidating_lock = threading.Lock()
+if UPSTREAM_LOCK_DIR:
+    makedirs(UPSTREAM_LOCK_DIR)
+wikipedia_flight = SingleFlight('wikipedia', UPSTREAM_LOCK_DIR, WIKIPEDIA_DEADLINE)
+omdb_flight = SingleFlight('omdb', UPSTREAM_LOCK_DIR, OMDB_DEADLINE)
+wikipedia_breaker = CircuitBreaker('wikipedia')
+omdb_breaker = CircuitBreaker('omdb')
+#functions called with the category name when a re-crawl finds its titles changed
+titles_changed_listeners = []
+
 ## API code ###################################################################
 
+def fresh_value(cache, key):
+    '''The value cached under `key` if it's fresh, else None.'''
+    entry = cache.get(key)
+    if entry is not None and entry.is_fresh:
+        return entry.value
+    return None
+
+def get_json(url, deadline):
+    '''
+    GET `url` and decode the JSON response, giving up once the `time.time()`
+    `deadline` has passed. Server errors raise `httpclient.HTTPError`.
+    '''
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        raise socket.timeout("Deadline passed before requesting {!r}".format(url))
+    response = httpclient.get(url, connect_timeout=min(remaining, httpclient.CONNECT_TIMEOUT), read_timeout=remaining,
+                              pool_timeout=remaining)
+    if response.status >= 500:
+        raise httpclient.HTTPError("Request to {!r} failed with status {}".format(url, response.status))
+    return response.json()
+
 def clean_title(title):
     '''
     Removes "(film)", "(serial)", "(1998 film)", etc. from the given Wikipedia
@@ -92,22 +174,97 @@ def filter_titles(members):
         titles.append(title)
     return titles
 
-def fetch_wikipedia_titles(category):
-    '''
-    Returns a full list of members returned by the Wikipedia categorymembers
-    API call.
-    '''
+def _crawl_wikipedia_titles(category):
+    deadline = time.time() + WIKIPEDIA_DEADLINE
     cmcontinue = ""
     out = []
     while True:
         url = WIKIPEDIA_CATEGORY_URL.format(category, cmcontinue)
-        response = urllib.urlopen(url)
-        data = json.loads(response.read())
+        data = get_json(url, deadline)
         out.extend(data['query']['categorymembers'])
         if 'continue' not in data:
             break
         cmcontinue = data['continue']['cmcontinue']
-    return filter_titles(out)
+    return out
+
+def crawl_wikipedia_titles(category):
+    '''
+    Returns a full list of members returned by the Wikipedia categorymembers
+    API call. Raises `UpstreamUnavailable` if Wikipedia fails or takes longer
+    than WIKIPEDIA_DEADLINE.
+    '''
+    return filter_titles(wikipedia_breaker.call(_crawl_wikipedia_titles, category))
+
+def refresh_wikipedia_titles(category):
+    '''
+    Crawl the titles in `category` and store them in the shared cache.
+    '''
+    titles = crawl_wikipedia_titles(category)
+    previous = wikipedia_cache.get(category)
+    wikipedia_cache.set(category, titles)
+    if previous is not None and previous.value != titles:
+        for listener in titles_changed_listeners:
+            listener(category)
+    return titles
+
+def coalesced_refresh_wikipedia_titles(category):
+    '''
+    `refresh_wikipedia_titles`, sharing the result with concurrent callers for
+    the same category. Skips the crawl if another worker refreshed it while
+    this one waited.
+    '''
+    return wikipedia_flight.do(
+        category,
+        lambda: refresh_wikipedia_titles(category),
+        lambda: fresh_value(wikipedia_cache, category),
+    )
+
+def _revalidate(category):
+    try:
+        coalesced_refresh_wikipedia_titles(category)
+    except CircuitOpen:
+        pass
+    except Exception:
+        logging.exception("Failed to refresh cached titles for %r", category)
+    finally:
+        with _revalidating_lock:
+            _revalidating.discard(category)
+
+def revalidate_in_background(category):
+    '''
+    Refresh the cached titles for `category` in a background thread, unless
+    this process is already doing so.
+    '''
+    with _revalidating_lock:
+        if category in _revalidating:
+            return
+        _revalidating.add(category)
+    t = threading.Thread(target=_revalidate, args=(category,))
+    t.daemon = True
+    t.start()
+
+@timed('fetch_wikipedia_titles')
+def fetch_wikipedia_titles(category):
+    '''
+    Returns the cleaned list of titles in the given Wikipedia category.
+
+    Titles are served from the shared cache. Stale entries are returned right
+    away while a fresh copy is fetched in the background, only missing (or
+    very old) entries require crawling Wikipedia before returning, and even
+    those are served if Wikipedia is unavailable.
+    '''
+    entry = wikipedia_cache.get(category)
+    if entry is None or entry.age > WIKIPEDIA_CACHE_TTL + WIKIPEDIA_CACHE_MAX_STALE:
+        try:
+            return coalesced_refresh_wikipedia_titles(category)
+        except UpstreamUnavailable, e:
+            if entry is None:
+                raise
+            logging.warning("Serving old titles for %r: %s", category, e)
+            return entry.value
+    if not entry.is_fresh:
+        revalidate_in_background(category)
+    return entry.value
 
 def is_valid_category(category):
     if not category:
@@ -120,17 +277,98 @@ def is_valid_category(category):
 
     return True
 
+def normalize_title(title):
+    '''
+    Returns the cache key for `title`: lowercased with runs of whitespace
+    collapsed, so "The  Pest" and "the pest" share an entry.
+    '''
+    if isinstance(title, str):
+        title = title.decode('utf8')
+    return u" ".join(title.lower().split())
+
+def request_omdb_info(title):
+    '''
+    Retrieve movie information from OMDb API's title search, without caching.
+    Raises `UpstreamUnavailable` if OMDb fails or takes longer than
+    OMDB_DEADLINE.
+    '''
+    url = OMDBAPI_TITLE_URL.format(title.encode('utf8'))
+    return omdb_breaker.call(get_json, url, time.time() + OMDB_DEADLINE)
+
+@timed('fetch_omdb_info')
 def fetch_omdb_info(title):
     '''
     Retrieve movie information from OMDb API's title search.
+
+    Responses are cached, including "Movie not found!" errors (for a shorter
+    time) so titles that aren't movies don't cost a request every time. On a
+    miss, concurrent lookups of the same title share a single request, and a
+    stale entry is served if OMDb is unavailable.
     '''
-    url = OMDBAPI_TITLE_URL.format(title.encode('utf8'))
-    response = urllib.urlopen(url)
-    data = json.loads(response.read())
+    key = normalize_title(title)
+    entry = omdb_cache.get(key)
+    if entry is not None and entry.is_fresh:
+        data = entry.value
+    else:
+        try:
+            data = omdb_flight.do(key, lambda: _request_and_cache_omdb_info(title, key), lambda: fresh_value(omdb_cache, key))
+        except UpstreamUnavailable, e:
+            if entry is None:
+                raise
+            logging.warning("Serving stale OMDb data for %r: %s", title, e)
+            data = entry.value
+    return raise_for_omdb_error(data, title)
+
+def _request_and_cache_omdb_info(title, key):
+    data = request_omdb_info(title)
+    if not data.get('Error'):
+        omdb_cache.set(key, data)
+    elif data['Error'] == OMDB_NOT_FOUND:
+        omdb_cache.set(key, data, OMDB_NOT_FOUND_TTL)
+    return data
+
+class OMDbError(RuntimeError):
+    '''Raised for an OMDb error response, `error` is OMDb's error message.'''
+    def __init__(self, error, title):
+        RuntimeError.__init__(self, "OMDb API returned {!r} when looking up {!r}".format(error, title))
+        self.error = error
+
+    @property
+    def not_found(self):
+        return self.error == OMDB_NOT_FOUND
+
+def raise_for_omdb_error(data, title):
+    '''Returns `data`, raising `OMDbError` if it's an OMDb error response.'''
     if data.get('Error'):
-        raise RuntimeError("OMDb API returned {!r} when looking up {!r}".format(data['Error'], title))
+        raise OMDbError(data['Error'], title)
     return data
 
+class OMDbResult(namedtuple('OMDbResult', 'title data error')):
+    @property
+    def not_found(self):
+        '''True if OMDb answered that it doesn't know the title.'''
+        return isinstance(self.error, OMDbError) and self.error.not_found
+
+def _fetch_omdb_result(title):
+    try:
+        return OMDbResult(title, fetch_omdb_info(title), None)
+    except Exception, e:
+        return OMDbResult(title, None, e)
+
+def fetch_omdb_info_many(titles, max_workers=None):
+    '''
+    Look up several titles on OMDb concurrently, using at most `max_workers`
+    threads (defaults to OMDB_MAX_WORKERS).
+
+    Returns a list of `OMDbResult` tuples in the same order as `titles`. A
+    title that failed to load has `data` set to None and the exception in
+    `error`, it doesn't stop the other lookups.
+    '''
+    titles = list(titles)
+    if len(titles) <= 1:
+        return [_fetch_omdb_result(title) for title in titles]
+    return map_concurrently(_fetch_omdb_result, titles, min(len(titles), max_workers or OMDB_MAX_WORKERS))
+
 ## classes ####################################################################
 
 class MovieData(object):
@@ -187,26 +425,96 @@ class MoviePicker(object):
     '''
     Random movie picker functionality. Returns random movies and keeps track of picked movies.
     '''
-    def __init__(self, titles):
+    def __init__(self, titles, prefetch=0, workers=1):
         '''
         Initializes the MoviePicker with a list of `titles` that will be picked from randomly.
+
+        If `prefetch` is greater than zero, `workers` background threads keep
+        up to that many movies looked up ahead of time so picking one doesn't
+        have to wait on OMDb. Call `close()` to stop them.
         '''
         self.titles = random.sample(titles, len(titles))
         self.picked = []
+        self._queue = None
+        self._upstream_error = None
+        if prefetch > 0:
+            self._start_prefetching(prefetch, workers)
+
+    def _start_prefetching(self, depth, workers):
+        self._queue = Queue.Queue(maxsize=depth)
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._exhausted = threading.Event()
+        self._running = workers
+        for _ in range(workers):
+            t = threading.Thread(target=self._prefetch)
+            t.daemon = True
+            t.start()
+
+    def _prefetch(self):
+        try:
+            while not self._stopped.is_set():
+                with self._lock:
+                    if not self.titles:
+                        break
+                    title = self.titles.pop()
+                try:
+                    movie = MovieData(fetch_omdb_info(title))
+                except UpstreamUnavailable, e:
+                    #put the title back and wait for OMDb to recover, get_random_movie raises the error meanwhile
+                    with self._lock:
+                        self.titles.append(title)
+                    self._upstream_error = e
+                    self._stopped.wait(e.retry_after)
+                    continue
+                except RuntimeError:
+                    continue
+                self._upstream_error = None
+                while not self._stopped.is_set():
+                    try:
+                        self._queue.put(movie, timeout=0.1)
+                        break
+                    except Queue.Full:
+                        pass
+        finally:
+            with self._lock:
+                self._running -= 1
+                if self._running == 0:
+                    self._exhausted.set()
+
+    def close(self):
+        '''Stop the prefetching threads, if any.'''
+        if self._queue is not None:
+            self._stopped.set()
 
     def get_random_movie(self):
         '''
         Pick a random title, fetch its data from OMDB, and return it as a MovieData object.
+
+        Titles OMDb doesn't know are skipped, up to PICK_ATTEMPTS of them.
+        Raises `UpstreamUnavailable` right away if OMDb isn't responding.
         '''
-        movie = None
-        while not movie:
+        if self._queue is not None:
+            while True:
+                try:
+                    return self._queue.get(timeout=0.1)
+                except Queue.Empty:
+                    if self._exhausted.is_set() and self._queue.empty():
+                        raise IndexError("No more titles to pick from.")
+                    if self._upstream_error is not None:
+                        raise self._upstream_error
+
+        for _ in range(PICK_ATTEMPTS):
             title = self.titles.pop()
             try:
-                movie = fetch_omdb_info(title)
+                return MovieData(fetch_omdb_info(title))
+            except UpstreamUnavailable:
+                self.titles.append(title)
+                raise
             except RuntimeError:
                 #retry "RuntimeError: OMDb API returned u'Movie not found!'" exceptions
-                movie = None
-        return MovieData(movie)
+                pass
+        raise RuntimeError("None of the {} titles tried were found on OMDb.".format(PICK_ATTEMPTS))
 
     def add_to_list(self, m):
         '''Add the given Movie object `m` to the list of picked movies.'''
@@ -219,7 +527,7 @@ class MoviePicker(object):
 ## main #######################################################################
 
 def main(category):
-    picker = MoviePicker(fetch_wikipedia_titles(category))
+    picker = MoviePicker(fetch_wikipedia_titles(category), prefetch=PREFETCH_DEPTH, workers=PREFETCH_WORKERS)
     num_picked = 0
     while num_picked < NUM_MOVIES:
         movie = picker.get_random_movie()
@@ -229,6 +537,7 @@ def main(category):
         if answer.lower().startswith('y'):
             picker.add_to_list(movie)
             num_picked += 1
+    picker.close()
     print "\n== Your movies ==\n"
     for title in picker.get_list():
         print title
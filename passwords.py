@@ -0,0 +1,144 @@
+'''
+Password hashing and verification.
+
+pbkdf2 is deliberately CPU heavy, so the work is sent to a small pool of
+worker processes instead of running inside the web worker. The number of
+hashes waiting on the pool is capped, past that `HashingOverloaded` is raised
+instead of letting a burst of logins queue up behind each other.
+'''
+
+import Queue
+import multiprocessing
+import os
+import select
+import threading
+import time
+
+from passlib.hash import pbkdf2_sha512
+
+#pbkdf2 rounds used for new hashes, existing hashes with a different cost are rehashed on login
+PASSWORD_HASH_ROUNDS = int(os.environ.get('PASSWORD_HASH_ROUNDS', pbkdf2_sha512.default_rounds))
+#number of hashing processes per web worker, 0 hashes inline
+PASSWORD_HASH_PROCESSES = int(os.environ.get('PASSWORD_HASH_PROCESSES', 2))
+#maximum hashes waiting on (or running in) the pool before HashingOverloaded is raised
+PASSWORD_HASH_QUEUE = int(os.environ.get('PASSWORD_HASH_QUEUE', 16))
+#seconds to wait for a hash before giving up
+PASSWORD_HASH_TIMEOUT = 30
+
+class HashingOverloaded(RuntimeError):
+    '''Raised when too many passwords are already waiting to be hashed.'''
+
+def _hash(password, rounds):
+    return pbkdf2_sha512.encrypt(password, rounds=rounds)
+
+def _verify(password, password_hash):
+    return pbkdf2_sha512.verify(password, password_hash)
+
+def _serve(requests, results):
+    #runs in a hashing process: call whatever comes down the pipe and send back the outcome
+    while True:
+        try:
+            func, args = requests.recv()
+        except EOFError:
+            return
+        try:
+            results.send((True, func(*args)))
+        except Exception, e:
+            results.send((False, e))
+
+class _Worker(object):
+    '''
+    A hashing process and the pipes to it, running one call at a time. One way
+    pipes because two way ones are socket pairs, which gevent makes
+    non-blocking.
+    '''
+    def __init__(self):
+        requests, self.requests = multiprocessing.Pipe(False)
+        self.results, results = multiprocessing.Pipe(False)
+        self.process = multiprocessing.Process(target=_serve, args=(requests, results))
+        self.process.daemon = True
+        self.process.start()
+        requests.close()
+        results.close()
+
+    def call(self, func, args, timeout):
+        self.requests.send((func, args))
+        #select is cooperative under gevent, so the other greenlets keep running while this one waits
+        if not select.select([self.results], [], [], timeout)[0]:
+            raise multiprocessing.TimeoutError()
+        ok, value = self.results.recv()
+        if not ok:
+            raise value
+        return value
+
+    def stop(self):
+        self.process.terminate()
+        self.requests.close()
+        self.results.close()
+
+class HashingPool(object):
+    '''
+    Runs calls in `processes` worker processes. multiprocessing.Pool can't be
+    used: its result handling threads deadlock once gevent has patched
+    threading, so each process gets its own pipes instead.
+    '''
+    def __init__(self, processes, max_pending, timeout):
+        self.processes = processes
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.pending = 0
+        self._lock = threading.Lock()
+        self._idle = None
+        self._pid = None
+
+    def _get_idle(self):
+        #the processes are started lazily so each gunicorn worker gets its own after forking
+        with self._lock:
+            if self._pid != os.getpid():
+                self._idle = Queue.Queue()
+                for _ in range(self.processes):
+                    self._idle.put(_Worker())
+                self._pid = os.getpid()
+            return self._idle
+
+    def run(self, func, *args):
+        '''Run `func(*args)` in one of the processes and return the result.'''
+        if self.processes <= 0:
+            return func(*args)
+        with self._lock:
+            if self.pending >= self.max_pending:
+                raise HashingOverloaded("Too many password checks in progress, please try again.")
+            self.pending += 1
+        try:
+            idle = self._get_idle()
+            deadline = time.time() + self.timeout
+            try:
+                worker = idle.get(timeout=self.timeout)
+            except Queue.Empty:
+                raise HashingOverloaded("Timed out waiting for the password check, please try again.")
+            try:
+                return worker.call(func, args, max(deadline - time.time(), 0))
+            except (multiprocessing.TimeoutError, EOFError, IOError):
+                #the process is stuck or gone, replace it so its late answer isn't read by the next call
+                worker.stop()
+                worker = _Worker()
+                raise HashingOverloaded("Timed out waiting for the password check, please try again.")
+            finally:
+                idle.put(worker)
+        finally:
+            with self._lock:
+                self.pending -= 1
+
+pool = HashingPool(PASSWORD_HASH_PROCESSES, PASSWORD_HASH_QUEUE, PASSWORD_HASH_TIMEOUT)
+
+def hash_password(password):
+    '''Returns a new hash of `password` using the configured number of rounds.'''
+    return pool.run(_hash, password, PASSWORD_HASH_ROUNDS)
+
+def verify_password(password, password_hash):
+    '''Returns True if `password` matches `password_hash`.'''
+    return pool.run(_verify, password, password_hash)
+
+def needs_rehash(password_hash):
+    '''Returns True if `password_hash` wasn't made with the configured number of rounds.'''
+    return pbkdf2_sha512.from_string(password_hash).rounds != PASSWORD_HASH_ROUNDS
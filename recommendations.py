@@ -0,0 +1,301 @@
+'''
+"People also listed" recommendations, from which movies end up on the same
+users' lists.
+
+The similarity of two movies is the cosine of their columns in the binary
+user x movie matrix built from `movielist`: the number of users listing both,
+divided by the square root of the number of users listing each. The top
+RECOMMENDATIONS_K similar movies of every movie are stored in
+`movie_similarity`, so pages only read a few rows by primary key.
+
+List changes are logged in `movielist_change` in the same transaction, and
+`refresh()` recomputes only the changed movies and the movies listed
+alongside them. It runs in the background shortly after a list changes, and
+can be run by hand:
+
+$ python recommendations.py refresh
+$ python recommendations.py rebuild
+'''
+
+import heapq
+import logging
+import math
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from cache import CACHE_DIR, makedirs
+from concurrency import file_lock
+from models import IN_CLAUSE_SIZE, chunked, db, Movie, movielist, movielist_change, movie_similarity
+
+#similar movies stored per movie, and how many of them the movie page and the user page show
+RECOMMENDATIONS_K = int(os.environ.get('RECOMMENDATIONS_K', 20))
+ALSO_LISTED_SHOWN = 5
+SUGGESTIONS_SHOWN = 10
+#seconds between a list change and the background refresh, so changes made meanwhile are refreshed together; set
+#to a negative number to only refresh from the command line
+RECOMMENDATIONS_REFRESH_DELAY = float(os.environ.get('RECOMMENDATIONS_REFRESH_DELAY', 5))
+
+#functions called with the titles of the movies whose similar movies were recomputed
+similar_changed_listeners = []
+
+_scheduled = False
+_scheduled_lock = threading.Lock()
+
+def _list_counts(movie_ids):
+    '''`{movie_id: number of lists it's on}` for `movie_ids`, or for every listed movie if None.'''
+    query = db.select([movielist.c.movie_id, db.func.count()]).group_by(movielist.c.movie_id)
+    if movie_ids is None:
+        return dict(db.session.execute(query).fetchall())
+    counts = {}
+    for chunk in chunked(movie_ids, IN_CLAUSE_SIZE):
+        counts.update(db.session.execute(query.where(movielist.c.movie_id.in_(chunk))).fetchall())
+    return counts
+
+def _co_listed(movie_ids):
+    '''
+    `{movie_id: {other_id: number of lists with both}}`: the rows of the
+    co-occurrence matrix for `movie_ids`, or for every listed movie if None.
+    '''
+    together = defaultdict(lambda: defaultdict(int))
+    if movie_ids is None:
+        lists = defaultdict(list)
+        for user_id, movie_id in db.session.execute(db.select([movielist.c.user_id, movielist.c.movie_id])):
+            lists[user_id].append(movie_id)
+        for movies in lists.values():
+            for movie_id in movies:
+                row = together[movie_id]
+                for other_id in movies:
+                    row[other_id] += 1
+    else:
+        #only the affected rows, counted by the database
+        other = movielist.alias()
+        for chunk in chunked(movie_ids, IN_CLAUSE_SIZE):
+            for movie_id, other_id, n in db.session.execute(
+                db.select([movielist.c.movie_id, other.c.movie_id, db.func.count()])
+                .where(db.and_(movielist.c.movie_id.in_(chunk), other.c.user_id == movielist.c.user_id))
+                .group_by(movielist.c.movie_id, other.c.movie_id)
+            ):
+                together[movie_id][other_id] = n
+    return together
+
+def similarities(movie_ids=None):
+    '''
+    Returns `{movie_id: {other_id: cosine similarity}}` for each movie in
+    `movie_ids`, or for every listed movie if None, leaving out movies never
+    listed together.
+
+    This is the product of the transposed binary user x movie matrix with
+    itself, normalized, computed sparsely: only movies sharing a list get a
+    count.
+    '''
+    together = _co_listed(movie_ids)
+    if movie_ids is None:
+        movie_ids = list(together)
+        counts = _list_counts(None)
+    else:
+        others = set(o for row in together.values() for o in row)
+        #past a few IN clauses, counting every movie in one pass is cheaper
+        counts = _list_counts(None if len(others) > 4 * IN_CLAUSE_SIZE else others)
+    scores = {}
+    for movie_id in movie_ids:
+        row = together.get(movie_id, {})
+        row.pop(movie_id, None)
+        norm = math.sqrt(counts.get(movie_id, 0))
+        scores[movie_id] = dict((other_id, n / (norm * math.sqrt(counts[other_id]))) for other_id, n in row.items())
+    return scores
+
+def top(scores, k=RECOMMENDATIONS_K):
+    '''The `k` best of the `(other_id, score)` pairs `scores` as `(score, other_id)`, ties going to the lower id.'''
+    return [(score, other_id) for score, _, other_id in heapq.nlargest(k, ((s, -o, o) for o, s in scores))]
+
+def compute(movie_ids=None, k=RECOMMENDATIONS_K):
+    '''
+    Returns `{movie_id: [(score, similar_movie_id), ...]}` with the top `k`
+    similar movies, best first, of each movie in `movie_ids`, or of every
+    listed movie if None.
+    '''
+    return dict((movie_id, top(row.items(), k)) for movie_id, row in similarities(movie_ids).items())
+
+def _insert(similar):
+    rows = [
+        dict(movie_id=movie_id, rank=rank, similar_movie_id=other_id, score=score)
+        for movie_id, top in similar.items() for rank, (score, other_id) in enumerate(top)
+    ]
+    if rows:
+        db.session.execute(movie_similarity.insert(), rows)
+
+def _notify(movie_ids):
+    if not similar_changed_listeners:
+        return
+    titles = []
+    for chunk in chunked(movie_ids, IN_CLAUSE_SIZE):
+        titles.extend(t for t, in db.session.execute(db.select([Movie.title]).where(Movie.id.in_(chunk))))
+    for listener in similar_changed_listeners:
+        listener(titles)
+
+def _stored(movie_ids):
+    '''`{movie_id: [(score, similar_movie_id), ...]}` as stored in `movie_similarity`.'''
+    stored = defaultdict(list)
+    for chunk in chunked(movie_ids, IN_CLAUSE_SIZE):
+        for movie_id, other_id, score in db.session.execute(
+            db.select([movie_similarity.c.movie_id, movie_similarity.c.similar_movie_id, movie_similarity.c.score])
+            .where(movie_similarity.c.movie_id.in_(chunk)).order_by(movie_similarity.c.rank)
+        ):
+            stored[movie_id].append((score, other_id))
+    return stored
+
+def refresh():
+    '''
+    Update the similar movies after list changes: movies added to or removed
+    from a list since the last refresh get their similarities recomputed, and
+    so do the movies whose similarity to them changed. Returns the number of
+    movies whose similar movies were updated.
+
+    Only the scores involving a changed movie can change, so the other
+    movies keep their stored similar movies and merge in their new scores
+    with the changed ones. They are only recomputed in full when a changed
+    movie among their similar movies lost score, since whatever should take
+    its place isn't stored, and only written if their similar movies changed.
+    '''
+    last_change = db.session.execute(db.select([db.func.max(movielist_change.c.id)])).scalar()
+    if last_change is None:
+        return 0
+    changed = set(m for m, in db.session.execute(
+        db.select([movielist_change.c.movie_id]).where(movielist_change.c.id <= last_change).distinct()))
+
+    rows = similarities(changed)
+    similar = dict((movie_id, top(row.items())) for movie_id, row in rows.items())
+    #similarity is symmetric, the changed rows hold every score that changed
+    new_scores = defaultdict(dict)
+    for movie_id, row in rows.items():
+        for other_id, score in row.items():
+            if other_id not in changed:
+                new_scores[other_id][movie_id] = score
+    neighbours = set(new_scores)
+    for chunk in chunked(changed, IN_CLAUSE_SIZE):
+        #movies that had a changed movie among their similar movies, but aren't listed with it anymore
+        neighbours.update(m for m, in db.session.execute(
+            db.select([movie_similarity.c.movie_id]).distinct().where(movie_similarity.c.similar_movie_id.in_(chunk))))
+    neighbours -= changed
+
+    stored = _stored(neighbours)
+    recompute = []
+    for movie_id in neighbours:
+        scores = new_scores.get(movie_id, {})
+        previous = stored.get(movie_id, [])
+        if any(other_id in changed and scores.get(other_id, 0) < score for score, other_id in previous):
+            recompute.append(movie_id)
+            continue
+        similar[movie_id] = top([(o, s) for s, o in previous if o not in changed] + scores.items())
+    similar.update(compute(recompute))
+    for movie_id in neighbours:
+        if similar[movie_id] == stored.get(movie_id, []):
+            del similar[movie_id]
+
+    for chunk in chunked(similar, IN_CLAUSE_SIZE):
+        db.session.execute(movie_similarity.delete().where(movie_similarity.c.movie_id.in_(chunk)))
+    _insert(similar)
+    db.session.execute(movielist_change.delete().where(movielist_change.c.id <= last_change))
+    db.session.commit()
+    _notify(similar)
+    return len(similar)
+
+def rebuild():
+    '''Recompute the similar movies of every movie. Returns the number of movies with similar movies.'''
+    last_change = db.session.execute(db.select([db.func.max(movielist_change.c.id)])).scalar()
+    similar = compute()
+    affected = set(m for m, in db.session.execute(db.select([movie_similarity.c.movie_id]).distinct()))
+    db.session.execute(movie_similarity.delete())
+    _insert(similar)
+    if last_change is not None:
+        db.session.execute(movielist_change.delete().where(movielist_change.c.id <= last_change))
+    db.session.commit()
+    _notify(affected | set(similar))
+    return len([top for top in similar.values() if top])
+
+@contextmanager
+def _refresh_lock():
+    #refreshes from different workers would write the same rows
+    if not CACHE_DIR:
+        yield
+        return
+    makedirs(CACHE_DIR)
+    with file_lock(os.path.join(CACHE_DIR, 'recommendations.lock'), 60):
+        yield
+
+def _refresh_later(app):
+    global _scheduled
+    time.sleep(RECOMMENDATIONS_REFRESH_DELAY)
+    with _scheduled_lock:
+        #changes from here on schedule another refresh
+        _scheduled = False
+    try:
+        with app.app_context(), _refresh_lock():
+            refresh()
+    except Exception:
+        logging.exception("Failed to refresh recommendations")
+
+def schedule_refresh(app):
+    '''
+    Refresh in a background thread RECOMMENDATIONS_REFRESH_DELAY seconds from
+    now, unless this process already has a refresh scheduled.
+    '''
+    global _scheduled
+    if RECOMMENDATIONS_REFRESH_DELAY < 0:
+        return
+    with _scheduled_lock:
+        if _scheduled:
+            return
+        _scheduled = True
+    t = threading.Thread(target=_refresh_later, args=(app,))
+    t.daemon = True
+    t.start()
+
+def also_listed(movie_id, limit=ALSO_LISTED_SHOWN):
+    '''Titles of the movies most often listed together with `movie_id`, best first.'''
+    return [title for title, in db.session.execute(
+        db.select([Movie.title])
+        .select_from(movie_similarity.join(Movie.__table__, Movie.id == movie_similarity.c.similar_movie_id))
+        .where(movie_similarity.c.movie_id == movie_id)
+        .order_by(movie_similarity.c.rank).limit(limit)
+    )]
+
+def suggestions(user_id, limit=SUGGESTIONS_SHOWN):
+    '''
+    Titles to suggest to `user_id`: the movies similar to the ones on their
+    list that aren't on it yet, by their total similarity to the list.
+    '''
+    listed = movielist.alias()
+    total = db.func.sum(movie_similarity.c.score)
+    return [title for title, _ in db.session.execute(
+        db.select([Movie.title, total])
+        .select_from(movielist
+            .join(movie_similarity, movie_similarity.c.movie_id == movielist.c.movie_id)
+            .join(Movie.__table__, Movie.id == movie_similarity.c.similar_movie_id))
+        .where(db.and_(movielist.c.user_id == user_id, ~db.exists().where(db.and_(
+            listed.c.user_id == user_id, listed.c.movie_id == movie_similarity.c.similar_movie_id))))
+        .group_by(Movie.id, Movie.title)
+        .order_by(total.desc(), Movie.title).limit(limit)
+    )]
+
+if __name__ == '__main__':
+    from flask_script import Command, Manager
+    from app import app
+
+    def refresh_command():
+        '''Update the similar movies of the movies whose lists changed.'''
+        with _refresh_lock():
+            print "{} movies refreshed".format(refresh())
+
+    def rebuild_command():
+        '''Recompute the similar movies of every movie.'''
+        with _refresh_lock():
+            print "{} movies have similar movies".format(rebuild())
+
+    manager = Manager(app)
+    manager.add_command('refresh', Command(refresh_command))
+    manager.add_command('rebuild', Command(rebuild_command))
+    manager.run()
@@ -0,0 +1,236 @@
+'''
+Full-text search over the titles of every saved category, stored in a sqlite
+FTS5 index in the cache directory so all workers share it.
+
+Each category's titles are replaced as a unit, and only when they changed
+since the category was last indexed, so keeping the index up to date after a
+category is added or re-crawled only touches that category's rows.
+
+If the sqlite library wasn't built with FTS5, titles are found by substring
+matching instead, which scans every title.
+'''
+
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import threading
+
+from cache import CACHE_DIR, makedirs
+
+#results returned by the search page and the autocomplete endpoint
+SEARCH_LIMIT = 50
+SUGGEST_LIMIT = 10
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS category (name TEXT PRIMARY KEY, checksum TEXT)",
+    #each distinct title once, however many categories it's in
+    "CREATE TABLE IF NOT EXISTS title (id INTEGER PRIMARY KEY, title TEXT UNIQUE, sort_key TEXT)",
+    "CREATE INDEX IF NOT EXISTS ix_title_sort_key ON title (sort_key)",
+    "CREATE TABLE IF NOT EXISTS title_category (category TEXT, title_id INTEGER, PRIMARY KEY (category, title_id))",
+    "CREATE INDEX IF NOT EXISTS ix_title_category_title_id ON title_category (title_id)",
+]
+
+FTS_SCHEMA = [
+    #external content table: the FTS index only stores the tokens, the titles live in `title`
+    '''CREATE VIRTUAL TABLE IF NOT EXISTS title_fts USING fts5(
+        title, content='title', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 1', prefix='1 2 3'
+    )''',
+    '''CREATE TRIGGER IF NOT EXISTS title_ai AFTER INSERT ON title BEGIN
+        INSERT INTO title_fts (rowid, title) VALUES (new.id, new.title);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS title_ad AFTER DELETE ON title BEGIN
+        INSERT INTO title_fts (title_fts, rowid, title) VALUES ('delete', old.id, old.title);
+    END''',
+]
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+def _unicode(text):
+    return text.decode('utf8') if isinstance(text, str) else text
+
+def sort_key(text):
+    '''Lowercased with runs of whitespace collapsed, used to find titles starting with what was typed.'''
+    return u" ".join(_unicode(text).lower().split())
+
+def match_query(text):
+    '''
+    Turn what the user typed into an FTS5 query: every word must match, the
+    last one as a prefix since it may not be finished yet. Returns None if
+    there are no words.
+    '''
+    words = WORD_RE.findall(_unicode(text))
+    if not words:
+        return None
+    return u" ".join(u'"{}"'.format(w) for w in words) + u"*"
+
+def like_patterns(text):
+    '''
+    LIKE patterns for the titles containing every word of `text`, used
+    instead of `match_query` when FTS5 isn't available.
+    '''
+    #words can't contain % or \\, only _ needs escaping
+    return [u"%{}%".format(w.replace(u"_", u"\\_")) for w in WORD_RE.findall(sort_key(text))]
+
+def checksum(titles):
+    return hashlib.sha1(u"\n".join(titles).encode('utf8')).hexdigest()
+
+class SearchIndex(object):
+    '''
+    Title search index kept in the sqlite database at `path`, or in memory if
+    `path` is None.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                for statement in SCHEMA:
+                    conn.execute(statement)
+            try:
+                with conn:
+                    for statement in FTS_SCHEMA:
+                        conn.execute(statement)
+                self.full_text = True
+            except sqlite3.OperationalError, e:
+                logging.warning("sqlite has no FTS5 (%s), title search falls back to substring matching", e)
+                self.full_text = False
+
+    def _connect(self):
+        #must be called with the lock held, connections can't be shared by forked processes
+        if self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path or ':memory:', timeout=30, check_same_thread=False)
+            if self.path:
+                self._conn.execute("PRAGMA journal_mode=WAL")
+            self._pid = os.getpid()
+        return self._conn
+
+    def _remove_titles(self, conn, category):
+        '''Take `category` off its titles, deleting the titles that are no longer in any category.'''
+        old_ids = [row[0] for row in conn.execute("SELECT title_id FROM title_category WHERE category = ?", (category,))]
+        conn.execute("DELETE FROM title_category WHERE category = ?", (category,))
+        conn.executemany(
+            "DELETE FROM title WHERE id = ? AND NOT EXISTS (SELECT 1 FROM title_category WHERE title_id = ?)",
+            ((i, i) for i in old_ids),
+        )
+
+    def update_category(self, category, titles):
+        '''Index `titles` as the titles of `category`, replacing its previous titles. Returns False if nothing changed.'''
+        titles = [_unicode(t) for t in titles]
+        new_checksum = checksum(titles)
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                row = conn.execute("SELECT checksum FROM category WHERE name = ?", (category,)).fetchone()
+                if row is not None and row[0] == new_checksum:
+                    return False
+                self._remove_titles(conn, category)
+                conn.executemany("INSERT OR IGNORE INTO title (title, sort_key) VALUES (?, ?)", ((t, sort_key(t)) for t in titles))
+                conn.executemany(
+                    "INSERT OR IGNORE INTO title_category (category, title_id) SELECT ?, id FROM title WHERE title = ?",
+                    ((category, t) for t in titles),
+                )
+                conn.execute("INSERT OR REPLACE INTO category (name, checksum) VALUES (?, ?)", (category, new_checksum))
+        return True
+
+    def remove_category(self, category):
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                self._remove_titles(conn, category)
+                conn.execute("DELETE FROM category WHERE name = ?", (category,))
+
+    def categories(self):
+        '''Names of the indexed categories.'''
+        with self._lock:
+            return [row[0] for row in self._connect().execute("SELECT name FROM category")]
+
+    def sync(self, title_index, category_names):
+        '''
+        Bring the index in line with a freshly built `TitleIndex` of
+        `category_names`: changed categories are re-indexed and categories that
+        are no longer saved are removed. Categories that failed to load keep
+        their previous titles.
+        '''
+        for category in title_index.categories:
+            self.update_category(category, title_index.titles_for(category))
+        for category in set(self.categories()) - set(category_names):
+            self.remove_category(category)
+
+    def _matching(self, text):
+        '''
+        `(select, parameters)` for the ids and titles of the titles containing
+        every word of `text`, or None if there are no words.
+        '''
+        if self.full_text:
+            query = match_query(text)
+            if query is None:
+                return None
+            return "SELECT t.id, t.title FROM title_fts f JOIN title t ON t.id = f.rowid WHERE title_fts MATCH ?", [query]
+        patterns = like_patterns(text)
+        if not patterns:
+            return None
+        where = " AND ".join(["t.sort_key LIKE ? ESCAPE '\\'"] * len(patterns))
+        return "SELECT t.id, t.title FROM title t WHERE " + where, patterns
+
+    def search(self, text, limit=SEARCH_LIMIT):
+        '''
+        Returns up to `limit` `(title, categories)` tuples for the titles
+        containing every word of `text`. Every result contains all the words,
+        so the shortest titles (the ones with the fewest other words) come
+        first; this is far cheaper than bm25 when a common word matches
+        thousands of titles.
+        '''
+        query = self._matching(text)
+        if query is None:
+            return []
+        select, params = query
+        with self._lock:
+            conn = self._connect()
+            rows = conn.execute(select + " ORDER BY length(t.title), t.sort_key LIMIT ?", params + [limit]).fetchall()
+            categories = dict((i, []) for i, _ in rows)
+            if rows:
+                placeholders = ", ".join("?" * len(rows))
+                for title_id, category in conn.execute(
+                    "SELECT title_id, category FROM title_category WHERE title_id IN ({}) ORDER BY category".format(placeholders),
+                    list(categories),
+                ):
+                    categories[title_id].append(category)
+        return [(title, categories[i]) for i, title in rows]
+
+    def suggest(self, text, limit=SUGGEST_LIMIT):
+        '''
+        Returns up to `limit` titles for autocompleting `text`: titles starting
+        with it first (an index range scan), then other titles containing its
+        words.
+        '''
+        key = sort_key(text)
+        if not key:
+            return []
+        with self._lock:
+            conn = self._connect()
+            titles = [row[0] for row in conn.execute(
+                "SELECT title FROM title WHERE sort_key >= ? AND sort_key < ? ORDER BY sort_key LIMIT ?",
+                (key, key + u"\uffff", limit),
+            )]
+            query = self._matching(text)
+            if len(titles) < limit and query is not None:
+                select, params = query
+                for _, title in conn.execute(select + " LIMIT ?", params + [limit * 2]):
+                    if len(titles) >= limit:
+                        break
+                    if title not in titles:
+                        titles.append(title)
+        return titles
+
+def open_search_index():
+    '''Returns a `SearchIndex` saved in `CACHE_DIR`, or kept in memory if caching is disabled.'''
+    if not CACHE_DIR:
+        return SearchIndex(None)
+    makedirs(CACHE_DIR)
+    return SearchIndex(os.path.join(CACHE_DIR, "search.db"))
@@ -5,21 +5,50 @@ $ ~/mp_app_env/bin/python runtests.py
 $ ~/mp_app_env/bin/python runtests.py --coverage
 '''
 
+import BaseHTTPServer
+import gzip
 import json
 import os
 import random
+import shutil
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
 import unittest
+from cStringIO import StringIO
 from functools import wraps
 
 # An empty sqlite URL means using an in-memory DB. We need to set this
 # before importing `app`.
 os.environ['DBURI'] = "sqlite://"
+# Likewise, an empty cache directory turns off the shared caches.
+os.environ['CACHE_DIR'] = ""
+# The in-memory DB isn't visible to background threads, tests refresh recommendations themselves.
+os.environ['RECOMMENDATIONS_REFRESH_DELAY'] = "-1"
 
-from mock import patch, mock_open
+import flask
+import sqlalchemy
+from mock import patch
 
+import app as app_module
 from app import app, db
 from app import User, Category, Movie, Comment
-from movies import fetch_wikipedia_titles
+import httpclient
+import metrics
+from httpclient import HTTPClient, HTTPError, PoolTimeout, Response, ResponseTooLarge
+from cache import SQLiteCache, LRUCache, TieredCache, DiskCache
+from concurrency import SingleFlight
+from breaker import CircuitBreaker, CircuitOpen, UpstreamUnavailable
+from titleindex import TitleIndex, SharedTitleIndex
+from passwords import HashingPool, HashingOverloaded, needs_rehash
+from metrics import Registry, render
+from search import SearchIndex
+import recommendations
+from movies import (
+    OMDB_NOT_FOUND, MoviePicker, OMDbError, fetch_wikipedia_titles, fetch_omdb_info, fetch_omdb_info_many,
+)
 
 app.config['TESTING'] = True  # to get full tracebacks in our tests
 app.config['WTF_CSRF_ENABLED'] = False  # turn off CSRF protection for tests
@@ -64,18 +93,582 @@ def with_app_context(f):
 ## non-app tests ##############################################################
 
 class MoviePickerTests(unittest.TestCase):
-    urlopen = mock_open(read_data='{"query": {"categorymembers": [{"title": "Up"}]}}')
-
-    @patch("urllib.urlopen", urlopen)
-    def test_fetch_wikipedia_titles(self):
+    @patch("httpclient.get")
+    def test_fetch_wikipedia_titles(self, get):
+        get.return_value = Response("", 200, {}, '{"query": {"categorymembers": [{"title": "Up"}]}}')
         titles = fetch_wikipedia_titles("Pixar_animated_films")
-        assert len(self.urlopen.mock_calls) == 2
-        assert "https://en.wikipedia.org/" in str(self.urlopen.mock_calls[0])
-        assert "Pixar_animated_films" in str(self.urlopen.mock_calls[0])
-        assert "read()" in str(self.urlopen.mock_calls[1])
+        assert len(get.mock_calls) == 1
+        assert "https://en.wikipedia.org/" in str(get.mock_calls[0])
+        assert "Pixar_animated_films" in str(get.mock_calls[0])
         assert len(titles) == 1
         assert titles[0] == 'Up'
 
+    @patch("movies.fetch_omdb_info")
+    def test_fetch_omdb_info_many(self, fetch):
+        def fake_fetch(title):
+            time.sleep(random.random() / 100)
+            if title == "Pixar":
+                raise OMDbError(OMDB_NOT_FOUND, title)
+            if title == "Brave":
+                raise IOError("timed out looking up 'Movie not found!'")
+            return {"Title": title}
+        fetch.side_effect = fake_fetch
+        titles = ["Up", "Cars", "Pixar", "Coco", "Brave"]
+        results = fetch_omdb_info_many(titles, max_workers=3)
+        assert [r.title for r in results] == titles
+        assert [r.data["Title"] for r in results if r.data] == ["Up", "Cars", "Coco"]
+        assert isinstance(results[2].error, RuntimeError) and results[2].data is None
+        assert [r.not_found for r in results] == [False, False, True, False, False]
+
+    @patch("movies.fetch_omdb_info")
+    def test_movie_picker_prefetch(self, fetch):
+        def fake_fetch(title):
+            if title.startswith("Category"):
+                raise RuntimeError("OMDb API returned 'Movie not found!'")
+            return {"Title": title}
+        fetch.side_effect = fake_fetch
+        titles = ["Up", "Cars", "Category A", "Coco", "Category B", "Brave"]
+        picker = MoviePicker(titles, prefetch=2, workers=2)
+        picked = [picker.get_random_movie().title for _ in range(4)]
+        assert sorted(picked) == ["Brave", "Cars", "Coco", "Up"]
+        with self.assertRaises(IndexError):
+            picker.get_random_movie()
+        picker.close()
+
+    @patch("movies.fetch_omdb_info")
+    def test_movie_picker_retry_budget(self, fetch):
+        fetch.side_effect = RuntimeError("OMDb API returned 'Movie not found!'")
+        picker = MoviePicker(["Category {}".format(i) for i in range(20)])
+        with self.assertRaises(RuntimeError):
+            picker.get_random_movie()
+        assert len(fetch.mock_calls) == 10
+
+        fetch.side_effect = CircuitOpen("omdb", 10)
+        with self.assertRaises(UpstreamUnavailable):
+            picker.get_random_movie()
+        assert len(fetch.mock_calls) == 11 and len(picker.titles) == 10
+
+class CircuitBreakerTests(unittest.TestCase):
+    def test_trip_and_half_open_probe(self):
+        breaker = CircuitBreaker("omdb", error_rate=0.5, min_calls=4, window=60, open_seconds=0.05)
+        def fail():
+            raise IOError("timed out")
+        assert breaker.call(lambda: 1) == 1
+        for _ in range(2):
+            with self.assertRaises(UpstreamUnavailable):
+                breaker.call(fail)
+        assert breaker.state == 'closed'
+        with self.assertRaises(UpstreamUnavailable):
+            breaker.call(fail)
+        assert breaker.state == 'open'
+
+        #refused without calling the upstream while open
+        calls = []
+        with self.assertRaises(CircuitOpen):
+            breaker.call(calls.append, 1)
+        assert calls == []
+
+        #a failed probe opens it again, a successful one closes it
+        time.sleep(0.05)
+        with self.assertRaises(UpstreamUnavailable):
+            breaker.call(fail)
+        assert breaker.state == 'open'
+        time.sleep(0.05)
+        assert breaker.call(lambda: 2) == 2
+        assert breaker.state == 'closed'
+        assert breaker.stats() == dict(state='closed', calls=6, failures=4, rejected=1, trips=2)
+
+    def test_interrupted_probe_counts_as_failure(self):
+        breaker = CircuitBreaker("omdb", error_rate=0.5, min_calls=1, window=60, open_seconds=0.05)
+        class Interrupted(BaseException):
+            pass
+        def interrupted():
+            raise Interrupted()
+        with self.assertRaises(UpstreamUnavailable):
+            breaker.call(lambda: 1 / 0)
+        time.sleep(0.05)
+        with self.assertRaises(Interrupted):
+            breaker.call(interrupted)
+        assert breaker.state == 'open'
+        time.sleep(0.05)
+        assert breaker.call(lambda: 2) == 2
+        assert breaker.state == 'closed'
+
+class CacheTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = SQLiteCache(os.path.join(self.tmpdir, "test.db"), ttl=60)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_sqlite_cache_ttl(self):
+        assert self.cache.get("Pixar_animated_films") is None
+        self.cache.set("Pixar_animated_films", [u"Up", u"Cars"])
+        entry = self.cache.get("Pixar_animated_films")
+        assert entry.value == [u"Up", u"Cars"]
+        assert entry.is_fresh
+        self.cache.set("Pixar_animated_films", [u"Up"], ttl=-1)
+        entry = self.cache.get("Pixar_animated_films")
+        assert entry.value == [u"Up"]
+        assert not entry.is_fresh
+
+    def test_sqlite_cache_one_connection_per_process(self):
+        connect = sqlite3.connect
+        connections = []
+        def counting_connect(*a, **kw):
+            connections.append(a)
+            return connect(*a, **kw)
+        with patch("sqlite3.connect", counting_connect):
+            cache = SQLiteCache(os.path.join(self.tmpdir, "shared.db"), ttl=60)
+            threads = [threading.Thread(target=cache.set, args=(str(i), i)) for i in range(5)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        assert [cache.get(str(i)).value for i in range(5)] == range(5)
+        assert len(connections) == 1
+
+    def test_sqlite_cache_purge(self):
+        self.cache.set("up", 1, ttl=-10)
+        self.cache.set("cars", 2, ttl=-1)
+        self.cache.set("coco", 3)
+        #stale entries are kept for the grace period
+        assert self.cache.purge() == 0
+        assert self.cache.purge(older_than=5) == 1
+        assert self.cache.get("up") is None
+        assert self.cache.get("cars").value == 2
+        #and purged by a `set` every now and then
+        self.cache.grace = 0
+        with patch("cache.CACHE_PURGE_PROBABILITY", 1):
+            self.cache.set("coco", 4)
+        assert self.cache.get("cars") is None
+        assert self.cache.get("coco").value == 4
+
+    @patch("movies.crawl_wikipedia_titles")
+    def test_fetch_wikipedia_titles_stale_while_revalidate(self, crawl):
+        crawl.return_value = [u"Up", u"Cars"]
+        with patch("movies.wikipedia_cache", self.cache):
+            assert fetch_wikipedia_titles("Pixar_animated_films") == [u"Up", u"Cars"]
+            assert fetch_wikipedia_titles("Pixar_animated_films") == [u"Up", u"Cars"]
+            assert len(crawl.mock_calls) == 1
+
+            #stale entries are served immediately and refreshed in the background
+            self.cache.set("Pixar_animated_films", [u"Up"], ttl=-1)
+            assert fetch_wikipedia_titles("Pixar_animated_films") == [u"Up"]
+            for _ in range(50):
+                if self.cache.get("Pixar_animated_films").is_fresh:
+                    break
+                time.sleep(0.01)
+            assert len(crawl.mock_calls) == 2
+            assert fetch_wikipedia_titles("Pixar_animated_films") == [u"Up", u"Cars"]
+
+    def test_lru_cache_eviction(self):
+        lru = LRUCache(2, ttl=60)
+        lru.set("a", 1)
+        lru.set("b", 2)
+        assert lru.get("a").value == 1
+        lru.set("c", 3)
+        assert lru.get("b") is None
+        assert lru.get("c").value == 3
+        assert lru.stats() == dict(hits=2, misses=1, evictions=1, size=2, maxsize=2)
+        #stale entries are returned so they can be served as a fallback, but they're refetched so they aren't hits
+        lru.set("c", 3, ttl=-1)
+        assert lru.get("c").value == 3
+        assert lru.stats() == dict(hits=2, misses=2, evictions=1, size=2, maxsize=2)
+
+    @patch("movies.OMDB_NOT_FOUND_TTL", 10)
+    @patch("movies.request_omdb_info")
+    def test_fetch_omdb_info_negative_caching(self, request):
+        omdb_cache = TieredCache(LRUCache(10, ttl=60), self.cache)
+        with patch("movies.omdb_cache", omdb_cache):
+            request.return_value = {"Title": "Up", "Year": "2009"}
+            assert fetch_omdb_info(u"Up")["Year"] == "2009"
+            assert fetch_omdb_info(u"  up ")["Year"] == "2009"
+            assert len(request.mock_calls) == 1
+
+            request.return_value = {"Response": "False", "Error": "Movie not found!"}
+            for _ in range(2):
+                with self.assertRaises(RuntimeError):
+                    fetch_omdb_info(u"Pixar")
+            assert len(request.mock_calls) == 2
+            assert self.cache.get(u"pixar").expires < self.cache.get(u"up").expires
+
+    @patch("movies.request_omdb_info")
+    def test_fetch_omdb_info_coalesces_concurrent_lookups(self, request):
+        started = threading.Event()
+        release = threading.Event()
+        def slow_request(title):
+            started.set()
+            release.wait()
+            return {"Title": "Up", "Year": "2009"}
+        request.side_effect = slow_request
+        flight = SingleFlight('omdb')
+        omdb_cache = TieredCache(LRUCache(10, ttl=60), self.cache)
+        with patch("movies.omdb_cache", omdb_cache), patch("movies.omdb_flight", flight):
+            results = []
+            threads = [threading.Thread(target=lambda: results.append(fetch_omdb_info(u"Up"))) for _ in range(5)]
+            threads[0].start()
+            started.wait()
+            for t in threads[1:]:
+                t.start()
+            for _ in range(50):
+                if flight.deduplicated == 4:
+                    break
+                time.sleep(0.01)
+            release.set()
+            for t in threads:
+                t.join()
+        assert [r["Year"] for r in results] == ["2009"] * 5
+        assert len(request.mock_calls) == 1
+        assert flight.stats() == dict(calls=1, deduplicated=4, shared=0)
+
+    def test_single_flight_errors_and_cross_worker_lock(self):
+        flight = SingleFlight('test', self.tmpdir)
+        def fail():
+            raise RuntimeError("upstream down")
+        with self.assertRaises(RuntimeError):
+            flight.do("up", fail)
+        #failures aren't remembered
+        assert flight.do("up", lambda: 1) == 1
+
+        #another worker holding the lock for a key makes this one wait, then use what it stored
+        other_worker = SingleFlight('test', self.tmpdir)
+        stored = []
+        def slow_fetch():
+            time.sleep(0.1)
+            stored.append(2)
+            return 2
+        t = threading.Thread(target=other_worker.do, args=("up", slow_fetch))
+        t.start()
+        time.sleep(0.02)
+        #other keys don't wait on it
+        start = time.time()
+        assert flight.do("cars", lambda: 4) == 4
+        assert time.time() - start < 0.05
+        assert flight.do("up", lambda: 3, lambda: stored[0] if stored else None) == 2
+        t.join()
+        assert flight.stats() == dict(calls=4, deduplicated=0, shared=1)
+        assert [name for name in os.listdir(self.tmpdir) if name.endswith(".lock")] == []
+
+    @patch("httpclient.get")
+    def test_fetch_omdb_info_stale_fallback(self, get):
+        omdb_cache = TieredCache(LRUCache(10, ttl=60), self.cache)
+        omdb_cache.set(u"up", {"Title": "Up", "Year": "2009"}, ttl=-1)
+        breaker = CircuitBreaker("omdb", min_calls=1, open_seconds=60)
+        get.side_effect = IOError("timed out")
+        with patch("movies.omdb_cache", omdb_cache), patch("movies.omdb_breaker", breaker):
+            assert fetch_omdb_info(u"Up")["Year"] == "2009"
+            assert breaker.state == 'open'
+            assert fetch_omdb_info(u"Up")["Year"] == "2009"
+            with self.assertRaises(CircuitOpen):
+                fetch_omdb_info(u"Cars")
+        assert len(get.mock_calls) == 1
+
+    def test_disk_cache_lru_eviction(self):
+        disk = DiskCache(os.path.join(self.tmpdir, "posters"), max_bytes=10)
+        def writer(data):
+            return lambda f: f.write(data)
+        a = disk.add("http://a.test/a.jpg", writer("aaaa"))
+        os.utime(a, (1, 1))
+        b = disk.add("http://a.test/b.jpg", writer("bbbb"))
+        os.utime(b, (2, 2))
+        assert disk.get("http://a.test/a.jpg") == a  #a is now the most recently used
+        disk.add("http://a.test/c.jpg", writer("cccc"))
+        assert disk.get("http://a.test/b.jpg") is None
+        assert open(disk.get("http://a.test/a.jpg")).read() == "aaaa"
+        assert disk.add("http://a.test/d.jpg", lambda f: False) is None
+
+class TitleIndexTests(unittest.TestCase):
+    titles = {
+        "Pixar_animated_films": [u"Up", u"Cars", u"Coco"],
+        "Empty_films": [],
+        "Claymation_films": [u"Chicken Run"],
+    }
+
+    def test_title_index(self):
+        index = TitleIndex.build(["Pixar_animated_films", "Empty_films", "Claymation_films"], fetch=self.titles.get)
+        assert len(index) == 4
+        assert index.titles_for("Claymation_films") == [u"Chicken Run"]
+        assert index.titles_for("Empty_films") == []
+        for _ in range(20):
+            assert index.random_title() in index.titles
+            assert index.random_title(by_category=True) in index.titles
+        assert TitleIndex([], [], [0]).random_title() is None
+
+    def test_packed_title_index(self):
+        titles = dict(self.titles, Foreign_films=[u"Am\xe9lie", u"\u5343\u3068\u5343\u5c0b\u306e\u795e\u96a0\u3057"])
+        index = TitleIndex.build(["Pixar_animated_films", "Empty_films", "Foreign_films"], fetch=titles.get)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "title_index.bin")
+            index.save(path)
+            packed = TitleIndex.load(path)
+            assert packed.categories == index.categories
+            assert packed.built == index.built
+            assert len(packed) == 5
+            assert "Empty_films" in packed and "Claymation_films" not in packed
+            for name in index.categories:
+                assert list(packed.titles_for(name)) == index.titles_for(name)
+                assert packed.checksum(name) == index.checksum(name)
+            foreign = packed.titles_for("Foreign_films")
+            assert foreign[-1] == titles["Foreign_films"][1]
+            assert list(packed.titles_for("Pixar_animated_films")[1:]) == [u"Cars", u"Coco"]
+            assert len(packed.titles_for("Empty_films")) == 0
+            for _ in range(20):
+                assert packed.random_title(by_category=True) in index.titles
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @patch("titleindex.fetch_wikipedia_titles")
+    def test_title_index_limits(self, fetch):
+        fetch.return_value = [u"Up"]
+        class Huge(str):
+            def __len__(self):
+                return 2 ** 31
+        class HugeTitle(unicode):
+            def encode(self, encoding):
+                return Huge("x")
+        index = TitleIndex(["Huge_films"], [HugeTitle(u"a"), HugeTitle(u"b")], [0, 2])
+        with self.assertRaises(RuntimeError):
+            index.save(os.path.join(tempfile.gettempdir(), "title_index.bin"))
+
+        #a stale index that's already being rebuilt doesn't queue up another rebuild
+        shared = SharedTitleIndex(None, ttl=-1)
+        shared.rebuild(["Pixar_animated_films"])
+        shared._rebuilding = True
+        listed = []
+        shared.get(lambda: listed.append(1) or [])
+        assert listed == [] and shared._pending is None
+
+    @patch("titleindex.fetch_wikipedia_titles")
+    def test_shared_title_index_saved(self, fetch):
+        fetch.side_effect = self.titles.get
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "title_index.json")
+            SharedTitleIndex(path, ttl=60).get(lambda: ["Pixar_animated_films", "Claymation_films"])
+            #another worker loads the saved index instead of building its own
+            index = SharedTitleIndex(path, ttl=60).get(lambda: [])
+            assert index.categories == ["Pixar_animated_films", "Claymation_films"]
+            assert list(index.titles_for("Pixar_animated_films")) == [u"Up", u"Cars", u"Coco"]
+            assert len(fetch.mock_calls) == 2
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @patch("titleindex.fetch_wikipedia_titles")
+    def test_shared_title_index_one_rebuild(self, fetch):
+        started = threading.Event()
+        def slow_fetch(name):
+            started.set()
+            time.sleep(0.1)
+            return self.titles[name]
+        fetch.side_effect = slow_fetch
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "title_index.bin")
+            names = ["Pixar_animated_films"]
+            workers = [SharedTitleIndex(path, ttl=60) for _ in range(3)]
+            threads = [threading.Thread(target=w.rebuild, args=(names,)) for w in workers]
+            threads[0].start()
+            started.wait()
+            for t in threads[1:]:
+                t.start()
+            for t in threads:
+                t.join()
+            #the other workers waited for the first one's rebuild and mapped the file it saved
+            assert len(fetch.mock_calls) == 1
+            assert len(set(w.current().built for w in workers)) == 1
+            #unless it doesn't have their categories
+            assert workers[1].rebuild(names + ["Claymation_films"]).categories == names + ["Claymation_films"]
+            assert len(fetch.mock_calls) == 3
+        finally:
+            shutil.rmtree(tmpdir)
+
+class SearchIndexTests(unittest.TestCase):
+    def test_search_and_suggest(self):
+        self.check_search_and_suggest(SearchIndex(None))
+
+    def test_search_and_suggest_without_fts5(self):
+        with patch("search.FTS_SCHEMA", ["CREATE VIRTUAL TABLE title_fts USING no_such_module(title)"]):
+            index = SearchIndex(None)
+        assert not index.full_text
+        self.check_search_and_suggest(index)
+        assert index.search("story_2") == []
+
+    def check_search_and_suggest(self, index):
+        index.update_category("Pixar_animated_films", [u"Toy Story", u"Toy Story 2", u"Up", u"Cars"])
+        index.update_category("Disney_films", [u"Toy Story", u"The Lion King"])
+        assert index.search("toy") == [
+            (u"Toy Story", ["Disney_films", "Pixar_animated_films"]),
+            (u"Toy Story 2", ["Pixar_animated_films"]),
+        ]
+        assert index.search("story to") == index.search("toy sto")
+        assert index.search("lion king!") == [(u"The Lion King", ["Disney_films"])]
+        assert index.search('"') == []
+        assert index.suggest("th") == [u"The Lion King"]
+        #titles starting with the query come before other matches
+        assert index.suggest("ki") == [u"The Lion King"]
+        assert index.suggest("c") == [u"Cars"]
+        assert index.update_category("Disney_films", [u"Toy Story", u"The Lion King"]) is False
+
+        index.update_category("Pixar_animated_films", [u"Up", u"Coco"])
+        assert index.search("toy") == [(u"Toy Story", ["Disney_films"])]
+        assert index.search("cars") == []
+        index.sync(TitleIndex(["Pixar_animated_films"], [u"Up"], [0, 1]), ["Pixar_animated_films"])
+        assert index.categories() == ["Pixar_animated_films"]
+        assert index.search("toy") == []
+        assert index.suggest("u") == [u"Up"]
+
+class HTTPClientTests(unittest.TestCase):
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            self.server.client_ports.append(self.client_address[1])
+            if self.path in ("/redirect", "/loop"):
+                self.send_response(302)
+                self.send_header("Location", "/final?from=redirect" if self.path == "/redirect" else "/loop")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            if self.path == "/trickle":
+                self.send_response(200)
+                self.send_header("Content-Length", "40")
+                self.end_headers()
+                try:
+                    for _ in range(40):
+                        self.wfile.write("x")
+                        self.wfile.flush()
+                        time.sleep(0.02)
+                except socket.error:
+                    pass
+                return
+            body = '{"path": "%s"}' % self.path
+            buf = StringIO()
+            with gzip.GzipFile(fileobj=buf, mode="wb") as f:
+                f.write(body)
+            self.send_response(200)
+            self.send_header("Content-Encoding", "gzip")
+            self.send_header("Content-Length", str(len(buf.getvalue())))
+            self.end_headers()
+            self.wfile.write(buf.getvalue())
+
+        def log_message(self, *a):
+            pass
+
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), self.Handler)
+        self.server.client_ports = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_keep_alive_and_gzip(self):
+        client = HTTPClient(connect_timeout=1, read_timeout=1)
+        url = "http://127.0.0.1:{}/w/api.php?t=Toy Story".format(self.server.server_port)
+        res1 = client.get(url)
+        res2 = client.get(url)
+        assert res1.status == 200
+        assert res1.json() == {"path": "/w/api.php?t=Toy%20Story"}
+        assert res2.json() == res1.json()
+        #both requests went over the same connection
+        assert len(set(self.server.client_ports)) == 1
+
+    def test_redirects_and_read_deadline(self):
+        client = HTTPClient(connect_timeout=1, read_timeout=1)
+        base = "http://127.0.0.1:{}".format(self.server.server_port)
+        res = client.get(base + "/redirect")
+        assert res.json() == {"path": "/final?from=redirect"}
+        assert res.url == base + "/final?from=redirect"
+        with self.assertRaises(HTTPError):
+            client.get(base + "/loop")
+        assert HTTPClient(max_redirects=0).get(base + "/redirect").status == 302
+        #every byte arrives well within the read timeout, the whole body doesn't
+        start = time.time()
+        with self.assertRaises(socket.timeout):
+            client.get(base + "/trickle", read_timeout=0.3)
+        assert time.time() - start < 0.5
+
+    def test_upstream_metric_labels(self):
+        client = HTTPClient(connect_timeout=1, read_timeout=1)
+        url = "http://127.0.0.1:{}/".format(self.server.server_port)
+        client.get(url)
+        text = render(metrics.registry.collect())
+        #hosts that weren't registered all share one label value
+        assert 'upstream_request_duration_seconds_count{status="200",upstream="other"}' in text
+        assert '127.0.0.1' not in text
+        with patch.dict(httpclient.upstream_labels):
+            httpclient.register_upstream(url, "stub")
+            client.get(url)
+        assert 'upstream_request_duration_seconds_count{status="200",upstream="stub"} 1' in render(metrics.registry.collect())
+
+    def test_pool_timeout(self):
+        client = HTTPClient(connect_timeout=1, read_timeout=1, max_connections_per_host=1)
+        url = "http://127.0.0.1:{}/".format(self.server.server_port)
+        pool = client._pool_for("http", "127.0.0.1", self.server.server_port)
+        conn, _ = pool.acquire(1, 1)
+        start = time.time()
+        with self.assertRaises(PoolTimeout):
+            client.get(url, pool_timeout=0.1)
+        assert time.time() - start < 1
+        pool.release(conn, True)
+        assert client.get(url, pool_timeout=0.1).status == 200
+
+    def test_download_write_error_releases_connection(self):
+        client = HTTPClient(connect_timeout=1, read_timeout=1, max_connections_per_host=1)
+        url = "http://127.0.0.1:{}/".format(self.server.server_port)
+        class FullDisk(object):
+            def write(self, data):
+                raise IOError(28, "No space left on device")
+        for _ in range(2):
+            with self.assertRaises(IOError):
+                client.download(url, FullDisk(), pool_timeout=0.1)
+        assert client.get(url, pool_timeout=0.1).status == 200
+
+    def test_download_accept_and_max_bytes(self):
+        client = HTTPClient(connect_timeout=1, read_timeout=1, max_connections_per_host=1)
+        url = "http://127.0.0.1:{}/".format(self.server.server_port)
+        f = StringIO()
+        assert client.download(url, f, accept=lambda r: r.headers["content-encoding"] != "gzip").status == 200
+        assert f.getvalue() == ""
+        with self.assertRaises(ResponseTooLarge):
+            client.download(url, f, max_bytes=5, pool_timeout=0.1)
+        assert client.download(url, f, max_bytes=1000, pool_timeout=0.1).status == 200
+        assert f.getvalue()
+
+class MetricsTests(unittest.TestCase):
+    def test_workers_aggregated(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            worker1, worker2 = Registry(tmpdir), Registry(tmpdir)
+            worker2.path = worker2.path.replace(".json", "-2.json") #same pid in the test, pretend it's another worker
+            worker1.observe("http_request_duration_seconds", 0.02, endpoint="index", method="GET", status=200)
+            worker2.observe("http_request_duration_seconds", 0.3, endpoint="index", method="GET", status=200)
+            worker2.observe("upstream_request_duration_seconds", 20, upstream="omdb", status="error")
+            worker2.flush()
+            text = render(worker1.collect())
+            labels = 'endpoint="index",method="GET",status="200"'
+            assert 'http_request_duration_seconds_bucket{%s,le="0.025"} 1' % labels in text
+            assert 'http_request_duration_seconds_bucket{%s,le="0.5"} 2' % labels in text
+            assert 'http_request_duration_seconds_bucket{%s,le="+Inf"} 2' % labels in text
+            assert 'http_request_duration_seconds_count{%s} 2' % labels in text
+            assert 'upstream_request_duration_seconds_bucket{status="error",upstream="omdb",le="10.0"} 0' in text
+            assert 'upstream_request_duration_seconds_count{status="error",upstream="omdb"} 1' in text
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_failed_statement_timer_dropped(self):
+        conn = sqlalchemy.create_engine("sqlite://").connect()
+        with self.assertRaises(sqlalchemy.exc.OperationalError):
+            conn.execute("SELECT * FROM no_such_table")
+        assert conn.info['metrics_start'] == []
+        conn.close()
+
 ## app tests ##################################################################
 
 class ViewTests(AppTestCase):
@@ -96,6 +689,67 @@ class ViewTests(AppTestCase):
         assert 'Inside Out' in str(fetch.mock_calls[0])
         assert 'Genre' in res.data and 'View this movie on IMDb' in res.data
 
+    @patch('app.fetch_omdb_info')
+    @with_logged_in_user
+    def test_recommendation_panels(self, fetch):
+        fetch.side_effect = lambda title: {"Title": title, "Year": "2001", "Plot": "", "Genre": "", "imdbRating": "",
+                                           "imdbID": "tt1", "Poster": "N/A", "Response": "True"}
+        with app.app_context():
+            other = User.create("panelist", "panelist@wow.com", "asdfasdf")
+            other.update_list([("add", "Panel One"), ("add", "Panel Two")])
+        self.client.post('/user/list', data=json.dumps({"changes": [{"action": "add", "title": "Panel One"}]}),
+                         content_type='application/json')
+        with app.app_context():
+            recommendations.refresh()
+        res = self.client.get('/movie/Panel%20One')
+        assert "People who listed this also listed" in res.data and "Panel Two" in res.data
+        res = self.client.get('/user')
+        assert "You might also like" in res.data and "Panel Two" in res.data
+
+    @patch('app.fetch_omdb_info')
+    def test_movie_page_upstream_unavailable(self, fetch):
+        fetch.side_effect = CircuitOpen("omdb", 12)
+        res = self.client.get('/movie/Inside%20Out')
+        assert res.status == '503 SERVICE UNAVAILABLE'
+        assert res.headers['Retry-After'] == '12'
+        assert "Inside Out" in res.data and "OMDb" in res.data
+
+    @with_logged_in_user
+    def test_update_list(self):
+        changes = [{"action": "add", "title": "Batch {}".format(i)} for i in range(600)]
+        changes.append({"action": "remove", "title": "Batch 0"})
+        res = self.client.post('/user/list', data=json.dumps({"changes": changes}), content_type='application/json')
+        assert res.status == '200 OK'
+        result = json.loads(res.data)['result']
+        assert len(result) == 601
+        assert result[1] == dict(action="add", title="Batch 1", status="added", error=None)
+        assert result[-1]["status"] == "removed"
+        with app.app_context():
+            with self.client.session_transaction() as sess:
+                user = User.query.get(sess['user'])
+            assert len(user.movies) == 599
+
+        res = self.client.post('/user', data=dict(action="remove", title="Batch 1"))
+        assert res.data == "Removed."
+        res = self.client.post('/user', data=dict(action="add", title="  "))
+        assert res.status == '400 BAD REQUEST'
+        assert res.data == "Title must not be blank."
+        #form posts aren't accepted, so other sites can't make changes on a user's behalf
+        res = self.client.post('/user/list', data=dict(changes="x"))
+        assert res.status == '400 BAD REQUEST'
+
+    @patch('app.fetch_omdb_info')
+    def test_movie_page_ingested(self, fetch):
+        with app.app_context():
+            m = Movie.get_or_create("Ingested Out")
+            m.set_omdb_data({"Title": "Ingested Out", "Year": "2015", "Genre": "Animation", "Plot": "Feelings.",
+                             "imdbRating": "8.2", "imdbID": "tt2096673", "Poster": "N/A", "Response": "True"})
+            db.session.commit()
+        res = self.client.get('/movie/Ingested%20Out')
+        assert res.status == '200 OK'
+        assert 'Feelings.' in res.data and '8.2/10' in res.data
+        assert fetch.mock_calls == []
+
     @with_logged_in_user
     def test_add_cat_logged_in_form(self):
         res = self.client.get('/categories')
@@ -126,6 +780,60 @@ class ViewTests(AppTestCase):
         assert 'Signed in as <a href="/user">test2</a>' in res2.data
         self.client.get('/logout') # so we don't pollute other tests
 
+    @patch('httpclient.download')
+    def test_rehost_image_cached(self, download):
+        def fake_download(url, f, **kw):
+            if "slow" in url:
+                raise socket.timeout("timed out")
+            response = Response(url, 200, {"content-type": "text/html" if "html" in url else "image/png"}, None)
+            if kw["accept"](response):
+                f.write("PNG DATA")
+            return response
+        download.side_effect = fake_download
+        tmpdir = tempfile.mkdtemp()
+        try:
+            with patch('app.poster_cache', DiskCache(tmpdir, max_bytes=1024)):
+                res = self.client.get('/rehost_image?url=http://img.test/poster.png')
+                assert res.status == '200 OK'
+                assert res.data == "PNG DATA"
+                assert res.headers['Content-Type'] == 'image/png'
+                assert 'max-age' in res.headers['Cache-Control']
+                res2 = self.client.get('/rehost_image?url=http://img.test/poster.png', headers={'If-None-Match': res.headers['ETag']})
+                assert res2.status == '304 NOT MODIFIED'
+                assert len(download.mock_calls) == 1
+                #upstream errors and responses that aren't images are a bad gateway, and aren't cached
+                assert self.client.get('/rehost_image?url=http://img.test/slow.png').status == '502 BAD GATEWAY'
+                assert self.client.get('/rehost_image?url=http://img.test/page.html').status == '502 BAD GATEWAY'
+                assert len(os.listdir(tmpdir)) == 2
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_api_cache_stats(self):
+        res = self.client.get('/api/cache')
+        data = json.loads(res.data)
+        assert set(data['omdb']['local']) == set(['hits', 'misses', 'evictions', 'size', 'maxsize'])
+        assert set(data['coalescing']['omdb']) == set(['calls', 'deduplicated', 'shared'])
+
+    def test_search(self):
+        search_index = SearchIndex(None)
+        shared = SharedTitleIndex(None, 60, search_index)
+        shared.index = TitleIndex.build(["Pixar_animated_films"], fetch={"Pixar_animated_films": [u"Toy Story", u"Up"]}.get)
+        with patch.object(app_module, 'search_index', search_index), patch.object(app_module, 'title_index', shared):
+            res = self.client.get('/search?q=toy')
+            assert res.status == '200 OK'
+            assert 'Toy Story' in res.data
+            assert 'Up' not in res.data
+            res = self.client.get('/search/suggest?q=u')
+            assert json.loads(res.data) == {"result": ["Up"]}
+
+    def test_metrics(self):
+        self.client.get('/api/category')
+        res = self.client.get('/metrics')
+        assert res.status == '200 OK'
+        assert 'http_request_duration_seconds_count{endpoint="api.category",method="GET",status="200"}' in res.data
+        assert 'http_request_sql_statements_bucket{endpoint="api.category",le="1.0"}' in res.data
+        assert 'sql_statement_duration_seconds_count ' in res.data
+
     def test_api_user_json(self):
         res = self.client.get('/api/user')
         assert res.status == '200 OK'
@@ -133,6 +841,182 @@ class ViewTests(AppTestCase):
         assert isinstance(data, dict)
         assert 'result' in data
 
+    @with_app_context
+    def test_api_category_pagination(self):
+        for i in range(5):
+            Category.create("Paginated_films_{}".format(i))
+        ids = [c.id for c in Category.query.order_by(Category.id)]
+        data = json.loads(self.client.get('/api/category?limit=2').data)
+        assert [row['id'] for row in data['result']] == ids[:2]
+        data = json.loads(self.client.get('/api/category?limit=2&after={}'.format(data['next'])).data)
+        assert [row['id'] for row in data['result']] == ids[2:4]
+        data = json.loads(self.client.get('/api/category?limit=100&after={}'.format(ids[2])).data)
+        assert [row['id'] for row in data['result']] == ids[3:]
+        assert data['next'] is None
+
+    @with_app_context
+    def test_api_category_stream(self):
+        Category.create("Streamed_films")
+        with patch('api.STREAM_BATCH_SIZE', 2):
+            res = self.client.get('/api/category?stream=1')
+            data = json.loads(res.data)
+        assert [row['id'] for row in data['result']] == [c.id for c in Category.query.order_by(Category.id)]
+
+    @with_app_context
+    def test_api_movie_constant_queries(self):
+        u = User.create("nplusone", "nplusone@wow.com", "asdfasdf")
+        for i in range(10):
+            m = Movie.get_or_create("N+1 Movie {}".format(i))
+            m.add_comment(Comment(user_id=u.id, contents="Visible", is_visible=True, is_deleted=False))
+            m.add_comment(Comment(user_id=u.id, contents="Pending"))
+
+        statements = []
+        def count(conn, cursor, statement, *a):
+            statements.append(statement)
+        sqlalchemy.event.listen(db.engine, "before_cursor_execute", count)
+        try:
+            small = json.loads(self.client.get('/api/movie?limit=2').data)
+            num_small = len(statements)
+            del statements[:]
+            large = json.loads(self.client.get('/api/movie?limit=10').data)
+            num_large = len(statements)
+        finally:
+            sqlalchemy.event.remove(db.engine, "before_cursor_execute", count)
+        assert len(small['result']) == 2 and len(large['result']) == 10
+        assert num_small == num_large
+        for row in large['result']:
+            if row['title'].startswith("N+1 Movie"):
+                assert [c['contents'] for c in row['comments']] == ["Visible"]
+
+    @with_logged_in_user
+    def test_identity_cache_skips_user_query(self):
+        statements = []
+        def count(conn, cursor, statement, *a):
+            statements.append(statement)
+        with app.app_context():
+            sqlalchemy.event.listen(db.engine, "before_cursor_execute", count)
+        try:
+            self.client.get('/')
+            del statements[:]
+            res = self.client.get('/')
+        finally:
+            with app.app_context():
+                sqlalchemy.event.remove(db.engine, "before_cursor_execute", count)
+        assert 'Signed in as' in res.data
+        assert not [s for s in statements if 'FROM user' in s]
+
+    @with_app_context
+    def test_identity_cache_role_invalidation(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            with patch.object(app_module, 'identity_stamps', SQLiteCache(os.path.join(tmpdir, "identities.db"), 60)):
+                u = User.create("promoted", "promoted@wow.com", "asdfasdf")
+                cached = (None, app_module.Identity(u.id, u.username, None))
+                app_module.identity_cache.set(u.id, cached)
+                other_worker = LRUCache(10, 60)
+                other_worker.set(u.id, cached)
+                other_worker_checks = LRUCache(10, 60)
+                other_worker_checks.set(u.id, None)
+                u.role = 'moderator'
+                db.session.commit()
+                assert app_module.identity_cache.get(u.id) is None
+                with app.test_request_context(), patch.object(app_module, 'identity_cache', other_worker), \
+                        patch.object(app_module, 'identity_stamp_checks', other_worker_checks):
+                    flask.session['user'] = u.id
+                    #another worker trusts the stamp it just read for a little while
+                    assert app_module.current_identity().role is None
+                    #then its cached identity has the old stamp, so it's looked up again
+                    other_worker_checks.delete(u.id)
+                    assert app_module.current_identity().role == 'moderator'
+                    assert app_module.current_identity().role == 'moderator'
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @with_logged_in_user
+    def test_moderation_bulk_approve_reject(self):
+        with app.app_context():
+            with self.client.session_transaction() as sess:
+                moderator = User.query.get(sess['user'])
+            moderator.role = 'moderator'
+            m = Movie.get_or_create("Moderated Movie")
+            for i in range(4):
+                m.add_comment(Comment(user_id=moderator.id, contents="Spike comment {}".format(i)))
+            ids = [c.id for c in m.comments.order_by(Comment.id)]
+
+        res = self.client.get('/admin/moderation/')
+        assert res.status == '200 OK'
+        assert all("Spike comment {}".format(i) in res.data for i in range(4))
+
+        res = self.client.post('/admin/moderation/approve_many', data=dict(comment_ids=ids[:3]))
+        assert res.status == '302 FOUND'
+        self.client.post('/admin/moderation/reject_many', data=dict(comment_ids=ids[3:]))
+        with app.app_context():
+            comments = Comment.query.filter(Comment.id.in_(ids)).order_by(Comment.id).all()
+            assert [(c.is_visible, c.is_deleted) for c in comments] == [(True, False)] * 3 + [(False, True)]
+        assert "Spike comment" not in self.client.get('/admin/moderation/').data
+
+    @with_logged_in_user
+    @patch('app.fetch_omdb_info')
+    def test_movie_page_cache(self, fetch):
+        fetch.return_value = {"Title": "Cached Movie", "Year": "2001", "Plot": "", "Genre": "", "imdbRating": "",
+                              "imdbID": "tt1", "Poster": "N/A", "Response": "True"}
+        with app.app_context():
+            with self.client.session_transaction() as sess:
+                moderator = User.query.get(sess['user'])
+            moderator.role = 'moderator'
+            m = Movie.get_or_create("Cached Movie")
+            m.add_comment(Comment(user_id=moderator.id, contents="Cached comment"))
+            comment_id = m.comments.one().id
+
+        with patch.object(app_module, 'page_cache', LRUCache(100, 60)):
+            res = self.client.get('/movie/Cached%20Movie')
+            assert res.status == '200 OK'
+            assert "Cached comment" not in res.data
+            res2 = self.client.get('/movie/Cached%20Movie', headers={'If-None-Match': res.headers['ETag']})
+            assert res2.status == '304 NOT MODIFIED'
+            assert len(fetch.mock_calls) == 1
+
+            self.client.post('/admin/moderation/approve', data=dict(comment_id=comment_id))
+            res3 = self.client.get('/movie/Cached%20Movie', headers={'If-None-Match': res.headers['ETag']})
+            assert res3.status == '200 OK'
+            assert "Cached comment" in res3.data
+            assert len(fetch.mock_calls) == 2
+
+    @patch('app.fetch_wikipedia_titles')
+    def test_category_page_cache(self, fetch):
+        fetch.return_value = [u"Up", u"Cars"]
+        with patch.object(app_module, 'page_cache', LRUCache(100, 60)):
+            etag = self.client.get('/categories/Pixar_animated_films').headers['ETag']
+            assert self.client.get('/categories/Pixar_animated_films').headers['ETag'] == etag
+            assert len(fetch.mock_calls) == 1
+            #a re-crawl found new titles
+            app_module.invalidate_category_page('Pixar_animated_films')
+            fetch.return_value = [u"Up", u"Cars", u"Coco"]
+            res = self.client.get('/categories/Pixar_animated_films', headers={'If-None-Match': etag})
+            assert res.status == '200 OK'
+            assert "Coco" in res.data
+
+    @patch('titleindex.fetch_wikipedia_titles')
+    def test_indexed_category_page_cache(self, fetch):
+        fetch.return_value = [u"Up", u"Cars"]
+        index = SharedTitleIndex(None, ttl=60)
+        index.rebuild(["Pixar_animated_films"])
+        page_cache = LRUCache(100, 60)
+        with patch.object(app_module, 'page_cache', page_cache), patch.object(app_module, 'title_index', index):
+            etag = self.client.get('/categories/Pixar_animated_films').headers['ETag']
+            #a rebuild that leaves the titles alone keeps the cached page
+            index.rebuild(["Pixar_animated_films"])
+            res = self.client.get('/categories/Pixar_animated_films', headers={'If-None-Match': etag})
+            assert res.status == '304 NOT MODIFIED'
+            assert page_cache.stats()['hits'] == 1
+            fetch.return_value = [u"Up", u"Cars", u"Coco"]
+            index.rebuild(["Pixar_animated_films"])
+            assert "Coco" in self.client.get('/categories/Pixar_animated_films').data
+            #pages are replaced, not added next to the old ones
+            assert page_cache.stats()['size'] == 1
+            app_module.invalidate_category_page('Pixar_animated_films')
+            assert page_cache.stats()['size'] == 0
+
 class ModelTests(AppTestCase):
     @with_app_context
     def test_user_create(self):
@@ -143,6 +1027,21 @@ class ModelTests(AppTestCase):
         assert len(users) == 1
         assert users[0].username == "test"
 
+    @with_app_context
+    def test_user_rehash_on_login(self):
+        u = User.create("rehash", "rehash@wow.com", "asdfasdf")
+        assert not needs_rehash(u.password_hash)
+        with patch("passwords.PASSWORD_HASH_ROUNDS", 1000):
+            assert needs_rehash(u.password_hash)
+            assert User.validate("rehash", "asdfasdf").id == u.id
+            assert not needs_rehash(User.query.get(u.id).password_hash)
+        assert User.validate("rehash@wow.com", "asdfasdf").id == u.id
+
+    def test_hashing_pool_overload(self):
+        assert HashingPool(0, 0, 1).run(len, "inline") == 6
+        with self.assertRaises(HashingOverloaded):
+            HashingPool(1, 0, 1).run(len, "overloaded")
+
     @with_app_context
     def test_category_create(self):
         c = Category.create("Cheezy movies")
@@ -161,6 +1060,81 @@ class ModelTests(AppTestCase):
         assert len(ms) == 1
         assert ms[0].title == "Monty Python and the Holy Test"
 
+    @with_app_context
+    def test_movie_omdb_data(self):
+        m = Movie.get_or_create("Monty Python and the Holy Data")
+        assert m.omdb_data is None
+        m.set_omdb_data({"Title": "Monty Python and the Holy Grail", "Year": "1975", "imdbRating": "N/A", "Poster": "N/A"})
+        assert m.omdb_data["Year"] == "1975"
+        assert m.omdb_data["imdbRating"] == "N/A"
+        assert m.omdb_data["Title"] == "Monty Python and the Holy Data"
+        m.set_omdb_data({"Response": "False", "Error": "Movie not found!"})
+        assert m.omdb_data["Error"] == "Movie not found!"
+
+    @with_app_context
+    def test_user_add_remove_list(self):
+        u = User.create("lister", "lister@wow.com", "asdfasdf")
+        other = User.create("otherlister", "otherlister@wow.com", "asdfasdf")
+        u.add_to_list("Monty Python and the List Test")
+        u.add_to_list("Monty Python and the List Test")
+        u.add_to_list("The Meaning of Lists")
+        other.add_to_list("Monty Python and the List Test")
+        assert sorted(m.title for m in u.movies) == ["Monty Python and the List Test", "The Meaning of Lists"]
+        assert Movie.query.filter_by(title="Monty Python and the List Test").count() == 1
+
+        u.remove_from_list("Monty Python and the List Test")
+        u.remove_from_list("Not On The List")
+        assert [m.title for m in u.movies] == ["The Meaning of Lists"]
+        assert [m.title for m in other.movies] == ["Monty Python and the List Test"]
+
+    @with_app_context
+    def test_user_update_list(self):
+        u = User.create("bulklister", "bulklister@wow.com", "asdfasdf")
+        u.add_to_list("Bulk Existing")
+        Movie.get_or_create("Bulk Not On List")
+        results = u.update_list([
+            ("add", "Bulk New"),
+            ("add", "Bulk Existing"),
+            ("add", "Bulk Not On List"),
+            ("remove", "Bulk Existing"),
+            ("add", "Bulk Added Then Removed"),
+            ("remove", "Bulk Added Then Removed"),
+            ("remove", "Bulk Never Seen"),
+            ("rename", "Bulk New"),
+            ("add", "   "),
+        ])
+        assert [status for status, _ in results] == [
+            "added", "unchanged", "added", "removed", "added", "removed", "unchanged", "error", "error"]
+        assert results[-1][1] == "Title must not be blank."
+        assert sorted(m.title for m in u.movies) == ["Bulk New", "Bulk Not On List"]
+        assert Movie.query.filter_by(title="Bulk Added Then Removed").count() == 1
+        assert Movie.query.filter_by(title="Bulk Never Seen").count() == 0
+
+    @with_app_context
+    def test_recommendations(self):
+        users = [User.create("recommender{}".format(i), "recommender{}@wow.com".format(i), "asdfasdf") for i in range(3)]
+        users[0].update_list([("add", "Rec A"), ("add", "Rec B"), ("add", "Rec C")])
+        users[1].update_list([("add", "Rec A"), ("add", "Rec B")])
+        users[2].update_list([("add", "Rec A"), ("add", "Rec D")])
+        recommendations.rebuild()
+        ids = dict((m.title, m.id) for m in Movie.query.filter(Movie.title.like("Rec %")))
+        #A and B are on 2 lists together, A is on 3 and B on 2
+        similar = recommendations.compute([ids["Rec A"]])[ids["Rec A"]]
+        assert similar[0] == (2 / (3 ** 0.5 * 2 ** 0.5), ids["Rec B"])
+        assert recommendations.also_listed(ids["Rec A"]) == ["Rec B", "Rec C", "Rec D"]
+        assert recommendations.also_listed(ids["Rec D"]) == ["Rec A"]
+        assert recommendations.suggestions(users[1].id) == ["Rec C", "Rec D"]
+
+        #refreshing after a change gives the same result as rebuilding everything
+        users[2].update_list([("remove", "Rec A"), ("add", "Rec C")])
+        assert recommendations.also_listed(ids["Rec D"]) == ["Rec A"]
+        assert recommendations.refresh() == 4
+        assert recommendations.refresh() == 0
+        refreshed = [recommendations.also_listed(ids[t]) for t in ["Rec A", "Rec B", "Rec C", "Rec D"]]
+        assert refreshed[3] == ["Rec C"]
+        recommendations.rebuild()
+        assert refreshed == [recommendations.also_listed(ids[t]) for t in ["Rec A", "Rec B", "Rec C", "Rec D"]]
+
     @with_app_context
     def test_comment_create(self):
         m = Movie.get_or_create("Monty Python and the Holy Test")
@@ -0,0 +1,319 @@
+'''
+Precomputed index of the titles in every saved category, so picking a random
+movie or listing a category doesn't require crawling Wikipedia.
+
+The index is a single list of titles with the titles of each category stored
+next to each other, plus an offsets array marking where each category starts.
+It is saved to a packed file in the cache directory that every worker maps
+into memory read-only, so the titles are held once by the OS page cache no
+matter how many workers there are, instead of as Python strings in each one.
+
+Packed file layout, all integers little-endian:
+
+    header      magic, version, built timestamp, category count, title count
+    categories  per category: start and end of its name in the blob, index
+                of its first title and one past its last title
+    offsets     title count + 1 uint32s, title i is blob[offsets[i]:offsets[i+1]]
+    blob        UTF-8 category names followed by the UTF-8 titles
+'''
+
+import hashlib
+import logging
+import mmap
+import os
+import random
+import struct
+import sys
+import tempfile
+import threading
+import time
+from array import array
+
+from cache import CACHE_DIR, makedirs
+from concurrency import file_lock
+from movies import fetch_wikipedia_titles
+
+#rebuild the index after this many seconds
+TITLE_INDEX_TTL = int(os.environ.get('TITLE_INDEX_TTL', 60 * 60))
+#seconds a worker waits for another worker's rebuild to finish before giving up on it
+TITLE_INDEX_LOCK_TIMEOUT = 300
+
+MAGIC = "MPTITLES"
+VERSION = 1
+HEADER = struct.Struct('<8sIdII')
+CATEGORY = struct.Struct('<IIII')
+OFFSET = struct.Struct('<I')
+
+class BaseTitleIndex(object):
+    '''
+    Lookups shared by the in-memory and packed indexes. Subclasses provide
+    `categories`, `offsets` (where each category's titles start, plus the
+    total), `built`, `title(i)` and `titles_for(category)`.
+    '''
+    def __len__(self):
+        return self.offsets[-1]
+
+    def __contains__(self, category):
+        return category in self._positions
+
+    def _range(self, category):
+        i = self._positions[category]
+        return self.offsets[i], self.offsets[i + 1]
+
+    def checksum(self, category):
+        '''SHA-1 of the titles of `category`, which stays the same across rebuilds as long as its titles do.'''
+        if category not in self._checksums:
+            titles = u"\n".join(self.titles_for(category))
+            self._checksums[category] = hashlib.sha1(titles.encode('utf8')).hexdigest()
+        return self._checksums[category]
+
+    def random_title(self, by_category=False):
+        '''
+        Returns a random title, chosen uniformly across all titles or, if
+        `by_category` is set, from a uniformly chosen (non-empty) category.
+        Returns None if the index is empty.
+        '''
+        if not len(self):
+            return None
+        if by_category:
+            nonempty = [i for i in range(len(self.categories)) if self.offsets[i + 1] > self.offsets[i]]
+            i = random.choice(nonempty)
+            return self.title(random.randrange(self.offsets[i], self.offsets[i + 1]))
+        return self.title(random.randrange(len(self)))
+
+class TitleIndex(BaseTitleIndex):
+    def __init__(self, categories, titles, offsets, built=None):
+        '''
+        `titles[offsets[i]:offsets[i+1]]` are the titles in `categories[i]`.
+        '''
+        self.categories = categories
+        self.titles = titles
+        self.offsets = array('L', offsets)
+        self.built = time.time() if built is None else built
+        self._positions = dict((name, i) for i, name in enumerate(categories))
+        self._checksums = {}
+
+    @classmethod
+    def build(cls, category_names, fetch=None):
+        '''Build an index of `category_names`, fetching titles with `fetch` (defaults to `fetch_wikipedia_titles`).'''
+        fetch = fetch or fetch_wikipedia_titles
+        categories, titles, offsets = [], [], [0]
+        for name in category_names:
+            try:
+                category_titles = fetch(name)
+            except Exception:
+                logging.exception("Failed to fetch titles for %r, leaving it out of the title index", name)
+                continue
+            categories.append(name)
+            titles.extend(category_titles)
+            offsets.append(len(titles))
+        return cls(categories, titles, offsets)
+
+    def title(self, i):
+        return self.titles[i]
+
+    def titles_for(self, category):
+        start, end = self._range(category)
+        return self.titles[start:end]
+
+    def save(self, path):
+        '''Write the index to `path` in the packed format, atomically replacing any existing file.'''
+        names = [name.encode('utf8') for name in self.categories]
+        titles = [title.encode('utf8') for title in self.titles]
+        #summed as Python ints, array('I') raises OverflowError on values past 32 bits
+        blob_offsets = [0]
+        for chunk in names + titles:
+            blob_offsets.append(blob_offsets[-1] + len(chunk))
+        if blob_offsets[-1] >= 2 ** 32:
+            raise RuntimeError("Title index too large to pack.")
+        title_offsets = array('I', blob_offsets[len(names):])
+        if sys.byteorder != 'little':
+            title_offsets.byteswap()
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, self.built, len(names), len(titles)))
+            for i in range(len(names)):
+                f.write(CATEGORY.pack(blob_offsets[i], blob_offsets[i + 1], self.offsets[i], self.offsets[i + 1]))
+            f.write(title_offsets.tostring())
+            for chunk in names:
+                f.write(chunk)
+            for chunk in titles:
+                f.write(chunk)
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        '''Map the packed index at `path` into memory, returns a `PackedTitleIndex`.'''
+        return PackedTitleIndex(path)
+
+class PackedTitles(object):
+    '''
+    Read-only sequence of the titles `start` to `end` of a `PackedTitleIndex`.
+    Titles are decoded from the mapped file as they're accessed.
+    '''
+    def __init__(self, index, start, end):
+        self.index = index
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step != 1:
+                return [self[j] for j in range(start, stop, step)]
+            return PackedTitles(self.index, self.start + start, self.start + max(start, stop))
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self.index.title(self.start + i)
+
+    def __iter__(self):
+        for i in range(self.start, self.end):
+            yield self.index.title(i)
+
+class PackedTitleIndex(BaseTitleIndex):
+    '''
+    A title index saved by `TitleIndex.save`, mapped read-only. Only the
+    category table is decoded up front.
+    '''
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.built, num_categories, num_titles = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise RuntimeError("{} is not a packed title index.".format(path))
+        self._offsets_at = HEADER.size + CATEGORY.size * num_categories
+        self._blob_at = self._offsets_at + OFFSET.size * (num_titles + 1)
+
+        self.categories = []
+        self.offsets = array('L')
+        for i in range(num_categories):
+            name_start, name_end, first, end = CATEGORY.unpack_from(self._map, HEADER.size + CATEGORY.size * i)
+            self.categories.append(self._map[self._blob_at + name_start:self._blob_at + name_end].decode('utf8'))
+            self.offsets.append(first)
+        self.offsets.append(num_titles)
+        self._positions = dict((name, i) for i, name in enumerate(self.categories))
+        self._checksums = {}
+
+    def title(self, i):
+        start, end = struct.unpack_from('<II', self._map, self._offsets_at + OFFSET.size * i)
+        return self._map[self._blob_at + start:self._blob_at + end].decode('utf8')
+
+    def titles_for(self, category):
+        start, end = self._range(category)
+        return PackedTitles(self, start, end)
+
+class SharedTitleIndex(object):
+    '''
+    Holds the current `TitleIndex`, rebuilding it in a background thread once
+    it is older than `ttl` seconds. When `path` is set the index is saved there
+    and workers pick up indexes built by other workers; only one worker
+    rebuilds at a time, the others wait for it and map the file it saved.
+    Every index built is also synced into `search_index`, if given.
+    '''
+    def __init__(self, path, ttl, search_index=None):
+        self.path = path
+        self.ttl = ttl
+        self.search_index = search_index
+        self.index = None
+        self._mtime = None
+        self._lock = threading.Lock()
+        self._rebuilding = False
+        self._pending = None
+
+    def _load_saved(self):
+        if not self.path:
+            return
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return
+        #every save renames a new file into place, so the inode changes
+        if (st.st_ino, st.st_mtime) != self._mtime:
+            self.index = TitleIndex.load(self.path)
+            self._mtime = (st.st_ino, st.st_mtime)
+
+    def _build(self, category_names):
+        index = TitleIndex.build(category_names)
+        if self.search_index is not None:
+            self.search_index.sync(index, category_names)
+        if self.path:
+            index.save(self.path)
+            self._mtime = None
+            self._load_saved()
+        else:
+            self.index = index
+        return self.index
+
+    def rebuild(self, category_names):
+        if not self.path:
+            return self._build(category_names)
+        requested = time.time()
+        with file_lock(self.path + '.lock', TITLE_INDEX_LOCK_TIMEOUT) as locked:
+            self._load_saved()
+            if self.index is not None:
+                #another worker may have rebuilt it while we waited for the lock
+                if self.index.built >= requested and set(category_names) <= set(self.index.categories):
+                    return self.index
+                if not locked:
+                    logging.warning("Timed out waiting for another worker to rebuild the title index")
+                    return self.index
+            return self._build(category_names)
+
+    def _rebuild_in_background(self, category_names):
+        while category_names is not None:
+            try:
+                self.rebuild(category_names)
+            except Exception:
+                logging.exception("Failed to rebuild the title index")
+            with self._lock:
+                #pick up categories added while we were rebuilding
+                category_names, self._pending = self._pending, None
+                if category_names is None:
+                    self._rebuilding = False
+
+    def get(self, get_category_names):
+        '''
+        Returns the current index. `get_category_names` is called to list the
+        categories to index if the index needs building. The first call builds
+        the index before returning, later calls return the current index while
+        stale ones are rebuilt in the background.
+        '''
+        self._load_saved()
+        if self.index is None:
+            return self.rebuild(get_category_names())
+        #a stale index is already being rebuilt, don't queue up another rebuild after it
+        if time.time() - self.index.built > self.ttl and not self._rebuilding:
+            self.refresh(get_category_names())
+        return self.index
+
+    def current(self):
+        '''Returns the current index, or None if there isn't one yet. Never builds one.'''
+        self._load_saved()
+        return self.index
+
+    def refresh(self, category_names):
+        '''
+        Rebuild the index in a background thread. If a rebuild is already
+        running, another one is done after it finishes.
+        '''
+        with self._lock:
+            if self._rebuilding:
+                self._pending = list(category_names)
+                return
+            self._rebuilding = True
+        t = threading.Thread(target=self._rebuild_in_background, args=(list(category_names),))
+        t.daemon = True
+        t.start()
+
+def open_title_index(ttl=TITLE_INDEX_TTL, search_index=None):
+    '''Returns a `SharedTitleIndex` saved in `CACHE_DIR`, or kept in memory if caching is disabled.'''
+    if not CACHE_DIR:
+        return SharedTitleIndex(None, ttl, search_index)
+    makedirs(CACHE_DIR)
+    return SharedTitleIndex(os.path.join(CACHE_DIR, "title_index.bin"), ttl, search_index)